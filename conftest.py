@@ -0,0 +1 @@
+"""pytest configuration: Sage's modules live at the repository root, which this file puts on sys.path"""
@@ -12,9 +12,12 @@ from typing import Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass
 import logging
 import asyncio
+import time
 import websocket
 from datetime import datetime
 
+from sage_guard import GUARDS
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -27,15 +30,25 @@ class M8Client:
         self.client = httpx.Client(timeout=self.timeout)
         self.async_client = httpx.AsyncClient(timeout=self.timeout)
     
+    def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send a request through the nexus's rate limiter and circuit breaker"""
+        url = f"{self.base_url}{path}"
+        guard = GUARDS.for_url(self.base_url)  # one circuit for the whole nexus
+        time.sleep(guard.admit(self.timeout))
+        try:
+            response = self.client.request(method, url, **kwargs)
+        except Exception as e:
+            guard.record(None, e)
+            raise
+        guard.record(response.status_code, retry_after=response.headers.get("retry-after"))
+        return response
+    
     def upload_context(self, text: str, importance: int = 7) -> Dict[str, Any]:
         """Upload text context to M8 nexus"""
         try:
             # Upload as plain text
             files = {'file': ('context.txt', text.encode(), 'text/plain')}
-            response = self.client.post(
-                f"{self.base_url}/upload/text",
-                files=files
-            )
+            response = self._request("POST", "/upload/text", files=files)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -46,10 +59,7 @@ class M8Client:
         """Upload Marqant compressed data"""
         try:
             files = {'file': ('data.mq', marqant_data, 'application/octet-stream')}
-            response = self.client.post(
-                f"{self.base_url}/upload/marqant",
-                files=files
-            )
+            response = self._request("POST", "/upload/marqant", files=files)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -59,7 +69,7 @@ class M8Client:
     def retrieve_container(self, wave_signature: str) -> Optional[str]:
         """Retrieve container content by wave signature"""
         try:
-            response = self.client.get(f"{self.base_url}/container/{wave_signature}")
+            response = self._request("GET", f"/container/{wave_signature}")
             response.raise_for_status()
             return response.text
         except Exception as e:
@@ -69,7 +79,7 @@ class M8Client:
     def get_latest_context(self) -> Optional[Dict[str, Any]]:
         """Get the latest language memory context"""
         try:
-            response = self.client.get(f"{self.base_url}/mem8/context/latest")
+            response = self._request("GET", "/mem8/context/latest")
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -79,7 +89,7 @@ class M8Client:
     def get_stats(self) -> Optional[Dict[str, Any]]:
         """Get nexus and MEM8 statistics"""
         try:
-            response = self.client.get(f"{self.base_url}/mem8/stats")
+            response = self._request("GET", "/mem8/stats")
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -174,6 +184,12 @@ class M8ContextManager:
             logger.error(f"Failed to save context to 8q-is: {e}")
             return None
     
+    def record_command(self, command: str):
+        """Append a suggested command to the recent commands stored in 8q-is"""
+        context = self.load_context() or {"recent_commands": []}
+        context["recent_commands"] = context.get("recent_commands", [])[-9:] + [command]
+        self.save_context(context)
+    
     def load_context(self) -> Optional[Dict[str, Any]]:
         """Load context from 8q-is"""
         try:
@@ -6,24 +6,37 @@ Sage - AI-powered tmux session monitoring with persona support
 import subprocess
 import time
 import random
-import re
 import sys
 import os
+import threading
 import yaml
 import json
 import argparse
 import logging
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import urlsplit
 from typing import Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass, field
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
 from rich.console import Console
 from rich.table import Table
 from rich.panel import Panel
-from rich.progress import Progress, SpinnerColumn, TextColumn
-import httpx
-import zlib
 import hashlib
+from sage_http import HTTP_POOL, PoolSettings
+from sage_markqant import (
+    DictionaryStore, MarkqantProcessor, PersonaContext, train_shared_dictionary,
+)
+from sage_ai import HedgeCancelled, complete, extract_command, extract_commands
+from sage_cache import (
+    CandidateQueue, SuggestionCache, SimHashIndex, SUGGESTION_CACHE_FILE, SIMILARITY_MAX_DISTANCE,
+    context_key, state_key,
+)
+from sage_guard import GUARDS, CircuitOpenError, RateLimitedError, circuit_name
+from sage_routing import ROUTER, persona_endpoints
+from sage_predict import CommandPredictor, LOCAL_ENDPOINT
+from sage_prompt import BuiltPrompt, PromptBuilder, build_messages, summarize_pane, suggestion_prompt, DEFAULT_PROMPT_BUDGET
+from sage_tmux import TmuxSnapshotter, PaneSnapshot, ControlModeMonitor, ActivityTracker, looks_idle
 
 # Initialize rich console for beautiful output
 console = Console()
@@ -31,29 +44,13 @@ console = Console()
 # Sage configuration
 SAGE_DIR = Path.home() / ".sage"
 PERSONAS_DIR = SAGE_DIR / "personas"
+DICTIONARIES_DIR = SAGE_DIR / "dictionaries"
+# Shared Markqant dictionary every persona and context is written with, once trained
+SHARED_DICTIONARY = "sage"
 DEFAULT_SESSION = "my-session"
 IDLE_THRESHOLD_RANGE = (10, 20)
 CHECK_INTERVAL = 1
 
-# Markqant token definitions
-MARKQANT_TOKENS = {
-    "T00": "# ",
-    "T01": "## ",
-    "T02": "### ",
-    "T03": "#### ",
-    "T04": "```",
-    "T05": "```\n",
-    "T06": "- ",
-    "T07": "* ",
-    "T08": "1. ",
-    "T09": "> ",
-    "T0A": "**",
-    "T0B": "*",
-    "T0C": "---",
-    "T0D": "\n\n",
-    "T0E": "| ",
-}
-
 @dataclass
 class PersonaConfig:
     """Configuration for an AI persona"""
@@ -66,153 +63,22 @@ class PersonaConfig:
     tools: List[str] = field(default_factory=list)
     mcp_tools: List[str] = field(default_factory=list)
     system_prompt: str = ""
+    http: Dict[str, Any] = field(default_factory=dict)
+    stream: bool = False
+    prompt_budget: int = DEFAULT_PROMPT_BUDGET
+    endpoints: List[Dict[str, Any]] = field(default_factory=list)
+    prompt_cache: bool = True
+    candidates: int = 1
+    local_confidence: float = 0.0  # answer locally when the predictor is this sure (0 = never)
+    local_fallback: bool = False
     
-@dataclass
-class PersonaContext:
-    """Context and personality from .mq file"""
-    name: str
-    personality: str
-    compressed_content: str
-    original_size: int
-    compressed_size: int
-    timestamp: datetime
-
-class MarkqantProcessor:
-    """Handles Markqant (.mq) format compression and decompression"""
-    
-    def __init__(self):
-        self.dynamic_tokens = {}
-        self.next_token_id = 0x10  # Start after predefined tokens
-        
-    def compress(self, content: str) -> Tuple[str, Dict[str, str]]:
-        """Compress markdown content to Markqant format"""
-        # Count pattern frequencies
-        pattern_freq = {}
-        for pattern in MARKQANT_TOKENS.values():
-            count = content.count(pattern)
-            if count > 0:
-                pattern_freq[pattern] = count
-                
-        # Find additional patterns that appear 3+ times
-        words = re.findall(r'\b\w+\b', content)
-        word_freq = {}
-        for word in words:
-            if len(word) > 5:  # Only consider longer words
-                word_freq[word] = word_freq.get(word, 0) + 1
-                
-        # Assign dynamic tokens
-        dynamic_tokens = {}
-        for word, count in sorted(word_freq.items(), key=lambda x: x[1], reverse=True):
-            if count >= 3 and self.next_token_id <= 0xFF:
-                token = f"T{self.next_token_id:02X}"
-                dynamic_tokens[token] = word
-                self.next_token_id += 1
-                
-        # Create reverse mapping
-        all_tokens = {**MARKQANT_TOKENS, **dynamic_tokens}
-        reverse_tokens = {v: k for k, v in all_tokens.items()}
-        
-        # Compress content
-        compressed = content
-        for pattern, token in sorted(reverse_tokens.items(), key=lambda x: len(x[0]), reverse=True):
-            compressed = compressed.replace(pattern, token)
-            
-        return compressed, dynamic_tokens
-        
-    def decompress(self, compressed: str, dynamic_tokens: Dict[str, str]) -> str:
-        """Decompress Markqant content back to markdown"""
-        all_tokens = {**MARKQANT_TOKENS, **dynamic_tokens}
-        
-        # Sort by token length to avoid partial replacements
-        decompressed = compressed
-        for token in sorted(all_tokens.keys(), key=len, reverse=True):
-            decompressed = decompressed.replace(token, all_tokens[token])
-            
-        return decompressed
-        
-    def create_mq_file(self, content: str, filename: str) -> str:
-        """Create a complete .mq file with header"""
-        compressed, dynamic_tokens = self.compress(content)
-        
-        # Build token dictionary
-        token_dict = "\n".join([f"{k}={v}" for k, v in dynamic_tokens.items()])
-        
-        # Calculate sizes
-        original_size = len(content.encode('utf-8'))
-        compressed_size = len(compressed.encode('utf-8'))
-        
-        # Create header
-        header = f"MARKQANT_V1 {datetime.now().isoformat()}Z {original_size} {compressed_size}"
-        
-        # Optional zlib compression if beneficial
-        if compressed_size > 1000:
-            compressed_bytes = zlib.compress(compressed.encode('utf-8'))
-            if len(compressed_bytes) < compressed_size:
-                header += " -zlib"
-                compressed = compressed_bytes.hex()
-                compressed_size = len(compressed_bytes)
-                
-        # Build complete file
-        mq_content = f"{header}\n"
-        if token_dict:
-            mq_content += f"{token_dict}\n"
-        mq_content += "---\n"
-        mq_content += compressed
-        
-        return mq_content
-        
-    def parse_mq_file(self, mq_content: str) -> PersonaContext:
-        """Parse a .mq file and return decompressed content"""
-        lines = mq_content.strip().split('\n')
-        
-        # Parse header
-        header_parts = lines[0].split()
-        version = header_parts[0]
-        timestamp = datetime.fromisoformat(header_parts[1].rstrip('Z'))
-        original_size = int(header_parts[2])
-        compressed_size = int(header_parts[3])
-        flags = header_parts[4:] if len(header_parts) > 4 else []
-        
-        # Find content separator
-        separator_idx = next(i for i, line in enumerate(lines) if line == "---")
-        
-        # Parse dynamic tokens
-        dynamic_tokens = {}
-        for i in range(1, separator_idx):
-            if '=' in lines[i]:
-                token, pattern = lines[i].split('=', 1)
-                dynamic_tokens[token] = pattern
-                
-        # Get compressed content
-        compressed = '\n'.join(lines[separator_idx + 1:])
-        
-        # Handle zlib compression
-        if "-zlib" in flags:
-            compressed = zlib.decompress(bytes.fromhex(compressed)).decode('utf-8')
-            
-        # Decompress
-        content = self.decompress(compressed, dynamic_tokens)
-        
-        # Extract persona name from first line
-        name_match = re.match(r'#\s+(.+)\s+Persona', content)
-        name = name_match.group(1) if name_match else "Unknown"
-        
-        return PersonaContext(
-            name=name,
-            personality=content,
-            compressed_content=compressed,
-            original_size=original_size,
-            compressed_size=compressed_size,
-            timestamp=timestamp
-        )
-
 class PersonaManager:
     """Manages AI personas and their configurations"""
     
     def __init__(self):
         self.personas_dir = PERSONAS_DIR
         self.ensure_directories()
-        self.markqant = MarkqantProcessor()
+        self.markqant = MarkqantProcessor(dictionaries=DictionaryStore(DICTIONARIES_DIR), shared=SHARED_DICTIONARY)
         
     def ensure_directories(self):
         """Create necessary directories"""
@@ -228,8 +94,7 @@ class PersonaManager:
             raise ValueError(f"Persona '{persona_name}' not found in {self.personas_dir}")
             
         # Load personality from .mq file
-        with open(mq_path, 'r') as f:
-            context = self.markqant.parse_mq_file(f.read())
+        context = self.markqant.read_mq_file(mq_path)
             
         # Load configuration from .yml file
         with open(yml_path, 'r') as f:
@@ -244,7 +109,15 @@ class PersonaManager:
             max_tokens=config_data.get('max_tokens', 500),
             tools=config_data.get('tools', []),
             mcp_tools=config_data.get('mcp_tools', []),
-            system_prompt=context.personality
+            system_prompt=context.personality,
+            http=config_data.get('http', {}),
+            stream=config_data.get('stream', False),
+            prompt_budget=config_data.get('prompt_budget', DEFAULT_PROMPT_BUDGET),
+            endpoints=config_data.get('endpoints', []),
+            prompt_cache=config_data.get('prompt_cache', True),
+            candidates=config_data.get('candidates', 1),
+            local_confidence=config_data.get('local_confidence', 0.0),
+            local_fallback=config_data.get('local_fallback', False)
         )
         
         return config, context
@@ -257,10 +130,8 @@ class PersonaManager:
     def create_persona(self, name: str, personality: str, config: Dict[str, Any]):
         """Create a new persona"""
         # Create .mq file
-        mq_content = self.markqant.create_mq_file(personality, f"{name}.mq")
         mq_path = self.personas_dir / f"{name}.mq"
-        with open(mq_path, 'w') as f:
-            f.write(mq_content)
+        self.markqant.write_mq_file(mq_path, personality)
             
         # Create .yml file
         yml_path = self.personas_dir / f"{name}.yml"
@@ -278,7 +149,7 @@ class ContextManager:
         self.project_path = project_path or Path.cwd()
         self.context_dir = self.project_path / ".sage_proj"
         self.context_dir.mkdir(exist_ok=True)
-        self.markqant = MarkqantProcessor()
+        self.markqant = MarkqantProcessor(dictionaries=DictionaryStore(DICTIONARIES_DIR), shared=SHARED_DICTIONARY)
         
     def log_interaction(self, persona: str, prompt: str, response: str):
         """Log an interaction to the project context"""
@@ -297,11 +168,14 @@ class ContextManager:
     def save_context(self, context: Dict[str, Any]):
         """Save current context as compressed .m8 file"""
         context_str = json.dumps(context, indent=2)
-        mq_content = self.markqant.create_mq_file(context_str, "context.m8")
-        
         context_file = self.context_dir / "context.m8"
-        with open(context_file, 'w') as f:
-            f.write(mq_content)
+        self.markqant.write_mq_file(context_file, context_str)
+            
+    def record_command(self, command: str):
+        """Append a suggested command to the recent commands in context"""
+        context = self.load_context() or {"recent_commands": []}
+        context["recent_commands"] = context.get("recent_commands", [])[-9:] + [command]
+        self.save_context(context)
             
     def load_context(self) -> Optional[Dict[str, Any]]:
         """Load context from .m8 file"""
@@ -309,16 +183,31 @@ class ContextManager:
         if not context_file.exists():
             return None
             
-        with open(context_file, 'r') as f:
-            context_data = self.markqant.parse_mq_file(f.read())
-            
+        context_data = self.markqant.read_mq_file(context_file)
         return json.loads(context_data.personality)
 
+@dataclass
+class PendingSuggestion:
+    """An AI query running in the background for a set of idle panes"""
+    panes: List[str]
+    future: Future
+    started: float
+    queue_key: Optional[str] = None
+    queued: bool = False  # the future holds a ready command from the candidate queue
+    cancelled: threading.Event = field(default_factory=threading.Event)  # set to abandon the AI request
+
 class SageSession:
     """Main Sage session manager"""
     
-    def __init__(self, session_name: str, persona_name: str):
+    def __init__(self, session_name: str, persona_name: str, engine: str = "poll",
+                 idle_mode: str = "content", use_cache: bool = True,
+                 max_distance: int = SIMILARITY_MAX_DISTANCE, speculate: Optional[float] = None):
         self.session = session_name
+        self.engine = engine
+        self.idle_mode = idle_mode
+        # Fraction of the idle threshold at which the query starts; the answer is
+        # still only sent once the full threshold has passed
+        self.query_at = 1.0 if speculate is None else min(max(speculate, 0.0), 1.0)
         self.persona_manager = PersonaManager()
         self.context_manager = ContextManager()
         
@@ -337,6 +226,35 @@ class SageSession:
         )
         self.logger = logging.getLogger(__name__)
         
+        # Per-tick pane capture shared by is_idle, get_summary and display_status
+        self.snapshotter = TmuxSnapshotter()
+        self.snapshot: Optional[PaneSnapshot] = None
+        self.activity = ActivityTracker(self.session, snapshotter=self.snapshotter)
+        
+        # AI queries run here so monitoring never blocks on the model
+        self.ai_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sage-ai")
+        self.prompts = PromptBuilder()
+        self.candidates = CandidateQueue()
+        self.predictor = CommandPredictor(self.context_manager.context_dir / "interactions.jsonl")
+        
+        # Answers for idle states we've already asked about
+        self.suggestion_cache: Optional[SuggestionCache] = (
+            SuggestionCache(self.context_manager.context_dir / SUGGESTION_CACHE_FILE)
+            if use_cache else None
+        )
+        # ...and for states that only differ by a line or two (0 bits turns this off)
+        self.similar_index: Optional[SimHashIndex] = (
+            SimHashIndex(self.context_manager.context_dir / "interactions.jsonl", max_distance)
+            if use_cache and max_distance > 0 else None
+        )
+        
+        # Keep-alive connections to the model endpoints, opened ahead of the first query
+        self.http_settings = PoolSettings.from_config(self.config.http)
+        if self.http_settings.warmup:
+            for endpoint in persona_endpoints(self.config):
+                if endpoint.api_endpoint != LOCAL_ENDPOINT:
+                    self.ai_pool.submit(HTTP_POOL.warm_up, endpoint.api_endpoint, self.http_settings)
+        
         console.print(Panel(
             f"[bold cyan]Sage Session Started[/bold cyan]\n"
             f"Session: {self.session}\n"
@@ -357,8 +275,15 @@ class SageSession:
             self.logger.error(f"Failed to list panes for session '{self.session}'")
             return []
             
+    def refresh_snapshot(self, panes: List[str]) -> PaneSnapshot:
+        """Capture every pane in one tmux call for this tick"""
+        self.snapshot = self.snapshotter.capture(panes)
+        return self.snapshot
+        
     def get_pane_content(self, pane_id: str) -> str:
         """Get content from a specific pane"""
+        if self.snapshot is not None and pane_id in self.snapshot:
+            return self.snapshot.content(pane_id)
         return subprocess.check_output(
             ["tmux", "capture-pane", "-pt", pane_id, "-S", "-10"]
         ).decode()
@@ -367,70 +292,25 @@ class SageSession:
         """Check if a pane is idle (showing a shell prompt)"""
         text = self.get_pane_content(pane_id)
         last_line = text.strip().splitlines()[-1] if text.strip() else ""
-        # Enhanced prompt detection
-        idle_patterns = [
-            r".*[\$>#]\s*$",
-            r".*❯\s*$",
-            r".*→\s*$",
-            r".*\)\s*$",  # For custom prompts
-            r"^>>>.*$",    # Python REPL
-            r"^irb.*>.*$", # Ruby IRB
-        ]
-        return any(re.match(pattern, last_line) for pattern in idle_patterns)
+        return looks_idle(last_line)
         
     def get_summary(self, pane_id: str) -> str:
         """Get summary of recent activity in a pane"""
-        content = self.get_pane_content(pane_id)
-        lines = content.strip().splitlines()[-5:]
-        return f"Pane {pane_id}:\n" + "\n".join(lines)
+        return summarize_pane(pane_id, self.get_pane_content(pane_id))
         
-    def query_ai(self, prompt: str) -> str:
-        """Query the AI with the configured persona"""
+    def query_ai(self, prompt: str, cache_key: Optional[str] = None,
+                 messages: Optional[List[Dict[str, str]]] = None,
+                 cancelled: Optional[threading.Event] = None) -> Optional[str]:
+        """Query the AI with the configured persona (None when no answer could be had)"""
         self.logger.info(f"Querying {self.config.model} with prompt")
         
-        # Build messages
-        messages = [
-            {"role": "system", "content": self.config.system_prompt},
-            {"role": "user", "content": prompt}
-        ]
-        
-        # Add context from previous interactions
-        context = self.context_manager.load_context()
-        if context and "recent_commands" in context:
-            messages.insert(1, {
-                "role": "system", 
-                "content": f"Recent commands: {', '.join(context['recent_commands'][-5:])}"
-            })
+        # Build messages, adding context from previous interactions
+        if messages is None:
+            messages = build_messages(self.config, prompt, self.context_manager.load_context())
         
         try:
-            # Make API request
-            headers = {
-                "Authorization": f"Bearer {self.config.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            if "openrouter" in self.config.api_endpoint:
-                headers["HTTP-Referer"] = "https://github.com/sage-ai/sage"
-                headers["X-Title"] = "Sage AI Assistant"
-            
-            data = {
-                "model": self.config.model,
-                "messages": messages,
-                "temperature": self.config.temperature,
-                "max_tokens": self.config.max_tokens
-            }
-            
-            with httpx.Client() as client:
-                response = client.post(
-                    self.config.api_endpoint,
-                    headers=headers,
-                    json=data,
-                    timeout=30.0
-                )
-                response.raise_for_status()
-                
-            result = response.json()
-            ai_response = result['choices'][0]['message']['content']
+            # Make API request (streamed when the persona enables it, hedged across its endpoints)
+            ai_response = complete(self.config, messages, self.http_settings, cancelled)
             
             # Log interaction
             self.context_manager.log_interaction(
@@ -439,23 +319,70 @@ class SageSession:
                 ai_response
             )
             
+            if cache_key and self.suggestion_cache is not None:
+                self.suggestion_cache.put(cache_key, ai_response)
+            
             return ai_response
             
+        except (CircuitOpenError, RateLimitedError) as e:
+            self.logger.warning(f"AI query skipped: {e}")
+            return None
+        except HedgeCancelled:
+            self.logger.info("AI query cancelled")
+            return None
         except Exception as e:
             self.logger.error(f"AI query failed: {e}")
-            return f"echo 'AI query failed: {str(e)}'"
+            return None
             
+    def resolve_suggestion(self, prompt: str, cache_key: Optional[str] = None,
+                           built: Optional[BuiltPrompt] = None,
+                           cancelled: Optional[threading.Event] = None) -> Optional[str]:
+        """Reuse the answer to a near-identical past prompt, ask the local predictor, else query the AI"""
+        if self.similar_index is not None:
+            match = self.similar_index.lookup(self.config.name, prompt)
+            if match is not None:
+                response, distance = match
+                self.logger.info(f"Near-duplicate cache hit ({distance} bits away)")
+                if cache_key and self.suggestion_cache is not None:
+                    self.suggestion_cache.put(cache_key, response)
+                return response
+        
+        # Local predictor: a persona of its own, a confident first tier, or a fallback
+        self.predictor.refresh()
+        recent = (self.context_manager.load_context() or {}).get("recent_commands") or [None]
+        local = self.predictor.predict(prompt, recent[-1])
+        if self.config.api_endpoint == LOCAL_ENDPOINT:
+            return f"`{local[0]}`" if local else None
+        if local and self.config.local_confidence and local[1] >= self.config.local_confidence:
+            self.logger.info(f"Local prediction ({local[1]:.0%} sure): {local[0]}")
+            return f"`{local[0]}`"
+        
+        response = self.query_ai(prompt, cache_key, built.messages if built else None, cancelled)
+        if cancelled is not None and cancelled.is_set():
+            return None
+        if response is None:
+            if local and self.config.local_fallback:
+                self.logger.info(f"Model unavailable, using local prediction: {local[0]}")
+                return f"`{local[0]}`"
+            return None
+        if built is not None:
+            self.prompts.commit(built)
+        self.predictor.compare(local[0] if local else None, extract_command(response))
+        return response
+        
     def send_to_pane(self, pane_id: str, cmd: str):
         """Send command to a tmux pane"""
         subprocess.call(["tmux", "send-keys", "-t", pane_id, cmd, "Enter"])
         self.logger.info(f"Sent to {pane_id}: {cmd}")
         
-    def display_status(self, panes_status: Dict[str, Dict[str, Any]]):
+    def display_status(self, panes_status: Dict[str, Dict[str, Any]],
+                       pending: Optional[PendingSuggestion] = None):
         """Display beautiful status table"""
         table = Table(title=f"Tmux Pane Status - {datetime.now().strftime('%H:%M:%S')} 🖥️")
         table.add_column("Pane ID", style="cyan")
         table.add_column("Status", style="green")
         table.add_column("Idle Time", style="yellow")
+        table.add_column("Last Line", style="dim", overflow="ellipsis", no_wrap=True)
         
         for pane_id, status in panes_status.items():
             idle_time = (
@@ -466,21 +393,134 @@ class SageSession:
             table.add_row(
                 pane_id,
                 "Idle 😴" if status['is_idle'] else "Active 🚀",
-                idle_time
+                idle_time,
+                status.get('last_line', self.snapshot.last_line(pane_id) if self.snapshot else "")
             )
             
+        caption = []
+        if pending is not None:
+            if pending.future.done():
+                caption.append("🔮 Suggestion ready, held until the idle threshold")
+            else:
+                caption.append(f"🧠 Thinking... {time.time() - pending.started:.0f}s")
+        if self.suggestion_cache is not None:
+            stats = self.suggestion_cache.stats()
+            caption.append(f"💾 Cache {stats['hits']} hits / {stats['misses']} misses")
+        if self.similar_index is not None:
+            caption.append(f"≈ {self.similar_index.hits} near hits")
+        breakers = GUARDS.status()
+        for endpoint in persona_endpoints(self.config):
+            circuit = circuit_name(endpoint.api_endpoint, endpoint.model)
+            if circuit in breakers:
+                caption.append(f"🔌 {urlsplit(endpoint.api_endpoint).netloc} {endpoint.model} {breakers[circuit]}")
+        if self.predictor.predictions:
+            caption.append(f"🎯 Local {self.predictor.agreements}/{self.predictor.predictions} agree")
+        if len(self.candidates):
+            caption.append(f"📋 {len(self.candidates)} queued")
+        if self.prompts.total_saved:
+            caption.append(f"✂️ ~{self.prompts.total_saved} tokens saved")
+        table.caption = "  ".join(caption) or None
+            
         console.clear()
         console.print(table)
         
+    def start_suggestion(self, panes: List[str]) -> PendingSuggestion:
+        """Start an AI query in the background; monitoring keeps ticking meanwhile"""
+        console.print("\n[bold magenta]All panes idle! Consulting AI... 🧠[/bold magenta]")
+        
+        # Gather summaries
+        contents = {pid: self.get_pane_content(pid) for pid in panes}
+        summaries = [summarize_pane(pid, text) for pid, text in contents.items()]
+        prompt = suggestion_prompt(summaries)
+        context = self.context_manager.load_context()
+        
+        # Runner-up commands from an earlier answer, while the panes sit at the same prompts
+        queue_key = context_key(self.config.name, self.config.model, summaries)
+        queued = self.candidates.pop(queue_key, exclude=(context or {}).get("recent_commands"))
+        if queued is not None:
+            self.logger.info("Using queued candidate")
+            future: Future = Future()
+            future.set_result(queued)
+            return PendingSuggestion(panes=list(panes), future=future, started=time.time(),
+                                     queue_key=queue_key, queued=True)
+        
+        # Same persona looking at the same panes: answer from the cache
+        cache_key = None
+        if self.suggestion_cache is not None:
+            cache_key = state_key(self.config.name, self.config.model, summaries)
+            cached = self.suggestion_cache.get(cache_key)
+            if cached is not None:
+                self.logger.info("Suggestion cache hit")
+                future = Future()
+                future.set_result(cached)
+                return PendingSuggestion(panes=list(panes), future=future, started=time.time(),
+                                         queue_key=queue_key)
+        
+        # What actually goes to the model: deduped, delta-encoded, within budget
+        built = self.prompts.build(self.config, contents, context)
+        cancelled = threading.Event()
+        
+        return PendingSuggestion(
+            panes=list(panes),
+            # The similarity index loads lazily, so its first lookup stays off the monitor thread
+            future=self.ai_pool.submit(self.resolve_suggestion, prompt, cache_key, built, cancelled),
+            started=time.time(),
+            queue_key=queue_key,
+            cancelled=cancelled
+        )
+        
+    def cancel_suggestion(self, pending: PendingSuggestion):
+        """Drop a suggestion whose panes became active before it arrived"""
+        pending.cancelled.set()  # a running request stops at its next streamed event
+        pending.future.cancel()
+        self.logger.info("Pane became active, discarding pending AI suggestion")
+        
+    def finish_suggestion(self, pending: PendingSuggestion) -> Optional[str]:
+        """Send a completed suggestion to the main pane"""
+        try:
+            response = pending.future.result()
+        except Exception as e:
+            self.logger.error(f"Suggestion failed: {e}")
+            response = None
+        if response is None:
+            # Never type an error message into someone's shell
+            console.print("\n[yellow]No suggestion this time (model unavailable, see log)[/yellow]")
+            return None
+        
+        # Extract command(s) from response; runners-up wait for later idle cycles
+        if pending.queued:
+            command = response
+        else:
+            command, *runners_up = extract_commands(response, self.config.candidates)
+            if runners_up and pending.queue_key:
+                self.candidates.push(pending.queue_key, runners_up)
+        
+        # Send to main pane
+        main_pid = pending.panes[0]
+        console.print(f"\n[green]AI suggests:[/green] [bold]{command}[/bold]")
+        console.print(f"[yellow]Sending to {main_pid}[/yellow]")
+        
+        self.send_to_pane(main_pid, command)
+        
+        # Update context
+        self.context_manager.record_command(command)
+        
+        return command
+        
     def run(self):
         """Main monitoring loop"""
+        if self.engine == "control":
+            return self.run_control_mode()
+            
         panes = self.list_panes()
         if not panes:
             console.print("[red]No panes found in session![/red]")
             return
             
         idle_start = {pid: None for pid in panes}
+        last_reset = 0.0
         threshold = random.randint(*IDLE_THRESHOLD_RANGE)
+        pending: Optional[PendingSuggestion] = None
         
         console.print(f"[green]Monitoring {len(panes)} panes[/green]")
         console.print(f"[yellow]Idle threshold: {threshold} seconds[/yellow]")
@@ -489,13 +529,25 @@ class SageSession:
             while True:
                 all_idle = True
                 panes_status = {}
+                if self.idle_mode == "activity":
+                    # One list-panes call; captures only when a pane goes quiet
+                    idle_since = self.activity.check(panes)
+                else:
+                    self.refresh_snapshot(panes)
                 
                 for pid in panes:
-                    is_idle = self.is_idle(pid)
+                    if self.idle_mode == "activity":
+                        is_idle = idle_since[pid] is not None
+                    else:
+                        is_idle = self.is_idle(pid)
                     
                     if is_idle:
                         if idle_start[pid] is None:
-                            idle_start[pid] = datetime.now()
+                            idle_start[pid] = (
+                                datetime.fromtimestamp(max(idle_since[pid], last_reset))
+                                if self.idle_mode == "activity"
+                                else datetime.now()
+                            )
                         idle_seconds = (datetime.now() - idle_start[pid]).total_seconds()
                     else:
                         idle_start[pid] = None
@@ -506,57 +558,139 @@ class SageSession:
                         'is_idle': is_idle,
                         'idle_seconds': idle_seconds
                     }
+                    if self.idle_mode == "activity":
+                        panes_status[pid]['last_line'] = self.activity.last_line(pid)
                 
                 # Display status
-                self.display_status(panes_status)
+                self.display_status(panes_status, pending)
                 
-                # Check if all panes have been idle long enough
-                if all_idle and all(
-                    panes_status[pid]['idle_seconds'] > threshold 
+                if pending is not None:
+                    if not all_idle:
+                        # Don't type a stale command into a pane that's busy again
+                        self.cancel_suggestion(pending)
+                        pending = None
+                    elif pending.future.done() and all(
+                        panes_status[pid]['idle_seconds'] > threshold
+                        for pid in panes
+                    ):
+                        self.finish_suggestion(pending)
+                        pending = None
+                        
+                        # Reset idle times and generate new threshold
+                        idle_start = {pid: None for pid in panes}
+                        last_reset = time.time()
+                        threshold = random.randint(*IDLE_THRESHOLD_RANGE)
+                        console.print(f"\n[yellow]New idle threshold: {threshold} seconds[/yellow]")
+                        
+                # Check if all panes have been idle long enough (or, speculatively, part of it)
+                elif all_idle and all(
+                    panes_status[pid]['idle_seconds'] > threshold * self.query_at
                     for pid in panes
                 ):
-                    console.print("\n[bold magenta]All panes idle! Consulting AI... 🧠[/bold magenta]")
-                    
-                    # Gather summaries
-                    summaries = "\n\n".join(self.get_summary(pid) for pid in panes)
-                    prompt = f"Analyze these idle tmux panes and suggest ONE useful command:\n\n{summaries}"
+                    if self.idle_mode == "activity":
+                        self.refresh_snapshot(panes)
+                    pending = self.start_suggestion(panes)
                     
-                    # Get AI suggestion
-                    with Progress(
-                        SpinnerColumn(),
-                        TextColumn("[progress.description]{task.description}"),
-                        transient=True,
-                    ) as progress:
-                        progress.add_task(description="Thinking...", total=None)
-                        command = self.query_ai(prompt)
-                    
-                    # Extract command from response
-                    command_match = re.search(r'`([^`]+)`|^(\S+.*)$', command, re.MULTILINE)
-                    if command_match:
-                        command = command_match.group(1) or command_match.group(2)
-                    
-                    # Send to main pane
-                    main_pid = panes[0]
-                    console.print(f"\n[green]AI suggests:[/green] [bold]{command}[/bold]")
-                    console.print(f"[yellow]Sending to {main_pid}[/yellow]")
-                    
-                    self.send_to_pane(main_pid, command)
-                    
-                    # Update context
-                    context = self.context_manager.load_context() or {"recent_commands": []}
-                    context["recent_commands"] = context.get("recent_commands", [])[-9:] + [command]
-                    self.context_manager.save_context(context)
-                    
-                    # Reset idle times and generate new threshold
-                    idle_start = {pid: None for pid in panes}
-                    threshold = random.randint(*IDLE_THRESHOLD_RANGE)
-                    console.print(f"\n[yellow]New idle threshold: {threshold} seconds[/yellow]")
+                if pending is not None and not pending.future.done():
+                    # Wake up early when the answer arrives
+                    wait_futures([pending.future], timeout=CHECK_INTERVAL)
+                else:
+                    time.sleep(CHECK_INTERVAL)
+                
+        except KeyboardInterrupt:
+            console.print("\n[red]Sage session terminated by user[/red]")
+            self.logger.info("Session terminated by user")
+        finally:
+            self.ai_pool.shutdown(wait=False)
+            ROUTER.log_summary()
+            
+    def run_control_mode(self):
+        """Event-driven monitoring loop fed by tmux control mode"""
+        panes = self.list_panes()
+        if not panes:
+            console.print("[red]No panes found in session![/red]")
+            return
+            
+        monitor = ControlModeMonitor(self.session)
+        monitor.start(self.refresh_snapshot(panes))
+        threshold = random.randint(*IDLE_THRESHOLD_RANGE)
+        pending: Optional[PendingSuggestion] = None
+        
+        console.print(f"[green]Following {len(panes)} panes via tmux control mode[/green]")
+        console.print(f"[yellow]Idle threshold: {threshold} seconds[/yellow]")
+        
+        try:
+            while monitor.alive:
+                panes_status = monitor.status()
+                self.display_status(panes_status, pending)
+                all_idle = bool(panes_status) and all(s['is_idle'] for s in panes_status.values())
+                
+                quietest = min((s['idle_seconds'] for s in panes_status.values()), default=0.0)
+                if pending is not None:
+                    if not all_idle:
+                        self.cancel_suggestion(pending)
+                        pending = None
+                    elif pending.future.done() and quietest > threshold:
+                        self.finish_suggestion(pending)
+                        pending = None
+                        monitor.reset_idle()
+                        
+                        threshold = random.randint(*IDLE_THRESHOLD_RANGE)
+                        console.print(f"\n[yellow]New idle threshold: {threshold} seconds[/yellow]")
+                        continue
+                    # A speculative answer that arrived early waits for the threshold
+                    monitor.wait(threshold - quietest + 0.05 if pending.future.done() else None)
+                    continue
+                
+                # Sleep until output arrives or the quietest pane crosses the (query) threshold
+                timeout = None
+                if all_idle:
+                    remaining = threshold * self.query_at - quietest
+                    if remaining < 0:
+                        panes = monitor.pane_ids()
+                        self.refresh_snapshot(panes)
+                        pending = self.start_suggestion(panes)
+                        pending.future.add_done_callback(lambda _: monitor.poke())
+                        continue
+                    timeout = remaining + 0.05
                     
-                time.sleep(CHECK_INTERVAL)
+                monitor.wait(timeout)
+                
+            console.print("[red]tmux control connection closed[/red]")
                 
         except KeyboardInterrupt:
             console.print("\n[red]Sage session terminated by user[/red]")
             self.logger.info("Session terminated by user")
+        finally:
+            monitor.stop()
+            self.ai_pool.shutdown(wait=False)
+            ROUTER.log_summary()
+
+def train_dictionary(manager: PersonaManager, context_manager: ContextManager):
+    """Train the shared Markqant dictionary on every persona and this project's context, then rewrite them"""
+    files = [manager.personas_dir / f"{name}.mq" for name in manager.list_personas()]
+    context_file = context_manager.context_dir / "context.m8"
+    if context_file.exists():
+        files.append(context_file)
+    if not files:
+        console.print("[yellow]Nothing to train on yet[/yellow]")
+        return
+
+    documents = {path: manager.markqant.read_mq_file(path).personality for path in files}
+    before = {path: path.stat().st_size for path in files}
+    dictionary = train_shared_dictionary(SHARED_DICTIONARY, list(documents.values()))
+    saved_to = manager.markqant.dictionaries.save(dictionary)
+
+    table = Table(title=f"Shared dictionary {saved_to.name} 📚")
+    table.add_column("File", style="cyan")
+    table.add_column("Original", justify="right")
+    table.add_column("Before", style="yellow", justify="right")
+    table.add_column("After", style="green", justify="right")
+    for result in manager.markqant.write_mq_files(documents):
+        table.add_row(result.target.name, str(result.original_size), str(before[result.target]),
+                      str(result.stored_size))
+    console.print(table)
+    console.print(f"{len(dictionary.tokens)} shared tokens, {len(dictionary.zdict)} byte zlib preset")
 
 def create_default_personas():
     """Create default personas if they don't exist"""
@@ -682,6 +816,50 @@ Environment Variables:
         help="Create a new persona"
     )
     
+    parser.add_argument(
+        "--train-dictionary",
+        action="store_true",
+        help="Train the shared Markqant dictionary on all personas and this project's context"
+    )
+    
+    parser.add_argument(
+        "--engine", "-e",
+        choices=["poll", "control"],
+        default="poll",
+        help="poll: capture panes every second; control: follow tmux control-mode events"
+    )
+    
+    parser.add_argument(
+        "--idle-mode",
+        choices=["content", "activity"],
+        default="content",
+        help="content: match prompts in captured text; activity: use tmux activity timestamps"
+    )
+    
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always ask the model, even for idle states seen before"
+    )
+    
+    parser.add_argument(
+        "--similarity",
+        type=int,
+        default=SIMILARITY_MAX_DISTANCE,
+        metavar="BITS",
+        help=f"Reuse past answers for states within this SimHash distance (default: {SIMILARITY_MAX_DISTANCE}, 0 disables)"
+    )
+    
+    parser.add_argument(
+        "--speculate",
+        type=float,
+        nargs="?",
+        const=0.0,
+        metavar="FRACTION",
+        help="Start the AI query early, at this fraction of the idle threshold (no value: as soon as "
+             "all panes are idle); the suggestion is still sent at the threshold"
+    )
+    
     args = parser.parse_args()
     
     # Create default personas if needed
@@ -696,6 +874,10 @@ Environment Variables:
             console.print(f"  • {persona}")
         return
     
+    if args.train_dictionary:
+        train_dictionary(manager, ContextManager())
+        return
+    
     if args.create:
         console.print("[bold]Create New Persona[/bold]")
         name = console.input("Persona name: ")
@@ -717,7 +899,11 @@ Environment Variables:
     
     # Start monitoring session
     try:
-        session = SageSession(args.session, args.persona)
+        session = SageSession(
+            args.session, args.persona,
+            engine=args.engine, idle_mode=args.idle_mode, use_cache=not args.no_cache,
+            max_distance=args.similarity, speculate=args.speculate
+        )
         session.run()
     except ValueError as e:
         console.print(f"[red]Error: {e}[/red]")
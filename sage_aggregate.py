@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Markqant aggregates for Sage - many documents in one indexed .mq archive
+
+Layout (all integers little-endian):
+
+    header      magic "MQA1", version, flags, member count, index offset, index size
+    dictionary  length-prefixed, zlib-compressed SharedDictionary (unified tokens + zlib preset)
+    members     each tokenized with the unified tokens and compressed on its own
+    index       per member: path, offset, length, original size, CRC-32, flags
+
+The index sits at the end so members can be written as they are compressed;
+readers map the file, read the header and index, and decompress only the
+members they are asked for.
+"""
+
+import argparse
+import fnmatch
+import mmap
+import re
+import struct
+import sys
+import time
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from rich.console import Console
+from rich.markup import escape
+from rich.table import Table
+
+from sage_markqant import (
+    AUTO_CODEC, AUTO_CODECS, CODECS, DEFAULT_TARGET, ESCAPE_TOKEN, MARKQANT_TOKENS, SharedDictionary,
+    expand_tokens, pack_payload, tokenize, train_shared_dictionary, unpack_payload,
+)
+
+console = Console()
+
+ARCHIVE_MAGIC = b"MQA1"
+ARCHIVE_VERSION = 1
+#   magic, version, flags, member count, index offset, index size
+ARCHIVE_HEADER = struct.Struct("<4sBBIQQ")
+#   dictionary size (followed by zlib-compressed SharedDictionary.to_bytes())
+DICTIONARY_SIZE = struct.Struct("<I")
+#   path length, offset, compressed length, original size, CRC-32 of the original, flags
+INDEX_ENTRY = struct.Struct("<HQQQIB")
+
+DEFAULT_PATTERN = "*.md"
+
+
+@dataclass
+class ArchiveMember:
+    """One document in an aggregate"""
+    path: str
+    offset: int
+    length: int
+    original_size: int
+    crc: int
+    flags: int
+
+
+def find_documents(root: Path, pattern: str = DEFAULT_PATTERN, exclude: Optional[List[str]] = None) -> List[Path]:
+    """Files under root matching pattern, minus excluded globs, in a stable order"""
+    files = []
+    for path in sorted(root.rglob(pattern)):
+        relative = path.relative_to(root).as_posix()
+        if path.is_file() and not any(fnmatch.fnmatch(relative, glob) for glob in exclude or []):
+            files.append(path)
+    return files
+
+
+def _read_document(path: Path) -> str:
+    # Bytes, not read_text: line endings must survive, and nothing is replaced
+    try:
+        return path.read_bytes().decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise ValueError(f"{path} is not UTF-8 text: {e}") from e
+
+
+def member_path(directory: Path, name: str) -> Path:
+    """Where a member is extracted under directory; names that would land outside it are rejected"""
+    relative = Path(name)
+    target = directory / relative
+    if relative.is_absolute() or ".." in relative.parts:
+        raise ValueError(f"Refusing to extract {name!r} outside {directory}")
+    try:
+        target.resolve().relative_to(directory.resolve())  # e.g. through a symlinked subdirectory
+    except ValueError:
+        raise ValueError(f"Refusing to extract {name!r} outside {directory}") from None
+    return target
+
+
+def create_aggregate(output: Path, root: Path, files: List[Path], codec: str = AUTO_CODEC,
+                     target: str = DEFAULT_TARGET) -> List[ArchiveMember]:
+    """Write an aggregate of files (paths stored relative to root), each member packed with codec"""
+    documents = {path.relative_to(root).as_posix(): _read_document(path) for path in files}
+    dictionary = train_shared_dictionary("aggregate", list(documents.values()))
+    # The preset is mostly document text itself, so it compresses well too
+    packed_dictionary = zlib.compress(dictionary.to_bytes(), 9)
+
+    members = []
+    with open(output, 'wb') as f:
+        f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, 0, 0, 0))  # patched below
+        f.write(DICTIONARY_SIZE.pack(len(packed_dictionary)))
+        f.write(packed_dictionary)
+        for path, content in documents.items():
+            payload, flags = pack_payload(tokenize(content, dictionary.tokens), dictionary.zdict, codec, target)
+            original = content.encode('utf-8')
+            members.append(ArchiveMember(path, f.tell(), len(payload), len(original), zlib.crc32(original), flags))
+            f.write(payload)
+
+        index_offset = f.tell()
+        for member in members:
+            encoded = member.path.encode('utf-8')
+            f.write(INDEX_ENTRY.pack(len(encoded), member.offset, member.length,
+                                     member.original_size, member.crc, member.flags))
+            f.write(encoded)
+        index_size = f.tell() - index_offset
+        f.seek(0)
+        f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, len(members), index_offset, index_size))
+    return members
+
+
+class MarkqantAggregate:
+    """Random-access reader for an aggregate; members are decompressed on demand"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"{path} is empty, not a Markqant aggregate")
+        magic, version, _, count, index_offset, index_size = ARCHIVE_HEADER.unpack_from(self._map)
+        if magic != ARCHIVE_MAGIC or version > ARCHIVE_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a Markqant aggregate")
+
+        (dictionary_size,) = DICTIONARY_SIZE.unpack_from(self._map, ARCHIVE_HEADER.size)
+        start = ARCHIVE_HEADER.size + DICTIONARY_SIZE.size
+        self.dictionary = SharedDictionary.from_bytes(
+            "aggregate", zlib.decompress(self._map[start:start + dictionary_size])
+        )
+        self._tokens = {**MARKQANT_TOKENS, **self.dictionary.tokens, ESCAPE_TOKEN: "T"}
+
+        self.members: Dict[str, ArchiveMember] = {}
+        offset = index_offset
+        for _ in range(count):
+            length, *fields = INDEX_ENTRY.unpack_from(self._map, offset)
+            offset += INDEX_ENTRY.size
+            name = self._map[offset:offset + length].decode('utf-8')
+            offset += length
+            self.members[name] = ArchiveMember(name, *fields)
+        if offset != index_offset + index_size:
+            self.close()
+            raise ValueError(f"{path} has a corrupt index")
+
+    def __enter__(self) -> "MarkqantAggregate":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if not self._map.closed:
+            self._map.close()
+        self._file.close()
+
+    def read(self, name: str) -> str:
+        """Decompress one member, checking it against its stored CRC"""
+        member = self.members.get(name)
+        if member is None:
+            raise KeyError(f"{name} is not in {self.path}")
+        payload = unpack_payload(self._map[member.offset:member.offset + member.length],
+                                 member.flags, self.dictionary.zdict)
+        content = expand_tokens(payload.decode('utf-8'), self._tokens)
+        if zlib.crc32(content.encode('utf-8')) != member.crc:
+            raise ValueError(f"{name} in {self.path} failed its CRC check")
+        return content
+
+    def search(self, pattern: str, names: Optional[List[str]] = None,
+               ignore_case: bool = False) -> Iterator[Tuple[str, int, str]]:
+        """(member, line number, line) for every matching line, one member decompressed at a time
+
+        names are globs; only matching members are decompressed.
+        """
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        for name in self.members:
+            if names and not any(fnmatch.fnmatch(name, glob) for glob in names):
+                continue
+            for number, line in enumerate(self.read(name).splitlines(), 1):
+                if regex.search(line):
+                    yield name, number, line
+
+
+def main():
+    """Markqant aggregate command line"""
+    parser = argparse.ArgumentParser(description="Markqant aggregates: many documents, one indexed .mq")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    create = sub.add_parser("create", help="Aggregate every matching file under a directory")
+    create.add_argument("root", type=Path, help="Directory to aggregate")
+    create.add_argument("output", type=Path, help="Aggregate to write")
+    create.add_argument("--pattern", default=DEFAULT_PATTERN, help=f"File glob (default: {DEFAULT_PATTERN})")
+    create.add_argument("--exclude", action="append", default=[], help="Relative path glob to skip (repeatable)")
+    create.add_argument("--codec", default=AUTO_CODEC, choices=[AUTO_CODEC, *CODECS],
+                        help="Codec for each member (default: auto)")
+    create.add_argument("--target", default=DEFAULT_TARGET, choices=list(AUTO_CODECS),
+                        help="What the auto codec favours (default: balanced)")
+
+    listing = sub.add_parser("list", help="List members")
+    listing.add_argument("archive", type=Path)
+
+    extract = sub.add_parser("extract", help="Extract members")
+    extract.add_argument("archive", type=Path)
+    extract.add_argument("--file", action="append", default=[], help="Member to print (repeatable)")
+    extract.add_argument("--output-dir", type=Path, help="Write every member (or the --file ones) here")
+
+    search = sub.add_parser("search", help="Search member lines with a regular expression")
+    search.add_argument("archive", type=Path)
+    search.add_argument("pattern")
+    search.add_argument("--file", action="append", default=[], help="Only search members matching this glob")
+    search.add_argument("-i", "--ignore-case", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "create":
+        files = find_documents(args.root, args.pattern, args.exclude)
+        start = time.perf_counter()
+        members = create_aggregate(args.output, args.root, files, args.codec, args.target)
+        elapsed = time.perf_counter() - start
+        original = sum(m.original_size for m in members)
+        size = args.output.stat().st_size
+        console.print(f"📦 {args.output}: {len(members)} files, {original / 1024:.0f} KB -> {size / 1024:.0f} KB "
+                      f"({size / original if original else 0:.1%}) in {elapsed * 1000:.0f} ms")
+        return
+
+    with MarkqantAggregate(args.archive) as aggregate:
+        if args.command == "list":
+            table = Table(title=f"📦 {args.archive}")
+            table.add_column("Member", style="cyan")
+            table.add_column("Original", justify="right")
+            table.add_column("Stored", style="green", justify="right")
+            for member in aggregate.members.values():
+                table.add_row(member.path, str(member.original_size), str(member.length))
+            console.print(table)
+        elif args.command == "extract":
+            names = args.file or list(aggregate.members)
+            for name in names:
+                content = aggregate.read(name)
+                if args.output_dir is None:
+                    sys.stdout.buffer.write(content.encode('utf-8'))
+                    continue
+                target = member_path(args.output_dir, name)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.write_bytes(content.encode('utf-8'))
+            if args.output_dir is not None:
+                console.print(f"[green]Extracted {len(names)} files to {args.output_dir}[/green]")
+        elif args.command == "search":
+            for name, number, line in aggregate.search(args.pattern, args.file, args.ignore_case):
+                console.print(f"[cyan]{escape(name)}[/cyan]:{number}: {escape(line)}", highlight=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Model requests for Sage - provider request formats, streaming and command extraction
+"""
+
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as wait_futures
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from sage_http import HTTP_POOL, PoolSettings
+from sage_routing import ROUTER, Endpoint
+
+if TYPE_CHECKING:
+    from sage import PersonaConfig
+
+logger = logging.getLogger(__name__)
+
+ANTHROPIC_VERSION = "2023-06-01"
+
+# Single-line backticked spans and list numbering/bullets, for multi-candidate answers
+INLINE_CODE = re.compile(r'`([^`\n]+)`')
+LIST_MARKER = re.compile(r'^\s*(?:\d+[.)]|[-*•])\s+')
+
+# Prompt-cache breakpoint for providers that take explicit hints
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# First backticked span, or else the first line that starts with a non-space
+COMMAND_PATTERN = re.compile(r'`([^`]+)`|^(\S+.*)$', re.MULTILINE)
+
+
+def is_anthropic(endpoint: str) -> bool:
+    """Whether an endpoint speaks the Anthropic Messages API"""
+    return "anthropic.com" in endpoint
+
+
+def _cached_text(text: str) -> List[Dict[str, Any]]:
+    """A content block list marking the text as a cacheable prompt prefix"""
+    return [{"type": "text", "text": text, "cache_control": CACHE_CONTROL}]
+
+
+def build_request(config: "PersonaConfig", messages: List[Dict[str, str]],
+                  stream: bool = False) -> Tuple[Dict[str, str], Dict[str, Any]]:
+    """Build headers and JSON body for the persona's endpoint
+
+    With prompt_cache on, the static system prompt is marked as a cache
+    breakpoint for Anthropic, and for OpenRouter, which passes the hint on to
+    providers that support it. OpenAI caches matching prefixes on its own.
+    """
+    system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+    mark_cache = config.prompt_cache and bool(system)
+    if is_anthropic(config.api_endpoint):
+        headers = {
+            "x-api-key": config.api_key,
+            "anthropic-version": ANTHROPIC_VERSION,
+            "Content-Type": "application/json"
+        }
+        data = {
+            "model": config.model,
+            "system": _cached_text(system) if mark_cache else system,
+            "messages": [m for m in messages if m["role"] != "system"],
+            "temperature": config.temperature,
+            "max_tokens": config.max_tokens
+        }
+    else:
+        headers = {
+            "Authorization": f"Bearer {config.api_key}",
+            "Content-Type": "application/json"
+        }
+
+        if "openrouter" in config.api_endpoint:
+            headers["HTTP-Referer"] = "https://github.com/sage-ai/sage"
+            headers["X-Title"] = "Sage AI Assistant"
+            if mark_cache:
+                messages = [
+                    {"role": "system", "content": _cached_text(m["content"])} if m["role"] == "system" else m
+                    for m in messages
+                ]
+
+        data = {
+            "model": config.model,
+            "messages": messages,
+            "temperature": config.temperature,
+            "max_tokens": config.max_tokens
+        }
+
+    if stream:
+        data["stream"] = True
+        if "openrouter" in config.api_endpoint or "api.openai.com" in config.api_endpoint:
+            # Usage (with cached tokens) arrives in a final chunk
+            data["stream_options"] = {"include_usage": True}
+    return headers, data
+
+
+def log_usage(config: "PersonaConfig", usage: Optional[Dict[str, Any]]):
+    """Log how much of the prompt the provider served from its prefix cache"""
+    if not usage:
+        return
+    if "cache_read_input_tokens" in usage or "cache_creation_input_tokens" in usage:
+        # Anthropic: input_tokens excludes the cached and newly cached parts
+        cached = usage.get("cache_read_input_tokens") or 0
+        written = usage.get("cache_creation_input_tokens") or 0
+        total = (usage.get("input_tokens") or 0) + cached + written
+    else:
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        written = 0
+        total = usage.get("prompt_tokens") or 0
+    if not total:
+        return
+    logger.info(
+        f"Prompt cache {config.model}: {cached}/{total} input tokens cached"
+        + (f", {written} written" if written else "")
+    )
+
+
+def parse_completion(result: Dict[str, Any]) -> str:
+    """Get the assistant text out of a chat completion response"""
+    if isinstance(result.get("content"), list):
+        # Anthropic Messages API
+        return "".join(block.get("text", "") for block in result["content"])
+    return result['choices'][0]['message']['content']
+
+
+def parse_stream_event(payload: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Text and usage (if any) carried by one SSE data payload (OpenAI-compatible or Anthropic)"""
+    event = json.loads(payload)
+    if event.get("type") == "message_start":
+        return "", event.get("message", {}).get("usage")
+    if event.get("type") == "content_block_delta":
+        return event.get("delta", {}).get("text", ""), None
+    choices = event.get("choices") or []
+    text = ""
+    if choices:
+        text = (choices[0].get("delta") or {}).get("content") or ""
+    return text, event.get("usage")
+
+
+def extract_command(response: str) -> str:
+    """Pull the command out of an AI response (first backticked span or first line)"""
+    command_match = COMMAND_PATTERN.search(response)
+    if command_match:
+        return command_match.group(1) or command_match.group(2)
+    return response
+
+
+def extract_commands(response: str, limit: int) -> List[str]:
+    """Ranked commands from a response asked for several candidates"""
+    if limit <= 1:
+        return [extract_command(response)]
+    commands = INLINE_CODE.findall(response)
+    if not commands:
+        commands = [
+            LIST_MARKER.sub("", line).strip() for line in response.splitlines()
+            if line.strip() and not line.lstrip().startswith("```")
+        ]
+    return list(dict.fromkeys(c.strip() for c in commands if c.strip()))[:limit]
+
+
+class CommandExtractor:
+    """Finds the command in a response while it is still streaming in
+
+    A match only counts once it can't change with more text: a closed
+    backtick span, or a first line that has seen its newline.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.command: Optional[str] = None
+
+    def feed(self, delta: str) -> Optional[str]:
+        """Add streamed text, returning the command as soon as it's settled"""
+        self.text += delta
+        match = COMMAND_PATTERN.search(self.text)
+        if match is None:
+            return None
+        if match.group(2) is not None and match.end() == len(self.text):
+            return None  # line may still grow
+        if "`" in self.text[:match.start()]:
+            return None  # an earlier backtick could still close into a span
+        self.command = match.group(1) or match.group(2)
+        return self.command
+
+
+def _log_stream(config: "PersonaConfig", extractor: CommandExtractor, started: float, early: bool):
+    logger.info(
+        f"Streamed {len(extractor.text)} chars from {config.model} in "
+        f"{(time.perf_counter() - started) * 1000:.0f}ms"
+        + (" (closed early after command)" if early else "")
+    )
+
+
+def request_completion(config: "PersonaConfig", messages: List[Dict[str, str]],
+                       settings: PoolSettings, cancelled: Optional[threading.Event] = None) -> str:
+    """Send a suggestion request and return the assistant text
+
+    Setting `cancelled` abandons a streamed response at the next event; a
+    non-streamed request can't be interrupted and simply runs to completion.
+    """
+    if not config.stream:
+        headers, data = build_request(config, messages)
+        response = HTTP_POOL.post(config.api_endpoint, settings, headers=headers, json=data)
+        response.raise_for_status()
+        result = response.json()
+        log_usage(config, result.get("usage"))
+        return parse_completion(result)
+
+    headers, data = build_request(config, messages, stream=True)
+    extractor = CommandExtractor()
+    started = time.perf_counter()
+    events = HTTP_POOL.stream_events(config.api_endpoint, settings, headers=headers, json=data)
+    try:
+        for payload in events:
+            if cancelled is not None and cancelled.is_set():
+                raise HedgeCancelled(config.api_endpoint)
+            text, usage = parse_stream_event(payload)
+            log_usage(config, usage)
+            if extractor.feed(text) is not None and config.candidates <= 1:
+                _log_stream(config, extractor, started, early=True)
+                return extractor.text
+    finally:
+        events.close()
+    _log_stream(config, extractor, started, early=False)
+    return extractor.text
+
+
+async def arequest_completion(config: "PersonaConfig", messages: List[Dict[str, str]],
+                              settings: PoolSettings) -> str:
+    """Asyncio flavour of request_completion()"""
+    if not config.stream:
+        headers, data = build_request(config, messages)
+        response = await HTTP_POOL.apost(config.api_endpoint, settings, headers=headers, json=data)
+        response.raise_for_status()
+        result = response.json()
+        log_usage(config, result.get("usage"))
+        return parse_completion(result)
+
+    headers, data = build_request(config, messages, stream=True)
+    extractor = CommandExtractor()
+    started = time.perf_counter()
+    events = HTTP_POOL.astream_events(config.api_endpoint, settings, headers=headers, json=data)
+    try:
+        async for payload in events:
+            text, usage = parse_stream_event(payload)
+            log_usage(config, usage)
+            if extractor.feed(text) is not None and config.candidates <= 1:
+                _log_stream(config, extractor, started, early=True)
+                return extractor.text
+    finally:
+        await events.aclose()
+    _log_stream(config, extractor, started, early=False)
+    return extractor.text
+
+
+class HedgeCancelled(Exception):
+    """A hedged request that lost the race, or whose caller gave up on it"""
+
+
+class _EitherSet:
+    """Looks set once either of two events is (the race is decided, or the caller cancelled)"""
+
+    def __init__(self, first: threading.Event, second: threading.Event):
+        self.first = first
+        self.second = second
+
+    def is_set(self) -> bool:
+        return self.first.is_set() or self.second.is_set()
+
+
+# Threads for the extra requests of a synchronous hedged call
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sage-hedge")
+
+
+def _attempt(endpoint: Endpoint, config: "PersonaConfig", messages: List[Dict[str, str]],
+             settings: PoolSettings, cancelled: threading.Event) -> Tuple[str, float]:
+    ROUTER.started(endpoint)
+    started = time.perf_counter()
+    try:
+        text = request_completion(endpoint.apply(config), messages, settings, cancelled)
+    except HedgeCancelled:
+        raise
+    except Exception:
+        ROUTER.failed(endpoint)
+        raise
+    # Losers that finish anyway still count as latency samples
+    latency = time.perf_counter() - started
+    ROUTER.succeeded(endpoint, latency)
+    return text, latency
+
+
+def _log_winner(endpoint: Endpoint, latency: float, attempts: int):
+    ROUTER.won(endpoint)
+    if attempts > 1:
+        logger.info(f"Hedged request won by {endpoint.key} in {latency * 1000:.0f}ms ({attempts} endpoints tried)")
+
+
+def complete(config: "PersonaConfig", messages: List[Dict[str, str]], settings: PoolSettings,
+             cancelled: Optional[threading.Event] = None) -> str:
+    """Send a suggestion request, hedging across the persona's endpoints
+
+    The best endpoint goes first. If it hasn't answered within its p95
+    latency (or fails), the next one is started alongside it; the first
+    answer wins and the rest are cancelled. Setting `cancelled` abandons
+    every attempt and raises HedgeCancelled.
+    """
+    endpoints = ROUTER.route(config)
+    decided = threading.Event()
+    stop = _EitherSet(decided, cancelled) if cancelled is not None else decided
+    running: Dict[Future, Endpoint] = {}
+    errors: List[Exception] = []
+    launched = 0
+
+    def launch():
+        nonlocal launched
+        endpoint = endpoints[launched]
+        launched += 1
+        running[_HEDGE_POOL.submit(_attempt, endpoint, config, messages, settings, stop)] = endpoint
+
+    launch()
+    try:
+        while running:
+            timeout = ROUTER.hedge_delay(endpoints[launched - 1]) if launched < len(endpoints) else None
+            done, _ = wait_futures(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            if cancelled is not None and cancelled.is_set():
+                raise HedgeCancelled(config.api_endpoint)
+            for future in done:
+                endpoint = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    text, latency = future.result()
+                    _log_winner(endpoint, latency, launched)
+                    return text
+                logger.warning(f"Endpoint {endpoint.key} failed: {error}")
+                errors.append(error)
+            if launched < len(endpoints):
+                launch()  # hedge on a slow endpoint, fall back on a failed one
+        raise errors[-1]
+    finally:
+        decided.set()
+        for future in running:
+            future.cancel()
+
+
+async def _aattempt(endpoint: Endpoint, config: "PersonaConfig", messages: List[Dict[str, str]],
+                    settings: PoolSettings) -> Tuple[str, float]:
+    ROUTER.started(endpoint)
+    started = time.perf_counter()
+    try:
+        text = await arequest_completion(endpoint.apply(config), messages, settings)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        ROUTER.failed(endpoint)
+        raise
+    latency = time.perf_counter() - started
+    ROUTER.succeeded(endpoint, latency)
+    return text, latency
+
+
+async def acomplete(config: "PersonaConfig", messages: List[Dict[str, str]], settings: PoolSettings) -> str:
+    """Asyncio flavour of complete(); losing requests are cancelled outright"""
+    endpoints = ROUTER.route(config)
+    running: Dict[asyncio.Task, Endpoint] = {}
+    errors: List[Exception] = []
+    launched = 0
+
+    def launch():
+        nonlocal launched
+        endpoint = endpoints[launched]
+        launched += 1
+        running[asyncio.ensure_future(_aattempt(endpoint, config, messages, settings))] = endpoint
+
+    launch()
+    try:
+        while running:
+            timeout = ROUTER.hedge_delay(endpoints[launched - 1]) if launched < len(endpoints) else None
+            done, _ = await asyncio.wait(list(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                endpoint = running.pop(task)
+                error = task.exception()
+                if error is None:
+                    text, latency = task.result()
+                    _log_winner(endpoint, latency, launched)
+                    return text
+                logger.warning(f"Endpoint {endpoint.key} failed: {error}")
+                errors.append(error)
+            if launched < len(endpoints):
+                launch()
+        raise errors[-1]
+    finally:
+        for task in running:
+            task.cancel()
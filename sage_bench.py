@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+"""
+Sage benchmarks - measure what monitoring costs per tick and per session
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from rich.console import Console
+from rich.table import Table
+
+from sage import DICTIONARIES_DIR, PERSONAS_DIR, SageSession
+from sage_tmux import TmuxSnapshotter, ActivityTracker, PaneInfo
+from sage_daemon import WatchedSession
+from sage_http import ClientPool, PoolSettings, RequestTiming
+from sage_ai import extract_command
+from sage_predict import CommandPredictor
+from sage_aggregate import MarkqantAggregate, create_aggregate, find_documents
+from sage_markqant import (
+    AUTO_CODECS, BINARY_ENTRY, CODECS, DICTIONARY_BUILDERS, ESCAPE_TOKEN, MARKQANT_TOKENS, MAX_DYNAMIC_TOKENS,
+    SMALL_PAYLOAD, DictionaryStore, MarkqantProcessor, pack_payload, unpack_payload,
+)
+
+console = Console()
+
+
+class _CountingPopen(subprocess.Popen):
+    """Popen that counts how many processes were spawned"""
+    spawned = 0
+
+    def __init__(self, *args, **kwargs):
+        _CountingPopen.spawned += 1
+        super().__init__(*args, **kwargs)
+
+
+@contextmanager
+def count_subprocesses() -> Iterator[type]:
+    """Count every process spawned through the subprocess module"""
+    original = subprocess.Popen
+    _CountingPopen.spawned = 0
+    subprocess.Popen = _CountingPopen
+    try:
+        yield _CountingPopen
+    finally:
+        subprocess.Popen = original
+
+
+@contextmanager
+def scratch_session(pane_count: int) -> Iterator[str]:
+    """Create a throwaway tmux session with the requested number of panes"""
+    name = f"sage-bench-{os.getpid()}"
+    subprocess.check_call(["tmux", "new-session", "-d", "-s", name, "-x", "400", "-y", "200"])
+    try:
+        for _ in range(pane_count - 1):
+            subprocess.check_call(["tmux", "split-window", "-t", name])
+            subprocess.check_call(["tmux", "select-layout", "-t", name, "tiled"])
+        yield name
+    finally:
+        subprocess.call(["tmux", "kill-session", "-t", name])
+
+
+def bare_session(session_name: str) -> SageSession:
+    """A SageSession wired for tmux access only (no persona, no logging setup)"""
+    session = SageSession.__new__(SageSession)
+    session.session = session_name
+    session.logger = logging.getLogger("sage-bench")
+    session.snapshotter = TmuxSnapshotter()
+    session.snapshot = None
+    session.activity = ActivityTracker(session_name, snapshotter=session.snapshotter)
+    return session
+
+
+def measure(tick: Callable[[], None], ticks: int) -> tuple:
+    """Run a tick function repeatedly, returning (processes/tick, ms/tick)"""
+    with count_subprocesses() as counter:
+        start = time.perf_counter()
+        for _ in range(ticks):
+            tick()
+        elapsed = time.perf_counter() - start
+    return counter.spawned / ticks, elapsed / ticks * 1000
+
+
+def bench_tick(pane_counts: List[int], ticks: int):
+    """Compare per-pane capture, the batched snapshot and activity timestamps"""
+    table = Table(title="Monitoring cost per tick 🖥️")
+    table.add_column("Panes", style="cyan", justify="right")
+    table.add_column("Mode", style="green")
+    table.add_column("Procs/tick", style="yellow", justify="right")
+    table.add_column("ms/tick", style="yellow", justify="right")
+    table.add_column("Procs/AI tick", style="magenta", justify="right")
+
+    for pane_count in pane_counts:
+        with scratch_session(pane_count) as name:
+            session = bare_session(name)
+            panes = session.list_panes()
+
+            def legacy_tick():
+                session.snapshot = None
+                for pid in panes:
+                    session.is_idle(pid)
+
+            def legacy_ai_tick():
+                legacy_tick()
+                for pid in panes:
+                    session.get_summary(pid)
+
+            def batched_tick():
+                session.refresh_snapshot(panes)
+                for pid in panes:
+                    session.is_idle(pid)
+
+            def batched_ai_tick():
+                batched_tick()
+                for pid in panes:
+                    session.get_summary(pid)
+
+            def activity_tick():
+                session.activity.check(panes)
+
+            def activity_ai_tick():
+                activity_tick()
+                batched_ai_tick()
+
+            # Let the shells go quiet so activity mode reaches steady state
+            time.sleep(session.activity.stale_after + 1)
+            for mode, tick, ai_tick in (
+                ("per-pane", legacy_tick, legacy_ai_tick),
+                ("batched", batched_tick, batched_ai_tick),
+                ("activity", activity_tick, activity_ai_tick),
+            ):
+                procs, ms = measure(tick, ticks)
+                ai_procs, _ = measure(ai_tick, 1)
+                table.add_row(str(len(panes)), mode, f"{procs:.1f}", f"{ms:.1f}", f"{ai_procs:.0f}")
+
+    console.print(table)
+
+
+def bench_daemon(session_count: int, panes_per_session: int):
+    """Memory per watched session in the daemon vs. one sage.py process per session"""
+    now = time.time()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = []
+    for i in range(session_count):
+        panes = [f"%{i * panes_per_session + p}" for p in range(panes_per_session)]
+        state = WatchedSession(name=f"session-{i}", persona="helpful", threshold=15,
+                               tracker=ActivityTracker(f"session-{i}"))
+        info = {pid: PaneInfo(pane_id=pid, activity=now - 30, command="bash") for pid in panes}
+        state.panes = panes
+        for pid in state.tracker.observe(panes, info, now):
+            state.tracker.confirm(pid, "user@host:~/project$")
+        state.idle_start = dict(state.tracker.idle_since(panes, now))
+        sessions.append(state)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    per_session = sum(stat.size_diff for stat in after.compare_to(before, "filename")) / session_count
+
+    # Peak RSS of a process that has only imported Sage (kilobytes on Linux)
+    rss = subprocess.check_output([
+        sys.executable, "-c",
+        "import sage, resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)",
+    ], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+
+    table = Table(title="Per-session overhead 🧙")
+    table.add_column("Model", style="cyan")
+    table.add_column("Per session", style="yellow", justify="right")
+    table.add_row(f"daemon ({panes_per_session} panes/session)", f"{per_session / 1024:.1f} KB")
+    table.add_row("one sage.py process", f"{int(rss) / 1024:.1f} MB")
+    console.print(table)
+
+
+def bench_http(url: str, requests: int, http2: bool):
+    """Per-phase latency with a fresh client per request vs. the shared pool"""
+    settings = PoolSettings(http2=http2)
+
+    def fresh() -> RequestTiming:
+        pool = ClientPool()
+        try:
+            pool.request("GET", url, settings)
+            return pool.timings[-1]
+        finally:
+            pool.close()
+
+    shared = ClientPool()
+
+    def pooled() -> RequestTiming:
+        shared.request("GET", url, settings)
+        return shared.timings[-1]
+
+    def avg_ms(timings: List[RequestTiming], phase: str) -> str:
+        values = [getattr(t, phase) or 0.0 for t in timings]
+        return f"{sum(values) / len(values) * 1000:.1f}"
+
+    table = Table(title=f"HTTP phases for {url} 🌐")
+    table.add_column("Client", style="cyan")
+    for phase in ("connect", "tls", "first_byte", "total"):
+        table.add_column(f"{phase} ms", style="yellow", justify="right")
+
+    for label, run in (("fresh per request", fresh), ("shared pool", pooled)):
+        timings = [run() for _ in range(requests)]
+        table.add_row(label, *(avg_ms(timings, p) for p in ("connect", "tls", "first_byte", "total")))
+    shared.close()
+    console.print(table)
+
+
+def bench_predict(log_path: Path):
+    """Replay interactions.jsonl: predict each command locally before learning it"""
+    if not log_path.exists():
+        console.print(f"[red]No interaction log at {log_path}[/red]")
+        return
+
+    predictor = CommandPredictor()
+    top1 = top3 = total = 0
+    rank_seconds = 0.0
+    previous = None
+    with open(log_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                prompt, actual = entry["prompt"], extract_command(entry["response"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            if len(predictor):
+                start = time.perf_counter()
+                ranked = [command for command, _ in predictor.rank(prompt, previous, k=3)]
+                rank_seconds += time.perf_counter() - start
+                total += 1
+                top1 += bool(ranked) and ranked[0] == actual
+                top3 += actual in ranked
+            predictor.learn(prompt, actual)
+            previous = actual
+
+    table = Table(title=f"Local predictor vs. remote model choices ({log_path}) 🎯")
+    table.add_column("Examples", style="cyan", justify="right")
+    table.add_column("Distinct commands", justify="right")
+    table.add_column("Top-1 hit rate", style="green", justify="right")
+    table.add_column("Top-3 hit rate", style="green", justify="right")
+    table.add_column("µs/prediction", style="yellow", justify="right")
+    table.add_row(
+        str(len(predictor)), str(len(predictor.class_counts)),
+        f"{top1 / total:.1%}" if total else "-", f"{top3 / total:.1%}" if total else "-",
+        f"{rank_seconds / total * 1e6:.0f}" if total else "-",
+    )
+    console.print(table)
+
+
+def load_corpus(paths: List[Path], size_mb: float) -> str:
+    """Markdown files under the given paths, repeated up to roughly size_mb"""
+    files = []
+    for path in paths:
+        files += sorted(path.rglob("*.md")) if path.is_dir() else [path]
+    text = "\n\n".join(f.read_text(errors="replace") for f in files)
+    if not text:
+        return ""
+    target = int(size_mb * 1024 * 1024)
+    return text * max(1, target // len(text))
+
+
+def legacy_compress(content: str) -> Tuple[str, Dict[str, str]]:
+    """The original compressor: one str.replace pass per token, longest pattern first"""
+    words = re.findall(r'\b\w+\b', content)
+    word_freq: Dict[str, int] = {}
+    for word in words:
+        if len(word) > 5:
+            word_freq[word] = word_freq.get(word, 0) + 1
+    dynamic_tokens = {}
+    next_token_id = 0x10
+    for word, count in sorted(word_freq.items(), key=lambda x: x[1], reverse=True):
+        if count >= 3 and next_token_id <= 0xFF:
+            dynamic_tokens[f"T{next_token_id:02X}"] = word
+            next_token_id += 1
+    reverse_tokens = {v: k for k, v in {**MARKQANT_TOKENS, **dynamic_tokens}.items()}
+    compressed = content
+    for pattern, token in sorted(reverse_tokens.items(), key=lambda x: len(x[0]), reverse=True):
+        compressed = compressed.replace(pattern, token)
+    return compressed, dynamic_tokens
+
+
+def legacy_decompress(compressed: str, dynamic_tokens: Dict[str, str]) -> str:
+    """The original decoder: one str.replace pass per token"""
+    all_tokens = {**MARKQANT_TOKENS, **dynamic_tokens}
+    for token in sorted(all_tokens.keys(), key=len, reverse=True):
+        compressed = compressed.replace(token, all_tokens[token])
+    return compressed
+
+
+def timed(run: Callable[[], object], rounds: int) -> Tuple[object, float]:
+    """Last result of a function and its average seconds per call"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = run()
+    return result, (time.perf_counter() - start) / rounds
+
+
+def bench_markqant(paths: List[Path], size_mb: float, rounds: int):
+    """Markqant throughput: per-token replace passes vs. one scan, both ways
+
+    Both compressors use the frequent-words dictionary the replace loop was
+    written with, so the rows differ only in how text is tokenized;
+    bench_dictionary() compares the dictionaries themselves.
+    """
+    corpus = load_corpus(paths, size_mb)
+    if not corpus:
+        console.print(f"[red]No markdown found under {', '.join(map(str, paths))}[/red]")
+        return
+    megabytes = len(corpus.encode()) / (1024 * 1024)
+
+    table = Table(title=f"Markqant compression on {megabytes:.1f} MB of markdown, frequency dictionary 🗜️")
+    table.add_column("Compressor", style="cyan")
+    table.add_column("Tokens", justify="right")
+    table.add_column("Ratio", style="green", justify="right")
+    table.add_column("Encode MB/s", style="yellow", justify="right")
+    table.add_column("Decode MB/s", style="yellow", justify="right")
+    table.add_column("Round trip", justify="center")
+
+    processor = MarkqantProcessor(dictionary="frequency")
+    codecs = (
+        ("replace per token", legacy_compress, legacy_decompress),
+        ("single scan", processor.compress, processor.decompress),
+    )
+    for label, compress, decompress in codecs:
+        (compressed, dynamic_tokens), encode = timed(lambda: compress(corpus), rounds)
+        restored, decode = timed(lambda: decompress(compressed, dynamic_tokens), rounds)
+        table.add_row(
+            label, str(len(MARKQANT_TOKENS) + len(dynamic_tokens)),
+            f"{len(compressed) / len(corpus):.1%}", f"{megabytes / encode:.1f}",
+            f"{megabytes / decode:.1f}", "✅" if restored == corpus else "❌",
+        )
+    console.print(table)
+
+    # Decode cost as the dynamic dictionary grows, on a fixed 1 MB sample
+    sample = corpus[:1024 * 1024]
+    compressed, dynamic_tokens = processor.compress(sample)
+    growth = Table(title="Decode ms per MB by dictionary size 📖")
+    growth.add_column("Dynamic tokens", style="cyan", justify="right")
+    growth.add_column("replace per token", style="yellow", justify="right")
+    growth.add_column("single scan", style="yellow", justify="right")
+    for size in sorted({16, 64, len(dynamic_tokens)}):
+        tokens = dict(list(dynamic_tokens.items())[:size])
+        _, legacy = timed(lambda: legacy_decompress(compressed, tokens), rounds)
+        _, single = timed(lambda: processor.decompress(compressed, tokens), rounds)
+        growth.add_row(str(len(tokens)), f"{legacy * 1000:.0f}", f"{single * 1000:.0f}")
+    console.print(growth)
+
+
+def markdown_files(paths: List[Path]) -> List[Tuple[str, str]]:
+    """(name, text) of markdown files, and of .mq/.m8 files decoded, under the paths"""
+    processor = MarkqantProcessor(dictionaries=DictionaryStore(DICTIONARIES_DIR))
+    documents = []
+    for path in paths:
+        files = sorted(f for f in path.rglob("*") if f.suffix in (".md", ".mq", ".m8")) if path.is_dir() else [path]
+        for f in files:
+            if f.suffix == ".md":
+                documents.append((str(f), f.read_text(errors="replace")))
+            else:
+                documents.append((str(f), processor.read_mq_file(f).personality))
+    return documents
+
+
+def bench_dictionary(paths: List[Path]):
+    """Dictionary builders compared: size after tokens, container size and build time"""
+    table = Table(title="Markqant dictionaries: frequent words vs. net bytes saved 📚")
+    table.add_column("Corpus", style="cyan")
+    table.add_column("Builder", style="green")
+    table.add_column("Tokens/file", justify="right")
+    table.add_column("Tokenized", style="yellow", justify="right")
+    table.add_column("Container", style="yellow", justify="right")
+    table.add_column("Build ms/file", style="magenta", justify="right")
+
+    for path in paths:
+        documents = markdown_files([path])
+        if not documents:
+            continue
+        original = sum(len(text.encode()) for _, text in documents)
+        for name, build in DICTIONARY_BUILDERS.items():
+            tokens = tokenized = container = 0
+            build_seconds = 0.0
+            for _, text in documents:
+                start = time.perf_counter()
+                build(text, MAX_DYNAMIC_TOKENS)
+                build_seconds += time.perf_counter() - start
+                processor = MarkqantProcessor(dictionary=name)
+                compressed, dynamic_tokens = processor.compress(text)
+                tokens += len(dynamic_tokens)
+                tokenized += len(compressed.encode()) + sum(
+                    BINARY_ENTRY.size + len(pattern.encode()) for pattern in dynamic_tokens.values()
+                )
+                container += len(MarkqantProcessor(dictionary=name).create_mq_binary(text))
+            table.add_row(
+                f"{path} ({len(documents)} files, {original / 1024:.0f} KB)", name,
+                f"{tokens / len(documents):.0f}", f"{tokenized / original:.1%}", f"{container / original:.1%}",
+                f"{build_seconds / len(documents) * 1000:.1f}",
+            )
+    console.print(table)
+
+
+def write_interaction_log(path: Path, size_mb: float, seed: int = 0):
+    """A synthetic interactions.jsonl of about size_mb, written a line at a time"""
+    rng = random.Random(seed)
+    commands = ["git status", "git diff --stat", "make test", "pytest -q --lf", "npm run build",
+                "docker compose ps", "cargo check", "ls -la", "tail -f server.log"]
+    target = int(size_mb * 1024 * 1024)
+    written = 0
+    with open(path, 'w') as f:
+        while written < target:
+            panes = [f"Pane %{i}:\n$ {rng.choice(commands)}\n{rng.randint(0, 99)} passed, "
+                     f"{rng.randint(0, 3)} failed in {rng.random():.2f}s\nuser@host:~/project$"
+                     for i in range(rng.randint(1, 4))]
+            entry = {"timestamp": f"2026-10-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00",
+                     "persona": rng.choice(["helpful", "omni", "trisha"]),
+                     "prompt": "\n\n".join(panes), "response": f"`{rng.choice(commands)}`"}
+            line = json.dumps(entry) + "\n"
+            f.write(line)
+            written += len(line)
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def bench_stream(size_mb: float, chunk_size: int):
+    """Streamed Markqant on a large interaction log: throughput and peak memory"""
+    with tempfile.TemporaryDirectory() as scratch:
+        original, packed, restored = (Path(scratch) / name for name in ("log.jsonl", "log.mq", "log.out"))
+        write_interaction_log(original, size_mb)
+        megabytes = original.stat().st_size / (1024 * 1024)
+
+        def run(stream: Callable, source: Path, target: Path) -> Tuple[float, float]:
+            """(seconds untraced, peak traced MB) of one streaming pass"""
+            start = time.perf_counter()
+            with open(source, 'rb') as f, open(target, 'wb') as out:
+                for data in stream(f, chunk_size):
+                    out.write(data)
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            with open(source, 'rb') as f:
+                for _ in stream(f, chunk_size):
+                    pass
+            peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+            return elapsed, peak
+
+        encode, encode_peak = run(MarkqantProcessor().compress_stream, original, packed)
+        decode, decode_peak = run(MarkqantProcessor().decompress_stream, packed, restored)
+
+        table = Table(title=f"Streamed Markqant on a {megabytes:.0f} MB interaction log 🌊")
+        table.add_column("Direction", style="cyan")
+        table.add_column("MB/s", style="yellow", justify="right")
+        table.add_column("Peak MB", style="magenta", justify="right")
+        table.add_row("compress", f"{megabytes / encode:.1f}", f"{encode_peak:.1f}")
+        table.add_row("decompress", f"{megabytes / decode:.1f}", f"{decode_peak:.1f}")
+        console.print(table)
+        identical = file_digest(original) == file_digest(restored)
+        console.print(f"Ratio {packed.stat().st_size / original.stat().st_size:.1%}, "
+                      f"round trip {'✅' if identical else '❌'}")
+
+
+def bench_aggregate(root: Path, rounds: int):
+    """Aggregate of a directory: size against per-file containers and one zlib stream, access latency"""
+    files = find_documents(root)
+    if not files:
+        console.print(f"[red]No markdown under {root}[/red]")
+        return
+    texts = [f.read_text(encoding='utf-8', errors='replace') for f in files]
+    original = sum(len(text.encode()) for text in texts)
+    per_file = sum(len(MarkqantProcessor().create_mq_binary(text)) for text in texts)
+    whole = len(zlib.compress("".join(texts).encode()))
+
+    with tempfile.TemporaryDirectory() as scratch:
+        archive = Path(scratch) / "docs.mq"
+        _, create = timed(lambda: create_aggregate(archive, root, files), 1)
+        size = archive.stat().st_size
+
+        sizes = Table(title=f"{root}: {len(files)} files, {original / 1024:.0f} KB 📦")
+        sizes.add_column("Layout", style="cyan")
+        sizes.add_column("Size", style="green", justify="right")
+        sizes.add_column("Ratio", style="green", justify="right")
+        sizes.add_column("Random access", justify="center")
+        sizes.add_row("one .mq per file", f"{per_file / 1024:.0f} KB", f"{per_file / original:.1%}", "✅")
+        sizes.add_row("one zlib stream", f"{whole / 1024:.0f} KB", f"{whole / original:.1%}", "❌")
+        sizes.add_row(f"aggregate (built in {create * 1000:.0f} ms)", f"{size / 1024:.0f} KB",
+                      f"{size / original:.1%}", "✅")
+        console.print(sizes)
+
+        largest = max(files, key=lambda f: f.stat().st_size).relative_to(root).as_posix()
+
+        def open_index():
+            with MarkqantAggregate(archive) as aggregate:
+                return len(aggregate.members)
+
+        def extract_one():
+            with MarkqantAggregate(archive) as aggregate:
+                return aggregate.read(largest)
+
+        def extract_all():
+            with MarkqantAggregate(archive) as aggregate:
+                return [aggregate.read(name) for name in aggregate.members]
+
+        def search(names: Optional[List[str]]):
+            with MarkqantAggregate(archive) as aggregate:
+                return list(aggregate.search("zlib", names, ignore_case=True))
+
+        latency = Table(title="Aggregate access ⏱️")
+        latency.add_column("Operation", style="cyan")
+        latency.add_column("ms", style="yellow", justify="right")
+        for label, run in (("open + list", open_index), (f"extract {largest}", extract_one),
+                           ("extract all", extract_all), ("search all members", lambda: search(None)),
+                           ("search one member", lambda: search([largest]))):
+            _, seconds = timed(run, rounds)
+            latency.add_row(label, f"{seconds * 1000:.2f}")
+        console.print(latency)
+
+
+def size_class(size: int) -> str:
+    """Persona-sized payloads, then the bands the auto codec chooses by"""
+    if size <= 1024:
+        return "≤1 KB"
+    return f"≤{SMALL_PAYLOAD // 1024} KB" if size <= SMALL_PAYLOAD else f">{SMALL_PAYLOAD // 1024} KB"
+
+
+def bench_codecs(paths: List[Path], rounds: int):
+    """Ratio and throughput of every payload codec, and of auto per target, by size class"""
+    documents = markdown_files([path for path in paths if path.exists()])
+    if not documents:
+        console.print(f"[red]No .md/.mq/.m8 files under {', '.join(map(str, paths))}[/red]")
+        return
+    # Codecs see what a container would hold: the tokenized text
+    classes: Dict[str, List[Tuple[int, str]]] = {}
+    for _, text in documents:
+        compressed, _ = MarkqantProcessor().compress(text)
+        payload = compressed.encode()
+        classes.setdefault(size_class(len(payload)), []).append((len(text.encode()), compressed))
+
+    table = Table(title=f"Markqant payload codecs on {len(documents)} files ({rounds} rounds) 🗜️")
+    table.add_column("Size class", style="cyan")
+    table.add_column("Files", justify="right")
+    table.add_column("Codec", style="green")
+    table.add_column("Ratio", style="yellow", justify="right")
+    table.add_column("Encode MB/s", style="magenta", justify="right")
+    table.add_column("Decode MB/s", style="magenta", justify="right")
+    table.add_column("Round trip", justify="center")
+
+    labels = list(CODECS) + [f"auto/{target}" for target in AUTO_CODECS]
+    for label_class, members in sorted(classes.items(), key=lambda item: min(size for size, _ in item[1])):
+        original = sum(size for size, _ in members)
+        megabytes = original / (1024 * 1024)
+        for row, label in enumerate(labels):
+            codec, _, target = label.partition("/")
+            packed, encode = timed(lambda: [pack_payload(text, codec=codec, target=target) for _, text in members],
+                                   rounds)
+            restored, decode = timed(lambda: [unpack_payload(data, flags) for data, flags in packed], rounds)
+            ok = all(data.decode() == text for data, (_, text) in zip(restored, members))
+            table.add_row(
+                label_class if row == 0 else "", f"{len(members)} ({original / 1024:.0f} KB)" if row == 0 else "",
+                label,
+                f"{sum(len(data) for data, _ in packed) / original:.1%}",
+                f"{megabytes / encode:.1f}", f"{megabytes / decode:.1f}", "✅" if ok else "❌",
+            )
+        table.add_section()
+    console.print(table)
+
+
+def bench_batch(paths: List[Path], copies: int, worker_counts: List[int]):
+    """Batch compress/decompress across process pools of several sizes, and one processor shared by threads"""
+    documents = markdown_files([path for path in paths if path.exists()])
+    if not documents:
+        console.print(f"[red]No .md/.mq/.m8 files under {', '.join(map(str, paths))}[/red]")
+        return
+    texts = [text for _, text in documents]
+
+    # A processor reused for every document (and from many threads) must give
+    # each one exactly what a fresh processor would
+    shared = MarkqantProcessor()
+    fresh = [MarkqantProcessor().compress(text) for text in texts]
+    reused = [shared.compress(text) for text in texts]
+    with ThreadPoolExecutor(8) as pool:
+        threaded = list(pool.map(shared.compress, texts))
+    console.print(f"Shared processor: {sum(len(tokens) for _, tokens in reused)} dynamic tokens over "
+                  f"{len(texts)} documents, same as fresh processors {'✅' if reused == fresh else '❌'}, "
+                  f"same from 8 threads {'✅' if threaded == fresh else '❌'}")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        root = Path(scratch)
+        sources = []
+        for copy in range(copies):
+            for index, text in enumerate(texts):
+                source = root / f"{copy}-{index}.md"
+                source.write_bytes(text.encode())
+                sources.append(source)
+        megabytes = sum(f.stat().st_size for f in sources) / (1024 * 1024)
+
+        table = Table(title=f"Batch Markqant on {len(sources)} files, {megabytes:.1f} MB "
+                            f"({os.cpu_count()} CPUs) 🏭")
+        table.add_column("Workers", style="cyan", justify="right")
+        table.add_column("Compress MB/s", style="yellow", justify="right")
+        table.add_column("Speedup", style="green", justify="right")
+        table.add_column("Decompress MB/s", style="yellow", justify="right")
+        table.add_column("Speedup", style="green", justify="right")
+        table.add_column("Round trip", justify="center")
+        baseline = None
+        for workers in worker_counts:
+            packed = [(source, source.with_suffix(".mq")) for source in sources]
+            restored = [(target, target.with_suffix(".out")) for _, target in packed]
+            _, encode = timed(lambda: shared.compress_files(packed, workers), 1)
+            _, decode = timed(lambda: shared.decompress_files(restored, workers), 1)
+            baseline = baseline or (encode, decode)
+            identical = all(source.read_bytes() == out.read_bytes() for (source, _), (_, out) in zip(packed, restored))
+            table.add_row(
+                str(workers), f"{megabytes / encode:.1f}", f"{baseline[0] / encode:.2f}x",
+                f"{megabytes / decode:.1f}", f"{baseline[1] / decode:.2f}x", "✅" if identical else "❌",
+            )
+        console.print(table)
+
+
+def random_markdown(rng: random.Random, length: int) -> str:
+    """Text built from token patterns, token look-alikes and repeated words"""
+    pieces = list(MARKQANT_TOKENS.values()) + list(MARKQANT_TOKENS) + [
+        ESCAPE_TOKEN, "T", "TT", "0A", "FF", "T1", "=", "---\n", "\n", " ", "\r\n", "é", "🧙",
+        "suggest", "suggesting", "commands", "Terminal", "T0A0B",
+    ]
+    return "".join(rng.choice(pieces) for _ in range(length))
+
+
+def check_roundtrip(paths: List[Path], cases: int, seed: int):
+    """Round-trip random adversarial documents and real files through .mq files"""
+    processor = MarkqantProcessor()
+    rng = random.Random(seed)
+    documents = [("random", random_markdown(rng, rng.randint(0, 400))) for _ in range(cases)]
+    for path in paths:
+        for f in sorted(path.rglob("*.md")) if path.is_dir() else [path]:
+            documents.append((str(f), f.read_text(errors="replace")))
+
+    failures = []
+    for label, document in documents:
+        restored = processor.parse_mq_file(MarkqantProcessor().create_mq_file(document, "check.mq")).personality
+        if restored != document:
+            failures.append((label, document))
+    for label, document in failures[:5]:
+        console.print(f"[red]❌ {label}: {document[:80]!r}[/red]")
+    style = "red" if failures else "green"
+    console.print(f"[{style}]{len(documents) - len(failures)}/{len(documents)} documents round-tripped[/{style}]")
+    if failures:
+        sys.exit(1)
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="Sage benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    tick = sub.add_parser("tick", help="Subprocesses and latency per monitoring tick")
+    tick.add_argument("--panes", type=int, nargs="+", default=[1, 8, 32], help="Pane counts to test")
+    tick.add_argument("--ticks", type=int, default=20, help="Ticks per measurement")
+
+    daemon = sub.add_parser("daemon", help="Memory per session in the multi-session daemon")
+    daemon.add_argument("--sessions", type=int, default=100, help="Sessions to simulate")
+    daemon.add_argument("--panes", type=int, default=4, help="Panes per session")
+
+    http = sub.add_parser("http", help="Connection reuse: fresh client per request vs. shared pool")
+    http.add_argument("--url", default="https://openrouter.ai/api/v1/models", help="URL to GET")
+    http.add_argument("--requests", type=int, default=5, help="Requests per client mode")
+    http.add_argument("--http2", action="store_true", help="Use HTTP/2 (needs the h2 package)")
+
+    predict = sub.add_parser("predict", help="Hit rate and latency of the local command predictor")
+    predict.add_argument("--log", type=Path, default=Path(".sage_proj") / "interactions.jsonl",
+                         help="Interaction log to replay")
+
+    markqant = sub.add_parser("markqant", help="Markqant compression throughput on markdown")
+    markqant.add_argument("paths", type=Path, nargs="*", default=[Path("docs")],
+                          help="Markdown files or directories (default: docs/)")
+    markqant.add_argument("--size-mb", type=float, default=8.0, help="Repeat the corpus up to this size")
+    markqant.add_argument("--rounds", type=int, default=3, help="Runs per compressor")
+
+    roundtrip = sub.add_parser("roundtrip", help="Check Markqant decode(encode(x)) == x")
+    roundtrip.add_argument("paths", type=Path, nargs="*", default=[Path("docs")],
+                           help="Markdown files or directories to include (default: docs/)")
+    roundtrip.add_argument("--cases", type=int, default=2000, help="Random documents to generate")
+    roundtrip.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    dictionary = sub.add_parser("dictionary", help="Markqant dictionary builders: ratio and build time")
+    dictionary.add_argument("paths", type=Path, nargs="*", default=[PERSONAS_DIR, Path("docs")],
+                            help="Files or directories of .md/.mq/.m8 (default: personas and docs/)")
+
+    stream = sub.add_parser("stream", help="Streamed Markqant on a large synthetic interaction log")
+    stream.add_argument("--size-mb", type=float, default=32.0, help="Log size to generate")
+    stream.add_argument("--chunk-size", type=int, default=256 * 1024, help="Bytes read per step")
+
+    aggregate = sub.add_parser("aggregate", help="Markqant aggregate: size and per-member access latency")
+    aggregate.add_argument("root", type=Path, nargs="?", default=Path("docs"), help="Directory (default: docs/)")
+    aggregate.add_argument("--rounds", type=int, default=20, help="Runs per access measurement")
+
+    codecs = sub.add_parser("codecs", help="Markqant payload codecs: ratio and MB/s per codec and size class")
+    codecs.add_argument("paths", type=Path, nargs="*", default=[PERSONAS_DIR, Path(".sage_proj"), Path("docs")],
+                        help="Files or directories of .md/.mq/.m8 (default: personas, .sage_proj and docs/)")
+    codecs.add_argument("--rounds", type=int, default=5, help="Runs per codec")
+
+    batch = sub.add_parser("batch", help="Markqant batch compression scaling by worker processes")
+    batch.add_argument("paths", type=Path, nargs="*", default=[PERSONAS_DIR, Path("docs")],
+                       help="Files or directories of .md/.mq/.m8 (default: personas and docs/)")
+    batch.add_argument("--copies", type=int, default=10, help="Copies of each document to batch")
+    batch.add_argument("--workers", type=int, nargs="+",
+                       default=sorted({1, 2, 4, os.cpu_count() or 1}), help="Pool sizes to test")
+
+    args = parser.parse_args()
+
+    if args.bench == "tick":
+        bench_tick(args.panes, args.ticks)
+    elif args.bench == "daemon":
+        bench_daemon(args.sessions, args.panes)
+    elif args.bench == "http":
+        bench_http(args.url, args.requests, args.http2)
+    elif args.bench == "predict":
+        bench_predict(args.log)
+    elif args.bench == "markqant":
+        bench_markqant(args.paths, args.size_mb, args.rounds)
+    elif args.bench == "roundtrip":
+        check_roundtrip(args.paths, args.cases, args.seed)
+    elif args.bench == "dictionary":
+        bench_dictionary(args.paths)
+    elif args.bench == "stream":
+        bench_stream(args.size_mb, args.chunk_size)
+    elif args.bench == "aggregate":
+        bench_aggregate(args.root, args.rounds)
+    elif args.bench == "codecs":
+        bench_codecs(args.paths, args.rounds)
+    elif args.bench == "batch":
+        bench_batch(args.paths, args.copies, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Suggestion caches for Sage - answer repeated idle states without calling the model
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from sage_tmux import ANSI_ESCAPE
+
+logger = logging.getLogger(__name__)
+
+SUGGESTION_CACHE_FILE = "suggestion_cache.json"
+SUGGESTION_CACHE_SIZE = 256
+SUGGESTION_CACHE_TTL = 6 * 3600  # seconds
+
+# Queued follow-up candidates are dropped after this long
+CANDIDATE_TTL = 10 * 60  # seconds
+
+# SimHash signature width and default near-duplicate radius (Hamming bits)
+SIMHASH_BITS = 64
+SIMILARITY_MAX_DISTANCE = 4
+
+# Clocks and dates that change between otherwise identical idle states
+TIMESTAMP_PATTERNS = [re.compile(p) for p in (
+    r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?",  # ISO 8601
+    r"\b\d{1,2}:\d{2}(:\d{2})?(\s?[AaPp][Mm])?\b",                             # 12:34[:56] [PM]
+    r"\b\d{4}[-/]\d{2}[-/]\d{2}\b|\b\d{1,2}/\d{1,2}/\d{2,4}\b",                 # dates
+    r"\b1[6-9]\d{8}(\.\d+)?\b",                                                  # unix epoch
+)]
+
+
+def normalize_pane_text(text: str) -> str:
+    """Strip escapes, mask timestamps and trailing blanks so equal states hash equal"""
+    text = ANSI_ESCAPE.sub("", text)
+    for pattern in TIMESTAMP_PATTERNS:
+        text = pattern.sub("<TS>", text)
+    return "\n".join(line.rstrip() for line in text.strip().splitlines())
+
+
+def state_key(persona: str, model: str, summaries: List[str]) -> str:
+    """Cache key for one persona/model looking at one normalized pane state"""
+    digest = hashlib.sha256()
+    for part in [persona, model] + [normalize_pane_text(s) for s in summaries]:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def context_key(persona: str, model: str, summaries: List[str]) -> str:
+    """Looser key than state_key: the panes and the prompt line each one sits at"""
+    parts = [persona, model]
+    for summary in summaries:
+        lines = normalize_pane_text(summary).splitlines()
+        parts += [lines[0], lines[-1]]  # "Pane %N:" header and the prompt line
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class CandidateQueue:
+    """Ranked alternative commands from one answer, waiting for a later idle cycle
+
+    Candidates are keyed by context_key(), so they are only offered while
+    every pane still sits at the same prompt (same shells, same directories).
+    """
+
+    def __init__(self, ttl: float = CANDIDATE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self._queues: Dict[str, List[Tuple[float, str]]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def push(self, key: str, commands: List[str]):
+        """Queue commands (best first) behind any already waiting for this context"""
+        now = time.time()
+        self._queues.setdefault(key, []).extend((now, command) for command in commands)
+
+    def pop(self, key: str, exclude: Optional[List[str]] = None) -> Optional[str]:
+        """Next fresh candidate for this context that isn't one of the excluded commands"""
+        queue = self._queues.get(key, [])
+        now = time.time()
+        while queue:
+            queued_at, command = queue.pop(0)
+            if now - queued_at <= self.ttl and command not in (exclude or []):
+                self.hits += 1
+                return command
+        self._queues.pop(key, None)
+        return None
+
+    def clear(self, key: Optional[str] = None):
+        """Forget candidates for one context, or all of them"""
+        if key is None:
+            self._queues.clear()
+        else:
+            self._queues.pop(key, None)
+
+
+class SuggestionCache:
+    """Exact-match LRU cache of AI responses with TTL, persisted as JSON"""
+
+    def __init__(self, path: Optional[Path] = None, max_entries: int = SUGGESTION_CACHE_SIZE,
+                 ttl: float = SUGGESTION_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # one writer at a time, so the newest snapshot lands last
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached response for a key, counting the hit or miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, response: str):
+        """Store a response, evicting the least recently used entries"""
+        with self._lock:
+            self._entries[key] = (time.time(), response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self.save()
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters for display"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def load(self):
+        """Load unexpired entries from disk"""
+        if not self.path or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable suggestion cache {self.path}: {e}")
+            return
+        now = time.time()
+        for key, stored_at, response in data.get("entries", []):
+            if now - stored_at <= self.ttl:
+                self._entries[key] = (stored_at, response)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """Write entries to disk (oldest first, so LRU order survives a reload)"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                data = {"entries": [[key, stored_at, response] for key, (stored_at, response) in self._entries.items()]}
+            # A temp file of its own, so a writer in another process can't clobber it mid-dump
+            f = tempfile.NamedTemporaryFile('w', dir=self.path.parent, prefix=self.path.name,
+                                            suffix=".tmp", delete=False)
+            try:
+                with f:
+                    json.dump(data, f)
+                os.replace(f.name, self.path)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+
+# Byte value -> its 8 bits spread into 16-bit lanes, so per-bit feature votes
+# can be summed with big-int additions instead of a Python loop per bit
+_LANE_BITS = 16
+_SPREAD_BYTE = [sum((b >> i & 1) << (i * _LANE_BITS) for i in range(8)) for b in range(256)]
+_LANE_MASK = (1 << _LANE_BITS) - 1
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash over word unigrams and bigrams of normalized text"""
+    words = normalize_pane_text(text).split()
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    ones = 0
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        for index, byte in enumerate(digest):
+            ones += _SPREAD_BYTE[byte] << (index * 8 * _LANE_BITS)
+    signature = 0
+    for bit in range(SIMHASH_BITS):
+        # A bit is set when more than half of the features voted for it
+        if 2 * (ones >> (bit * _LANE_BITS) & _LANE_MASK) > len(features):
+            signature |= 1 << bit
+    return signature
+
+
+class SimHashIndex:
+    """Near-duplicate lookup over past prompt/response pairs in interactions.jsonl
+
+    Signatures are split into max_distance + 1 bands; by pigeonhole, two
+    signatures within max_distance bits agree exactly on at least one band,
+    so a lookup only inspects entries sharing a band bucket. Responses stay
+    on disk; the index keeps signatures and file offsets. The log is read
+    lazily on first lookup and incrementally after that.
+    """
+
+    def __init__(self, log_path: Path, max_distance: int = SIMILARITY_MAX_DISTANCE):
+        self.log_path = log_path
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        edges = [round(i * SIMHASH_BITS / band_count) for i in range(band_count + 1)]
+        self._bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(edges, edges[1:])]
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in self._bands]
+        self._signatures = array("Q")
+        self._offsets = array("q")
+        self._personas = array("H")
+        self._persona_ids: Dict[str, int] = {}
+        self._read_offset = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def _add(self, persona: str, prompt: str, offset: int):
+        signature = simhash(prompt)
+        entry = len(self._signatures)
+        self._signatures.append(signature)
+        self._offsets.append(offset)
+        self._personas.append(self._persona_ids.setdefault(persona, len(self._persona_ids)))
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            buckets.setdefault(signature >> shift & mask, []).append(entry)
+
+    def refresh(self):
+        """Index any interactions appended since the last read"""
+        if not self.log_path.exists():
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._read_offset)
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # missing or half-written last line; retry next time
+                self._read_offset = f.tell()
+                try:
+                    entry = json.loads(line)
+                    self._add(entry["persona"], entry["prompt"], offset)
+                except (ValueError, KeyError):
+                    continue
+
+    def _response_at(self, offset: int) -> Optional[str]:
+        with open(self.log_path, 'rb') as f:
+            f.seek(offset)
+            try:
+                return json.loads(f.readline())["response"]
+            except (ValueError, KeyError):
+                return None
+
+    def lookup(self, persona: str, prompt: str) -> Optional[Tuple[str, int]]:
+        """Closest past response for this persona within max_distance, with its distance"""
+        with self._lock:
+            self.refresh()
+            persona_id = self._persona_ids.get(persona)
+            signature = simhash(prompt)
+            best: Optional[Tuple[int, int]] = None
+            if persona_id is not None:
+                seen = set()
+                for buckets, (shift, mask) in zip(self._buckets, self._bands):
+                    for entry in buckets.get(signature >> shift & mask, ()):
+                        if entry in seen or self._personas[entry] != persona_id:
+                            continue
+                        seen.add(entry)
+                        distance = bin(self._signatures[entry] ^ signature).count("1")
+                        if distance > self.max_distance:
+                            continue
+                        # Ties go to the most recent interaction, whichever band turned it up
+                        if best is None or (distance, -entry) < (best[0], -best[1]):
+                            best = (distance, entry)
+
+            if best is None:
+                self.misses += 1
+                return None
+            response = self._response_at(self._offsets[best[1]])
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return response, best[0]
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Sage daemon - one process watching many tmux sessions
+
+All sessions share one tmux control connection, one HTTP connection pool and one
+persona cache; each session only carries its own idle timers and threshold.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from rich.table import Table
+
+from sage import (
+    console, PersonaManager, PersonaConfig, PersonaContext, ContextManager,
+    summarize_pane, suggestion_prompt, create_default_personas,
+    IDLE_THRESHOLD_RANGE, CHECK_INTERVAL,
+)
+from sage_ai import acomplete, extract_command, extract_commands
+from sage_cache import (
+    CandidateQueue, SuggestionCache, SimHashIndex, SUGGESTION_CACHE_FILE, context_key, state_key,
+)
+from sage_http import HTTP_POOL, PoolSettings
+from sage_guard import GUARDS, CircuitOpenError, RateLimitedError, circuit_name
+from sage_prompt import PromptBuilder
+from sage_routing import ROUTER, persona_endpoints
+from sage_predict import CommandPredictor, LOCAL_ENDPOINT
+from sage_tmux import (
+    AsyncTmuxControl, ActivityTracker, TmuxCommandError, ACTIVITY_FORMAT,
+    CAPTURE_START, quote_tmux,
+)
+
+logger = logging.getLogger(__name__)
+
+# list-panes -a row: session name followed by the ActivityTracker fields
+DAEMON_PANE_FORMAT = "#{session_name}\t" + ACTIVITY_FORMAT
+
+
+@dataclass
+class WatchedSession:
+    """Per-session state kept by the daemon"""
+    name: str
+    persona: str
+    threshold: int
+    tracker: ActivityTracker
+    prompts: PromptBuilder = field(default_factory=PromptBuilder)
+    candidates: CandidateQueue = field(default_factory=CandidateQueue)
+    panes: List[str] = field(default_factory=list)
+    idle_start: Dict[str, float] = field(default_factory=dict)
+    last_reset: float = 0.0
+    query: Optional[asyncio.Task] = None
+    last_command: str = ""
+    suggestions: int = 0
+
+    def reset(self):
+        """Restart idle timers with a fresh random threshold"""
+        self.idle_start.clear()
+        self.last_reset = time.time()
+        self.threshold = random.randint(*IDLE_THRESHOLD_RANGE)
+
+    def idle_seconds(self, now: float) -> Optional[float]:
+        """How long every pane has been idle (None if any pane is active)"""
+        if not self.panes or any(pid not in self.idle_start for pid in self.panes):
+            return None
+        return now - max(self.idle_start.values())
+
+
+class PersonaCache:
+    """Loads each persona once and shares it between sessions"""
+
+    def __init__(self, manager: Optional[PersonaManager] = None):
+        self.manager = manager or PersonaManager()
+        self._personas: Dict[str, Tuple[PersonaConfig, PersonaContext]] = {}
+
+    def get(self, name: str) -> Tuple[PersonaConfig, PersonaContext]:
+        """Load a persona, from cache after the first time"""
+        if name not in self._personas:
+            self._personas[name] = self.manager.load_persona(name)
+        return self._personas[name]
+
+
+class SageDaemon:
+    """Asyncio scheduler that monitors many tmux sessions at once"""
+
+    def __init__(self, sessions: Dict[str, str], default_persona: str, watch_all: bool = False,
+                 speculate: Optional[float] = None):
+        self.requested = sessions
+        self.default_persona = default_persona
+        self.watch_all = watch_all
+        # Fraction of the idle threshold at which queries start (see SageSession)
+        self.query_at = 1.0 if speculate is None else min(max(speculate, 0.0), 1.0)
+        self.personas = PersonaCache()
+        self.context_manager = ContextManager()
+        self.tmux = AsyncTmuxControl()
+        self.cache = SuggestionCache(self.context_manager.context_dir / SUGGESTION_CACHE_FILE)
+        self.similar_index = SimHashIndex(self.context_manager.context_dir / "interactions.jsonl")
+        self.predictor = CommandPredictor(self.context_manager.context_dir / "interactions.jsonl")
+        self.sessions: Dict[str, WatchedSession] = {}
+        self.skipped: Set[str] = set()  # sessions whose persona failed to load, until they close
+
+    def check_personas(self):
+        """Load the default and every requested persona, so a typo fails at startup"""
+        for persona in {self.default_persona, *self.requested.values()}:
+            self.personas.get(persona)
+
+    def watch(self, name: str, persona: str) -> WatchedSession:
+        """Start tracking a session"""
+        config, _ = self.personas.get(persona)  # fail early on unknown personas
+        settings = PoolSettings.from_config(config.http)
+        if settings.warmup:
+            for endpoint in persona_endpoints(config):
+                if endpoint.api_endpoint != LOCAL_ENDPOINT:
+                    asyncio.create_task(HTTP_POOL.awarm_up(endpoint.api_endpoint, settings))
+        state = WatchedSession(
+            name=name,
+            persona=persona,
+            threshold=random.randint(*IDLE_THRESHOLD_RANGE),
+            tracker=ActivityTracker(name),
+        )
+        self.sessions[name] = state
+        logger.info(f"Watching session '{name}' with persona '{persona}'")
+        return state
+
+    def unwatch(self, name: str):
+        """Stop tracking a session that went away"""
+        state = self.sessions.pop(name)
+        if state.query and not state.query.done():
+            state.query.cancel()
+        logger.info(f"Session '{name}' closed")
+
+    async def capture(self, pane_id: str) -> str:
+        """Capture a pane over the shared control connection"""
+        try:
+            lines = await self.tmux.command(f"capture-pane -p -t {pane_id} -S {CAPTURE_START}")
+        except TmuxCommandError:
+            return ""
+        return "\n".join(lines)
+
+    async def tick(self):
+        """One scheduling round: refresh every session's idle state"""
+        rows = await self.tmux.command(f"list-panes -a -F {quote_tmux(DAEMON_PANE_FORMAT)}")
+        by_session: Dict[str, List[str]] = {}
+        for row in rows:
+            name, _, rest = row.partition("\t")
+            by_session.setdefault(name, []).append(rest)
+
+        # Pick up new sessions and drop closed ones
+        for name in by_session:
+            if name in self.sessions or name in self.skipped:
+                continue
+            if self.watch_all or name in self.requested:
+                try:
+                    self.watch(name, self.requested.get(name, self.default_persona))
+                except Exception as e:
+                    # One bad persona must not take the other sessions down with it
+                    logger.error(f"Not watching session '{name}': {e}")
+                    self.skipped.add(name)
+        for name in list(self.sessions):
+            if name not in by_session:
+                self.unwatch(name)
+        self.skipped.intersection_update(by_session)  # retried if the session comes back
+
+        now = time.time()
+        confirmations = []
+        for name, state in self.sessions.items():
+            info = ActivityTracker.parse("\n".join(by_session[name]))
+            state.panes = list(info)
+            state.tracker.forget(state.panes)
+            for pid in list(state.idle_start):
+                if pid not in info:
+                    del state.idle_start[pid]
+            for pid in state.tracker.observe(state.panes, info, now):
+                confirmations.append((state, pid))
+
+        # Prompt confirmations for every session are pipelined on one connection
+        captured = await asyncio.gather(*(self.capture(pid) for _, pid in confirmations))
+        for (state, pid), text in zip(confirmations, captured):
+            lines = text.strip().splitlines()
+            state.tracker.confirm(pid, lines[-1] if lines else "")
+
+        for state in self.sessions.values():
+            for pid, since in state.tracker.idle_since(state.panes, now).items():
+                if since is None:
+                    state.idle_start.pop(pid, None)
+                else:
+                    state.idle_start.setdefault(pid, max(since, state.last_reset))
+
+            idle = state.idle_seconds(now)
+            if state.query is not None:
+                if idle is None and not state.query.done():
+                    # A pane is busy again; its answer would be stale
+                    state.query.cancel()
+            elif idle is not None and idle > state.threshold * self.query_at:
+                state.query = asyncio.create_task(self.suggest(state))
+
+    async def query_ai(self, config: PersonaConfig, prompt: str, messages: List[Dict[str, str]],
+                       cache_key: Optional[str] = None) -> Optional[str]:
+        """Query the persona's model on the shared HTTP client (None when no answer could be had)"""
+        try:
+            ai_response = await acomplete(config, messages, PoolSettings.from_config(config.http))
+            self.context_manager.log_interaction(config.name, prompt, ai_response)
+            if cache_key:
+                self.cache.put(cache_key, ai_response)
+            return ai_response
+        except (CircuitOpenError, RateLimitedError) as e:
+            logger.warning(f"AI query skipped: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"AI query failed: {e}")
+            return None
+
+    async def suggest(self, state: WatchedSession):
+        """Ask the AI for a command for one session and send it to its first pane"""
+        try:
+            panes = list(state.panes)
+            config, _ = self.personas.get(state.persona)
+            contents = await asyncio.gather(*(self.capture(pid) for pid in panes))
+            contents = dict(zip(panes, contents))
+            summaries = [summarize_pane(pid, text) for pid, text in contents.items()]
+            prompt = suggestion_prompt(summaries)
+            context = self.context_manager.load_context()
+
+            queue_key = context_key(config.name, config.model, summaries)
+            queued = state.candidates.pop(queue_key, exclude=(context or {}).get("recent_commands"))
+            if queued is not None:
+                logger.info(f"[{state.name}] Using queued candidate")
+                await self.hold(state)
+                await asyncio.shield(self.deliver(state, panes[0], queued))
+                return
+
+            cache_key = state_key(config.name, config.model, summaries)
+            response = self.cache.get(cache_key)
+            if response is None:
+                # Off the event loop: the first lookup loads the whole index
+                match = await asyncio.get_running_loop().run_in_executor(
+                    None, self.similar_index.lookup, config.name, prompt
+                )
+                if match is not None:
+                    response, distance = match
+                    logger.info(f"[{state.name}] Near-duplicate cache hit ({distance} bits away)")
+                    self.cache.put(cache_key, response)
+            if response is None:
+                response = await self.ask_models(state, config, prompt, contents, context, cache_key)
+            if response is None:
+                return
+            command, *runners_up = extract_commands(response, config.candidates)
+            state.candidates.push(queue_key, runners_up)
+            await self.hold(state)
+            # Once typing starts, finish it even if the pane wakes up meanwhile
+            await asyncio.shield(self.deliver(state, panes[0], command))
+        except asyncio.CancelledError:
+            logger.info(f"[{state.name}] Pane became active, discarded pending suggestion")
+            raise
+        except Exception as e:
+            logger.error(f"[{state.name}] Suggestion failed: {e}")
+        finally:
+            state.query = None
+            state.reset()
+
+    async def ask_models(self, state: WatchedSession, config: PersonaConfig, prompt: str,
+                         contents: Dict[str, str], context: Optional[Dict], cache_key: str) -> Optional[str]:
+        """Local predictor first when confident (or as the persona), then the remote model"""
+        await asyncio.get_running_loop().run_in_executor(None, self.predictor.refresh)
+        recent = (context or {}).get("recent_commands") or [None]
+        local = self.predictor.predict(prompt, recent[-1])
+        if config.api_endpoint == LOCAL_ENDPOINT:
+            return f"`{local[0]}`" if local else None
+        if local and config.local_confidence and local[1] >= config.local_confidence:
+            logger.info(f"[{state.name}] Local prediction ({local[1]:.0%} sure): {local[0]}")
+            return f"`{local[0]}`"
+
+        built = state.prompts.build(config, contents, context)
+        response = await self.query_ai(config, prompt, built.messages, cache_key)
+        if response is None:
+            if local and config.local_fallback:
+                logger.info(f"[{state.name}] Model unavailable, using local prediction: {local[0]}")
+                return f"`{local[0]}`"
+            return None
+        state.prompts.commit(built)
+        self.predictor.compare(local[0] if local else None, extract_command(response))
+        return response
+
+    async def hold(self, state: WatchedSession):
+        """Wait until the session has been idle for its full threshold
+
+        A speculative answer can arrive early; tick() cancels this task if a
+        pane wakes up in the meantime.
+        """
+        while True:
+            idle = state.idle_seconds(time.time())
+            if idle is not None and idle > state.threshold:
+                return
+            await asyncio.sleep(CHECK_INTERVAL if idle is None else state.threshold - idle + 0.05)
+
+    async def deliver(self, state: WatchedSession, pane_id: str, command: str):
+        """Type a suggested command into a pane and remember it"""
+        await self.tmux.command(f"send-keys -t {pane_id} -l {quote_tmux(command)}")
+        await self.tmux.command(f"send-keys -t {pane_id} Enter")
+        logger.info(f"[{state.name}] Sent to {pane_id}: {command}")
+
+        self.context_manager.record_command(command)
+        state.last_command = command
+        state.suggestions += 1
+
+    def circuit_status(self, state: WatchedSession, breakers: Dict[str, str]) -> str:
+        """Breaker state of each endpoint the session's persona uses"""
+        config, _ = self.personas.get(state.persona)
+        circuits = dict.fromkeys(circuit_name(e.api_endpoint, e.model) for e in persona_endpoints(config))
+        return " ".join(breakers.get(circuit, "closed") for circuit in circuits)
+
+    def display_status(self):
+        """Display one row per watched session"""
+        table = Table(title=f"Sage Daemon - {datetime.now().strftime('%H:%M:%S')} 🧙")
+        table.add_column("Session", style="cyan")
+        table.add_column("Persona", style="magenta")
+        table.add_column("Panes", justify="right")
+        table.add_column("Idle", style="green")
+        table.add_column("Threshold", style="yellow", justify="right")
+        table.add_column("Circuit", style="blue")
+        table.add_column("Last Suggestion", style="dim", overflow="ellipsis", no_wrap=True)
+
+        now = time.time()
+        breakers = GUARDS.status()
+        for state in self.sessions.values():
+            idle = state.idle_seconds(now)
+            if state.query is not None:
+                status = "Thinking 🧠"
+            elif idle is None:
+                status = f"Active 🚀 ({len(state.idle_start)}/{len(state.panes)} idle)"
+            else:
+                status = f"Idle 😴 {idle:.0f}s"
+            table.add_row(
+                state.name, state.persona, str(len(state.panes)), status,
+                f"{state.threshold}s", self.circuit_status(state, breakers), state.last_command
+            )
+
+        stats = self.cache.stats()
+        table.caption = (
+            f"💾 Cache {stats['hits']} hits / {stats['misses']} misses  "
+            f"≈ {self.similar_index.hits} near hits  "
+            f"📋 {sum(len(s.candidates) for s in self.sessions.values())} queued  "
+            f"🎯 Local {self.predictor.agreements}/{self.predictor.predictions} agree  "
+            f"✂️ ~{sum(s.prompts.total_saved for s in self.sessions.values())} tokens saved"
+        )
+
+        console.clear()
+        console.print(table)
+
+    async def run(self):
+        """Main scheduler loop"""
+        self.check_personas()
+        await self.tmux.start()
+        try:
+            while self.tmux.alive:
+                await self.tick()
+                self.display_status()
+                await asyncio.sleep(CHECK_INTERVAL)
+            console.print("[red]tmux control connection closed[/red]")
+        finally:
+            for state in self.sessions.values():
+                if state.query and not state.query.done():
+                    state.query.cancel()
+            await self.tmux.close()
+            await HTTP_POOL.aclose()
+            ROUTER.log_summary()
+
+
+def parse_sessions(specs: List[str]) -> Dict[str, str]:
+    """Parse 'session' or 'session:persona' arguments"""
+    sessions = {}
+    for spec in specs:
+        name, _, persona = spec.partition(":")
+        sessions[name] = persona
+    return sessions
+
+
+def main():
+    """Daemon entry point"""
+    parser = argparse.ArgumentParser(
+        description="Sage daemon - monitor many tmux sessions from one process",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  sage_daemon.py --all                  # Every session on the server
+  sage_daemon.py omni --sessions dev ops   # Two sessions, Omni persona
+  sage_daemon.py --sessions dev:trisha ops:claude-code
+        """
+    )
+    parser.add_argument("persona", nargs="?", default="helpful", help="Default persona (default: helpful)")
+    parser.add_argument("--sessions", "-s", nargs="+", default=[], help="Sessions to watch, optionally as session:persona")
+    parser.add_argument("--all", "-a", action="store_true", help="Watch every session on the tmux server")
+    parser.add_argument("--speculate", type=float, nargs="?", const=0.0, metavar="FRACTION",
+                        help="Start queries at this fraction of the idle threshold (no value: at first idle)")
+    args = parser.parse_args()
+
+    if not args.sessions and not args.all:
+        args.sessions = [os.environ.get("SAGE_SESSION", "my-session")]
+
+    create_default_personas()
+    requested = {
+        name: persona or args.persona
+        for name, persona in parse_sessions(args.sessions).items()
+    }
+
+    daemon = SageDaemon(requested, args.persona, watch_all=args.all, speculate=args.speculate)
+    log_file = daemon.context_manager.context_dir / f"sage_daemon_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.FileHandler(log_file)]
+    )
+
+    try:
+        asyncio.run(daemon.run())
+    except ValueError as e:
+        console.print(f"[red]Error: {e}[/red]")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        console.print("\n[yellow]Sage daemon terminated gracefully[/yellow]")
+
+
+if __name__ == "__main__":
+    main()
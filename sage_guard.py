@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Endpoint guards for Sage - client-side rate limiting and circuit breaking
+
+Every outgoing request (model endpoints and the 8q-is nexus) first asks its
+guard. A token bucket per origin spaces requests out and honours Retry-After
+on 429s; a circuit breaker per endpoint URL and model opens after repeated
+429/5xx/transport failures so calls fail fast, then lets a single probe
+through (half-open) once the reset timeout has passed. Breakers are finer
+than buckets so one failing model doesn't cut off the hedge and fallback
+endpoints that share its origin.
+"""
+
+import logging
+import math
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+if TYPE_CHECKING:
+    from sage_http import PoolSettings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# Used for callers without persona http settings (e.g. the 8q-is client)
+DEFAULT_RATE = 2.0          # requests per second
+DEFAULT_BURST = 5
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0  # seconds
+DEFAULT_MAX_WAIT = 30.0
+
+
+class CircuitOpenError(Exception):
+    """The endpoint's circuit breaker is open; the request was not sent"""
+
+
+class RateLimitedError(Exception):
+    """The endpoint's rate limit would delay the request past its deadline"""
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `burst` saved up"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float = math.inf) -> float:
+        """Take a token, returning how long to wait before using it
+
+        When that wait would exceed max_wait no token is taken, so a request
+        turned away doesn't push later ones further back.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            after = self.tokens - 1
+            wait = max(-after / self.rate if after < 0 else 0.0, self.paused_until - now)
+            if wait <= max_wait:
+                self.tokens = after
+            return wait
+
+    def pause(self, seconds: float):
+        """Hold every request back for a while (server asked us to slow down)"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """closed -> open after `threshold` failures in a row -> half-open after `reset_timeout`"""
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker lets a probe through"""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self, name: str):
+        """Raise CircuitOpenError unless a request may go out now"""
+        with self._lock:
+            state = self.state
+            if state == OPEN or (state == HALF_OPEN and self.probing):
+                raise CircuitOpenError(f"{name} circuit open, retry in {self.retry_in():.0f}s")
+            if state == HALF_OPEN:
+                self.probing = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """A request ended without telling us anything about the endpoint"""
+        with self._lock:
+            self.probing = False
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None  # HTTP-date form; fall back to the breaker
+
+
+class EndpointGuard:
+    """Circuit breaker for one endpoint and model, with its origin's rate limiter"""
+
+    def __init__(self, name: str, bucket: Optional[TokenBucket] = None,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.bucket = bucket or TokenBucket(DEFAULT_RATE, DEFAULT_BURST)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.rejected = 0
+
+    def admit(self, max_wait: float = DEFAULT_MAX_WAIT) -> float:
+        """Check the breaker and take a rate-limit token; returns the delay to sleep first"""
+        try:
+            self.breaker.allow(self.name)
+        except CircuitOpenError:
+            self.rejected += 1
+            raise
+        wait = self.bucket.reserve(max_wait)
+        if wait > max_wait:
+            self.breaker.release()
+            self.rejected += 1
+            raise RateLimitedError(f"{self.name} rate limited for another {wait:.0f}s")
+        return wait
+
+    def record(self, status: Optional[int], error: Optional[BaseException] = None,
+               retry_after: Optional[str] = None):
+        """Feed the outcome of an admitted request back into the breaker"""
+        if status == 429:
+            pause = _retry_after(retry_after)
+            if pause:
+                self.bucket.pause(pause)
+            self.breaker.failure()
+        elif status is not None and status >= 500:
+            self.breaker.failure()
+        elif status is not None:
+            self.breaker.success()
+        elif error is not None and _is_transport_error(error):
+            self.breaker.failure()
+        else:
+            self.breaker.release()
+        if self.breaker.state != CLOSED:
+            logger.warning(f"{self.name} circuit {self.breaker.state} after {self.breaker.failures} failures")
+
+    def describe(self) -> str:
+        state = self.breaker.state
+        if state == OPEN:
+            return f"{state} ({self.breaker.retry_in():.0f}s)"
+        return state
+
+
+def _is_transport_error(error: BaseException) -> bool:
+    # Timeouts, refused connections, resets: the endpoint is unhealthy. Anything
+    # else (cancellation, our own bugs) says nothing about it.
+    return isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError))
+
+
+def endpoint_origin(url: str) -> str:
+    """scheme://host[:port] of an endpoint URL"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def circuit_name(url: str, model: Optional[str] = None) -> str:
+    """Key of the breaker guarding one endpoint URL and model"""
+    return f"{url} [{model}]" if model else url
+
+
+class GuardRegistry:
+    """One rate limiter per origin and one breaker per endpoint and model, shared process-wide"""
+
+    def __init__(self):
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._guards: Dict[Tuple[str, Optional[str]], EndpointGuard] = {}
+        self._lock = threading.Lock()
+
+    def for_url(self, url: str, settings: Optional["PoolSettings"] = None,
+                model: Optional[str] = None) -> EndpointGuard:
+        """Guard for an endpoint and model, created from the first caller's settings"""
+        origin = endpoint_origin(url)
+        with self._lock:
+            if origin not in self._buckets:
+                self._buckets[origin] = (TokenBucket(settings.rate_limit, settings.burst) if settings
+                                         else TokenBucket(DEFAULT_RATE, DEFAULT_BURST))
+            key = (url, model)
+            if key not in self._guards:
+                if settings is None:
+                    self._guards[key] = EndpointGuard(circuit_name(url, model), self._buckets[origin])
+                else:
+                    self._guards[key] = EndpointGuard(
+                        circuit_name(url, model), self._buckets[origin],
+                        settings.failure_threshold, settings.reset_timeout,
+                    )
+            return self._guards[key]
+
+    def status(self) -> Dict[str, str]:
+        """Breaker state per circuit_name() for status displays"""
+        with self._lock:
+            return {guard.name: guard.describe() for guard in self._guards.values()}
+
+
+# Process-wide guards shared by every persona, session and client
+GUARDS = GuardRegistry()
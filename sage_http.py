@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+HTTP transport for Sage - long-lived, pooled clients per model endpoint
+
+Every persona and session talking to the same origin shares one client, so
+DNS, TCP and TLS are paid once and kept alive between suggestions. Each
+request records per-phase timings (connect, TLS, first byte, total).
+"""
+
+import asyncio
+import importlib.util
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, Optional, Tuple
+
+import httpx
+
+from sage_guard import GUARDS, CircuitOpenError, RateLimitedError, endpoint_origin
+
+logger = logging.getLogger(__name__)
+
+# Timings kept for display and benchmarks
+TIMING_HISTORY = 200
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+@dataclass
+class PoolSettings:
+    """Connection pool configuration, read from the `http:` block of a persona .yml"""
+    max_connections: int = 10
+    max_keepalive_connections: int = 5
+    keepalive_expiry: float = 120.0
+    http2: bool = False
+    warmup: bool = True
+    timeout: float = 30.0
+    rate_limit: float = 2.0        # requests per second per origin
+    burst: int = 5
+    failure_threshold: int = 5     # failures in a row before the circuit opens
+    reset_timeout: float = 30.0    # seconds before a half-open probe
+
+    @classmethod
+    def from_config(cls, data: Optional[Dict[str, Any]]) -> "PoolSettings":
+        """Build settings from a persona's http config, ignoring unknown keys"""
+        data = data or {}
+        settings = cls(**{k: v for k, v in data.items() if k in cls.__dataclass_fields__})
+        # The rate limiter divides by the rate and needs room for at least one token
+        for name in ("rate_limit", "burst"):
+            value = getattr(settings, name)
+            if not value > 0:
+                default = cls.__dataclass_fields__[name].default
+                logger.warning(f"http.{name} must be positive, using {default} instead of {value!r}")
+                setattr(settings, name, default)
+        return settings
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+
+@dataclass
+class RequestTiming:
+    """Where the time of one request went (seconds; None when the phase didn't happen)"""
+    endpoint: str
+    connect: Optional[float] = None
+    tls: Optional[float] = None
+    first_byte: Optional[float] = None
+    total: float = 0.0
+    status: Optional[int] = None
+
+    @property
+    def reused(self) -> bool:
+        """True when the request rode on an already-open connection"""
+        return self.connect is None
+
+    def describe(self) -> str:
+        def ms(value):
+            return "-" if value is None else f"{value * 1000:.0f}ms"
+        return (
+            f"connect {ms(self.connect)}, tls {ms(self.tls)}, first byte {ms(self.first_byte)}, "
+            f"total {ms(self.total)}{' (reused)' if self.reused else ''}"
+        )
+
+
+class _PhaseTracer:
+    """httpcore trace callback turning connection events into a RequestTiming"""
+
+    def __init__(self, endpoint: str):
+        self.timing = RequestTiming(endpoint=endpoint)
+        self.started = time.perf_counter()
+        self._marks: Dict[str, float] = {}
+
+    def __call__(self, event_name: str, info: Dict[str, Any]):
+        now = time.perf_counter()
+        if event_name.endswith(".started"):
+            self._marks[event_name[:-len(".started")]] = now
+            return
+        if not event_name.endswith(".complete"):
+            return
+        phase = event_name[:-len(".complete")]
+        began = self._marks.get(phase, self.started)
+        if phase == "connection.connect_tcp":
+            self.timing.connect = now - began
+        elif phase == "connection.start_tls":
+            self.timing.tls = now - began
+        elif phase.endswith("receive_response_headers"):
+            self.timing.first_byte = now - self.started
+
+    async def async_trace(self, event_name: str, info: Dict[str, Any]):
+        self(event_name, info)
+
+    def finish(self, status: Optional[int] = None) -> RequestTiming:
+        self.timing.total = time.perf_counter() - self.started
+        self.timing.status = status
+        return self.timing
+
+
+def _record_guard(guard, response: Optional[httpx.Response], error: Optional[BaseException]):
+    if response is None:
+        guard.record(None, error)
+    else:
+        guard.record(response.status_code, retry_after=response.headers.get("retry-after"))
+
+
+def _request_model(kwargs: Dict[str, Any]) -> Optional[str]:
+    # Chat completion bodies name their model; each model gets its own circuit breaker
+    body = kwargs.get("json")
+    return body.get("model") if isinstance(body, dict) else None
+
+
+class ClientPool:
+    """Shared httpx clients keyed by endpoint origin"""
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, bool], httpx.Client] = {}
+        self._async_clients: Dict[Tuple[str, bool], httpx.AsyncClient] = {}
+        self._lock = threading.Lock()
+        self.timings: Deque[RequestTiming] = deque(maxlen=TIMING_HISTORY)
+
+    def _key(self, endpoint: str, settings: PoolSettings) -> Tuple[str, bool]:
+        http2 = settings.http2 and HTTP2_AVAILABLE
+        if settings.http2 and not HTTP2_AVAILABLE:
+            logger.warning("http2 requested but the 'h2' package isn't installed; using HTTP/1.1")
+        return endpoint_origin(endpoint), http2
+
+    def client(self, endpoint: str, settings: PoolSettings) -> httpx.Client:
+        """Long-lived client for an endpoint's origin"""
+        key = self._key(endpoint, settings)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = httpx.Client(
+                    limits=settings.limits(), http2=key[1], timeout=settings.timeout
+                )
+            return self._clients[key]
+
+    def async_client(self, endpoint: str, settings: PoolSettings) -> httpx.AsyncClient:
+        """Long-lived asyncio client for an endpoint's origin"""
+        key = self._key(endpoint, settings)
+        with self._lock:
+            if key not in self._async_clients:
+                self._async_clients[key] = httpx.AsyncClient(
+                    limits=settings.limits(), http2=key[1], timeout=settings.timeout
+                )
+            return self._async_clients[key]
+
+    def _record(self, tracer: _PhaseTracer, status: Optional[int]) -> RequestTiming:
+        timing = tracer.finish(status)
+        self.timings.append(timing)
+        logger.info(f"HTTP {timing.endpoint}: {timing.describe()}")
+        return timing
+
+    def request(self, method: str, endpoint: str, settings: PoolSettings, **kwargs) -> httpx.Response:
+        """Send a request on the pooled client, recording phase timings
+
+        Raises CircuitOpenError/RateLimitedError without sending when the
+        origin's guard says no.
+        """
+        guard = GUARDS.for_url(endpoint, settings, _request_model(kwargs))
+        time.sleep(guard.admit(settings.timeout))
+        tracer = _PhaseTracer(endpoint)
+        kwargs.setdefault("timeout", settings.timeout)
+        response = error = None
+        try:
+            response = self.client(endpoint, settings).request(
+                method, endpoint, extensions={"trace": tracer}, **kwargs
+            )
+            return response
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record(tracer, response.status_code if response is not None else None)
+            _record_guard(guard, response, error)
+
+    def post(self, endpoint: str, settings: PoolSettings, **kwargs) -> httpx.Response:
+        return self.request("POST", endpoint, settings, **kwargs)
+
+    async def arequest(self, method: str, endpoint: str, settings: PoolSettings, **kwargs) -> httpx.Response:
+        """Asyncio flavour of request()"""
+        guard = GUARDS.for_url(endpoint, settings, _request_model(kwargs))
+        await asyncio.sleep(guard.admit(settings.timeout))
+        tracer = _PhaseTracer(endpoint)
+        kwargs.setdefault("timeout", settings.timeout)
+        response = error = None
+        try:
+            response = await self.async_client(endpoint, settings).request(
+                method, endpoint, extensions={"trace": tracer.async_trace}, **kwargs
+            )
+            return response
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record(tracer, response.status_code if response is not None else None)
+            _record_guard(guard, response, error)
+
+    async def apost(self, endpoint: str, settings: PoolSettings, **kwargs) -> httpx.Response:
+        return await self.arequest("POST", endpoint, settings, **kwargs)
+
+    def stream_events(self, endpoint: str, settings: PoolSettings, **kwargs) -> Iterator[str]:
+        """POST and yield server-sent event data payloads as they arrive
+
+        Closing the generator early closes the response; the connection is
+        dropped rather than drained, which is the point when the rest of the
+        answer isn't wanted.
+        """
+        guard = GUARDS.for_url(endpoint, settings, _request_model(kwargs))
+        time.sleep(guard.admit(settings.timeout))
+        tracer = _PhaseTracer(endpoint)
+        kwargs.setdefault("timeout", settings.timeout)
+        status = error = None
+        try:
+            with self.client(endpoint, settings).stream(
+                "POST", endpoint, extensions={"trace": tracer}, **kwargs
+            ) as response:
+                status = response.status_code
+                _record_guard(guard, response, None)
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        return
+                    yield payload
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record(tracer, status)
+            if status is None:
+                _record_guard(guard, None, error)
+
+    async def astream_events(self, endpoint: str, settings: PoolSettings, **kwargs) -> AsyncIterator[str]:
+        """Asyncio flavour of stream_events()"""
+        guard = GUARDS.for_url(endpoint, settings, _request_model(kwargs))
+        await asyncio.sleep(guard.admit(settings.timeout))
+        tracer = _PhaseTracer(endpoint)
+        kwargs.setdefault("timeout", settings.timeout)
+        status = error = None
+        try:
+            async with self.async_client(endpoint, settings).stream(
+                "POST", endpoint, extensions={"trace": tracer.async_trace}, **kwargs
+            ) as response:
+                status = response.status_code
+                _record_guard(guard, response, None)
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        return
+                    yield payload
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record(tracer, status)
+            if status is None:
+                _record_guard(guard, None, error)
+
+    def warm_up(self, endpoint: str, settings: PoolSettings) -> Optional[RequestTiming]:
+        """Open a connection ahead of the first real request"""
+        try:
+            self.request("HEAD", endpoint_origin(endpoint) + "/", settings)
+            return self.timings[-1]
+        except (httpx.HTTPError, CircuitOpenError, RateLimitedError) as e:
+            logger.debug(f"Warm-up of {endpoint} failed: {e}")
+            return None
+
+    async def awarm_up(self, endpoint: str, settings: PoolSettings) -> Optional[RequestTiming]:
+        """Asyncio flavour of warm_up()"""
+        try:
+            await self.arequest("HEAD", endpoint_origin(endpoint) + "/", settings)
+            return self.timings[-1]
+        except (httpx.HTTPError, CircuitOpenError, RateLimitedError) as e:
+            logger.debug(f"Warm-up of {endpoint} failed: {e}")
+            return None
+
+    def close(self):
+        """Close the synchronous clients"""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+    async def aclose(self):
+        """Close the asyncio clients"""
+        with self._lock:
+            clients = list(self._async_clients.values())
+            self._async_clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+# Process-wide pool shared by every persona and session
+HTTP_POOL = ClientPool()
@@ -0,0 +1,1032 @@
+#!/usr/bin/env python3
+"""
+Markqant (.mq) compression for Sage personas and project contexts
+"""
+
+import argparse
+import bz2
+import codecs
+import hashlib
+import heapq
+import importlib.util
+import io
+import lzma
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Match, Optional, Pattern, Tuple, Union
+
+# Markqant token definitions
+MARKQANT_TOKENS = {
+    "T00": "# ",
+    "T01": "## ",
+    "T02": "### ",
+    "T03": "#### ",
+    "T04": "```",
+    "T05": "```\n",
+    "T06": "- ",
+    "T07": "* ",
+    "T08": "1. ",
+    "T09": "> ",
+    "T0A": "**",
+    "T0B": "*",
+    "T0C": "---",
+    "T0D": "\n\n",
+    "T0E": "| ",
+}
+
+# Literal "T" followed by two hex digits is written as this token plus the
+# two digits, so no original text can be mistaken for a token when decoding
+ESCAPE_TOKEN = "T0F"
+ESCAPED_FLAG = "-escaped"
+TOKEN_REF = re.compile(r"T[0-9A-F]{2}")
+NEEDS_ESCAPE = r"T(?=[0-9A-F]{2})"
+
+# Binary container: fixed header, length-prefixed dictionary, raw payload
+#   magic, version, flags, dictionary entries, timestamp, original size, payload size
+BINARY_MAGIC = b"MQB1"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sBBHdQQ")
+#   token id, pattern length (followed by the UTF-8 pattern)
+BINARY_ENTRY = struct.Struct("<BH")
+FLAG_ZLIB = 0x01
+FLAG_ESCAPED = 0x02
+FLAG_SHARED = 0x04  # a SHARED_REFERENCE follows the header
+FLAG_STREAMED = 0x08  # sizes unknown when the header was written; payload runs to the end
+# Payload formats other than zlib, in bits 4-5 (FLAG_ZLIB and none of these is zlib, neither is raw)
+FLAG_LZMA = 0x10
+FLAG_BZ2 = 0x20
+FLAG_ZSTD = 0x30
+CODEC_BITS = 0x30
+# The document's own tokens were dropped because the codec alone came out smaller;
+# the payload uses static and shared tokens only and the dictionary is empty
+FLAG_CODEC_ONLY = 0x40
+COMPRESSED_FLAGS = FLAG_ZLIB | CODEC_BITS
+KNOWN_FLAGS = FLAG_ZLIB | FLAG_ESCAPED | FLAG_SHARED | FLAG_STREAMED | CODEC_BITS | FLAG_CODEC_ONLY
+
+# Streaming: bytes read per step
+STREAM_CHUNK = 256 * 1024
+
+# Shared dictionaries (<name>-<digest>.mqd): token table plus a zlib preset
+#   magic, token count, preset length; then BINARY_ENTRY tokens and the preset
+SHARED_MAGIC = b"MQD1"
+SHARED_HEADER = struct.Struct("<4sHI")
+SHARED_DIGEST_SIZE = 8
+#   dictionary name (NUL padded), digest of the dictionary file
+SHARED_REFERENCE = struct.Struct(f"<16s{SHARED_DIGEST_SIZE}s")
+SHARED_TOKENS = 128  # the rest of T10-TFF stays free for per-file tokens
+ZDICT_SIZE = 16 * 1024
+
+# Payloads this short are stored as they are; any codec's framing would outweigh its savings
+STORED_PAYLOAD = 64
+
+# Automatic codec choice: payloads up to SMALL_PAYLOAD use the first codec
+# for the target, larger ones the second (zstd replaces zlib there when installed)
+AUTO_CODEC = "auto"
+SMALL_PAYLOAD = 16 * 1024
+AUTO_CODECS = {
+    "speed": ("zlib-1", "zlib-1"),
+    "balanced": ("zlib-6", "zlib-6"),
+    "ratio": ("zlib-9", "lzma"),
+}
+ZSTD_AUTO_CODECS = {"speed": "zstd-1", "balanced": "zstd-3"}
+DEFAULT_TARGET = "balanced"
+ZSTD_AVAILABLE = importlib.util.find_spec("zstandard") is not None
+
+# Dynamic tokens T10-TFF
+FIRST_DYNAMIC_TOKEN = 0x10
+MAX_DYNAMIC_TOKENS = 0x100 - FIRST_DYNAMIC_TOKEN
+TOKEN_LENGTH = 3
+
+# Static tokens worth writing; the others are no shorter than the pattern
+# they stand for and are only expanded when reading
+SAVING_TOKENS = {token: pattern for token, pattern in MARKQANT_TOKENS.items() if len(pattern) > TOKEN_LENGTH}
+
+# Words longer than 5 characters, i.e. the candidates for dynamic tokens
+LONG_WORD = re.compile(r"\w{6,}")
+MIN_WORD_COUNT = 3
+
+# Savings-based dictionaries: phrases of up to this many words on one line
+WORD = re.compile(r"\w{4,}")
+NON_SPACE = re.compile(r"\S+")
+MAX_PHRASE_WORDS = 4
+# Longer inputs are sampled (evenly spaced, whole lines) to build the dictionary
+DICTIONARY_SAMPLE = 256 * 1024
+SAMPLE_CHUNKS = 16
+
+
+def _token_id(token: str) -> int:
+    return int(token[1:], 16)
+
+
+def _token_name(token_id: int) -> str:
+    return f"T{token_id:02X}"
+
+
+def _persona_name(content: str) -> str:
+    # Persona files start with "# <Name> Persona"
+    name_match = re.match(r'#\s+(.+)\s+Persona', content)
+    return name_match.group(1) if name_match else "Unknown"
+
+
+def _trie_regex(node: Dict[str, dict]) -> str:
+    branches = [re.escape(char) + _trie_regex(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    # A pattern may end here; the greedy "?" still tries the longer ones first
+    return f"(?:{body})?" if "" in node else body
+
+
+def pattern_matcher(patterns: Iterable[str]) -> Pattern:
+    """One regex matching any of the patterns, leftmost-longest, or a "T" needing escape
+
+    The alternation is laid out as a trie, so each position costs at most
+    one character comparison per pattern character instead of one attempt
+    per pattern.
+    """
+    trie: Dict[str, dict] = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return re.compile(f"{_trie_regex(trie)}|{NEEDS_ESCAPE}")
+
+
+_STATIC_MATCHER = pattern_matcher(SAVING_TOKENS.values())
+
+
+def tokenize(content: str, dynamic_tokens: Dict[str, str]) -> str:
+    """Replace patterns with tokens in one scan, preferring the longest at each position
+
+    A "T" that would read as a token is escaped instead.
+    """
+    reverse_tokens = {v: k for k, v in {**SAVING_TOKENS, **dynamic_tokens}.items()}
+    matcher = pattern_matcher(reverse_tokens) if dynamic_tokens else _STATIC_MATCHER
+    return matcher.sub(lambda m: reverse_tokens.get(m.group(), ESCAPE_TOKEN), content)
+
+
+def expand_tokens(compressed: str, all_tokens: Dict[str, str]) -> str:
+    """Replace every token with its pattern in one scan; expanded text is never rescanned"""
+    return TOKEN_REF.sub(lambda m: all_tokens.get(m.group(), m.group()), compressed)
+
+
+def expand_tokens_sequential(compressed: str, all_tokens: Dict[str, str]) -> str:
+    """The decoder for unescaped files: one replace pass per token, in table order
+
+    Their compressor replaced patterns one after another, so a token can sit
+    inside text that a later pass turned into another token ("T11. " became
+    "T1T08"); only undoing the passes in turn takes those apart again.
+    """
+    for token in sorted(all_tokens, key=len, reverse=True):
+        compressed = compressed.replace(token, all_tokens[token])
+    return compressed
+
+
+class _Stored:
+    """Compressor and decompressor for payloads kept as they are"""
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+# Matched by type: zstandard's decompressor has an unconsumed_tail too, but no max_length
+_ZLIB_DECOMPRESSOR = type(zlib.decompressobj())
+
+
+class _Inflater:
+    """Incremental decompression with a cap on each piece of output, whatever the format"""
+
+    def __init__(self, unpacker: Any):
+        self.unpacker = unpacker
+
+    def feed(self, data: bytes, max_length: int = -1) -> Iterator[bytes]:
+        unpacker = self.unpacker
+        if isinstance(unpacker, (lzma.LZMADecompressor, bz2.BZ2Decompressor)):
+            # These keep unread input inside; asking again with nothing new drains it
+            yield unpacker.decompress(data, max_length)
+            while not unpacker.eof and not unpacker.needs_input:
+                yield unpacker.decompress(b"", max_length)
+        elif isinstance(unpacker, _ZLIB_DECOMPRESSOR):
+            limit = max(max_length, 0)  # zlib spells "no limit" 0
+            yield unpacker.decompress(data, limit)
+            while unpacker.unconsumed_tail:
+                yield unpacker.decompress(unpacker.unconsumed_tail, limit)
+        else:
+            yield unpacker.decompress(data)
+
+    def flush(self) -> bytes:
+        if isinstance(self.unpacker, (lzma.LZMADecompressor, bz2.BZ2Decompressor)):
+            return b""
+        return self.unpacker.flush()
+
+
+# Raw LZMA2: the .xz framing costs ~60 bytes, which small payloads can't afford
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+
+
+def _zlib_codec(level: int) -> Tuple[Callable[[Optional[bytes]], Any], Callable[[Optional[bytes]], Any]]:
+    return (lambda zdict: zlib.compressobj(level, zdict=zdict) if zdict else zlib.compressobj(level),
+            lambda zdict: zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj())
+
+
+def _zstd_codec(level: int) -> Tuple[Callable[[Optional[bytes]], Any], Callable[[Optional[bytes]], Any]]:
+    # zstandard is optional; it is only imported when a zstd codec is used
+    def compressor(zdict: Optional[bytes]) -> Any:
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    def decompressor(zdict: Optional[bytes]) -> Any:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    return compressor, decompressor
+
+
+@dataclass(frozen=True)
+class Codec:
+    """A payload format at one setting, identified in the header by its flag bits
+
+    Only zlib uses the shared dictionary's preset; the others ignore it.
+    """
+    name: str
+    flags: int
+    compressor: Callable[[Optional[bytes]], Any]
+    decompressor: Callable[[Optional[bytes]], Any]
+
+    def compress(self, data: bytes, zdict: Optional[bytes] = None) -> bytes:
+        packer = self.compressor(zdict)
+        return packer.compress(data) + packer.flush()
+
+
+# Codecs by name, for MarkqantProcessor(codec=...) and --codec
+CODECS: Dict[str, Codec] = {}
+# Decompressor for each format's flag bits
+PAYLOAD_FORMATS: Dict[int, Callable[[Optional[bytes]], Any]] = {}
+# Header flag naming each format in the text MARKQANT_V1 format ("-zlib", ...)
+TEXT_FORMAT_FLAGS = {FLAG_ZLIB: "zlib", FLAG_LZMA: "lzma", FLAG_BZ2: "bz2", FLAG_ZSTD: "zstd"}
+
+
+def register_codec(codec: Codec):
+    """Make a codec available by name (later registrations of a name win)"""
+    CODECS[codec.name] = codec
+    PAYLOAD_FORMATS[codec.flags & COMPRESSED_FLAGS] = codec.decompressor
+
+
+register_codec(Codec("raw", 0, lambda zdict: _Stored(), lambda zdict: _Stored()))
+for _level in (1, 6, 9):
+    register_codec(Codec(f"zlib-{_level}", FLAG_ZLIB, *_zlib_codec(_level)))
+register_codec(Codec(
+    "lzma", FLAG_LZMA,
+    lambda zdict: lzma.LZMACompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS),
+    lambda zdict: lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS),
+))
+register_codec(Codec("bz2", FLAG_BZ2, lambda zdict: bz2.BZ2Compressor(9), lambda zdict: bz2.BZ2Decompressor()))
+if ZSTD_AVAILABLE:
+    for _level in (1, 3, 19):
+        register_codec(Codec(f"zstd-{_level}", FLAG_ZSTD, *_zstd_codec(_level)))
+
+
+def choose_codec(size: int, target: str = DEFAULT_TARGET, zdict: Optional[bytes] = None) -> Codec:
+    """Codec for a payload of this many bytes, given a speed/ratio target"""
+    if target not in AUTO_CODECS:
+        raise ValueError(f"Unknown codec target '{target}' (choose from {', '.join(AUTO_CODECS)})")
+    if size <= STORED_PAYLOAD and not zdict:
+        return CODECS["raw"]
+    if size <= SMALL_PAYLOAD:
+        # With a trained preset, zlib beats everything at these sizes
+        return CODECS["zlib-9" if zdict else AUTO_CODECS[target][0]]
+    name = AUTO_CODECS[target][1]
+    if ZSTD_AVAILABLE and target in ZSTD_AUTO_CODECS:
+        name = ZSTD_AUTO_CODECS[target]
+    return CODECS[name]
+
+
+def resolve_codec(name: str, size: int, target: str = DEFAULT_TARGET, zdict: Optional[bytes] = None) -> Codec:
+    """The named codec, or the automatic choice for this payload size"""
+    if name == AUTO_CODEC:
+        return choose_codec(size, target, zdict)
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}' (available: {', '.join([AUTO_CODEC, *CODECS])})")
+    return CODECS[name]
+
+
+def pack_payload(compressed: str, zdict: Optional[bytes] = None, codec: str = AUTO_CODEC,
+                 target: str = DEFAULT_TARGET) -> Tuple[bytes, int]:
+    """Tokenized text as payload bytes, compressed when that is smaller, with its flags"""
+    # Stored raw rather than hex-encoded, so compression pays off from the first byte saved
+    payload = compressed.encode('utf-8')
+    chosen = resolve_codec(codec, len(payload), target, zdict)
+    if chosen.flags & COMPRESSED_FLAGS:
+        packed = chosen.compress(payload, zdict)
+        if len(packed) < len(payload):
+            return packed, FLAG_ESCAPED | chosen.flags
+    return payload, FLAG_ESCAPED
+
+
+def payload_inflater(flags: int, zdict: Optional[bytes] = None) -> _Inflater:
+    """Incremental decompressor for a payload written with these header flags"""
+    decompressor = PAYLOAD_FORMATS.get(flags & COMPRESSED_FLAGS)
+    if decompressor is None:
+        raise ValueError(f"Payload needs a codec that isn't available (flags {flags:#04x}; is zstandard installed?)")
+    return _Inflater(decompressor(zdict))
+
+
+def unpack_payload(payload: bytes, flags: int, zdict: Optional[bytes] = None) -> bytes:
+    """Payload bytes back to tokenized UTF-8, whichever codec wrote them"""
+    inflater = payload_inflater(flags, zdict)
+    return b"".join(inflater.feed(payload)) + inflater.flush()
+
+
+def frequency_dictionary(content: str, limit: int = MAX_DYNAMIC_TOKENS) -> List[str]:
+    """Words longer than 5 characters seen 3+ times, most frequent first"""
+    words = []
+    for word, count in Counter(LONG_WORD.findall(content)).most_common(limit):
+        if count < MIN_WORD_COUNT:
+            break
+        words.append(word)
+    return words
+
+
+def entry_savings(pattern: str, count: int) -> int:
+    """Net bytes saved by a dynamic token: every use, less its dictionary entry"""
+    length = len(pattern.encode('utf-8'))
+    return (length - TOKEN_LENGTH) * count - (BINARY_ENTRY.size + length)
+
+
+def dictionary_sample(content: str, size: int = DICTIONARY_SAMPLE) -> str:
+    """Evenly spaced whole-line chunks of content adding up to about size characters"""
+    if len(content) <= size:
+        return content
+    chunk = size // SAMPLE_CHUNKS
+    stride = len(content) // SAMPLE_CHUNKS
+    pieces = []
+    for i in range(SAMPLE_CHUNKS):
+        start = content.find("\n", i * stride) + 1
+        end = content.rfind("\n", start, start + chunk)
+        if start and end > start:
+            pieces.append(content[start:end])
+    return "\n".join(pieces)
+
+
+def _phrase_counts(text: str) -> Counter:
+    # Every run of 1..MAX_PHRASE_WORDS non-space words on one line, with the
+    # text between them kept as is, plus plain words inside punctuation
+    counts: Counter = Counter(WORD.findall(text))
+    for line in text.splitlines():
+        spans = [m.span() for m in NON_SPACE.finditer(line)]
+        for i, (start, _) in enumerate(spans):
+            for _, end in spans[i:i + MAX_PHRASE_WORDS]:
+                counts[line[start:end]] += 1
+    return counts
+
+
+def savings_dictionary(content: str, limit: int = MAX_DYNAMIC_TOKENS) -> List[str]:
+    """Words and phrases chosen greedily by net bytes saved, best first
+
+    After each pick its occurrences are blanked out of a working copy, so
+    candidates overlapping it are re-scored on what is left (lazily: a
+    candidate is only recounted when it reaches the top of the heap, which
+    is sound because picks can only lower other candidates' savings).
+    """
+    sample = dictionary_sample(content)
+    if not sample:
+        return []
+    scale = len(content) / len(sample)
+    static = set(SAVING_TOKENS.values())
+    heap = []
+    for pattern, count in _phrase_counts(sample).items():
+        if count > 1 and pattern not in static:
+            savings = entry_savings(pattern, round(count * scale))
+            if savings > 0:
+                heap.append((-savings, pattern))
+    heapq.heapify(heap)
+
+    working = sample
+    chosen = []
+    while heap and len(chosen) < limit:
+        _, pattern = heapq.heappop(heap)
+        savings = entry_savings(pattern, round(working.count(pattern) * scale))
+        if savings <= 0:
+            continue
+        if heap and savings < -heap[0][0]:
+            heapq.heappush(heap, (-savings, pattern))  # no longer the best; retry later
+            continue
+        chosen.append(pattern)
+        working = working.replace(pattern, "\0")
+    return chosen
+
+
+def _pack_tokens(tokens: Dict[str, str]) -> bytes:
+    parts = []
+    for token, pattern in tokens.items():
+        encoded = pattern.encode('utf-8')
+        parts.append(BINARY_ENTRY.pack(_token_id(token), len(encoded)))
+        parts.append(encoded)
+    return b"".join(parts)
+
+
+def _unpack_tokens(view: memoryview, offset: int, entries: int) -> Tuple[Dict[str, str], int]:
+    tokens = {}
+    for _ in range(entries):
+        token_id, length = BINARY_ENTRY.unpack_from(view, offset)
+        offset += BINARY_ENTRY.size
+        tokens[_token_name(token_id)] = str(view[offset:offset + length], 'utf-8')
+        offset += length
+    return tokens, offset
+
+
+@dataclass
+class SharedDictionary:
+    """Token table and zlib preset trained once and referenced by many files"""
+    name: str
+    tokens: Dict[str, str]
+    zdict: bytes
+
+    def to_bytes(self) -> bytes:
+        header = SHARED_HEADER.pack(SHARED_MAGIC, len(self.tokens), len(self.zdict))
+        return header + _pack_tokens(self.tokens) + self.zdict
+
+    @property
+    def digest(self) -> bytes:
+        """8-byte content hash; files record it so a retrained dictionary is never misapplied"""
+        return hashlib.blake2b(self.to_bytes(), digest_size=SHARED_DIGEST_SIZE).digest()
+
+    @classmethod
+    def from_bytes(cls, name: str, data: bytes) -> "SharedDictionary":
+        with memoryview(data) as view:
+            magic, entries, zdict_size = SHARED_HEADER.unpack_from(view)
+            if magic != SHARED_MAGIC:
+                raise ValueError(f"Not a Markqant shared dictionary: {name}")
+            tokens, offset = _unpack_tokens(view, SHARED_HEADER.size, entries)
+            zdict = bytes(view[offset:offset + zdict_size])
+        return cls(name, tokens, zdict)
+
+
+def train_shared_dictionary(name: str, documents: List[str], limit: int = SHARED_TOKENS,
+                            zdict_size: int = ZDICT_SIZE) -> SharedDictionary:
+    """Train a shared dictionary on a set of documents (personas, contexts)
+
+    Tokens are chosen by savings over the whole set, since their entries are
+    paid for once rather than in every file. The zlib preset is built from
+    the documents as they look after tokenizing, with lines that recur
+    across documents last, where zlib's back-references reach them cheapest.
+    """
+    if len(name.encode()) > 16:
+        raise ValueError(f"Shared dictionary name '{name}' is longer than 16 bytes")
+    patterns = savings_dictionary("\n".join(documents), limit)
+    tokens = {_token_name(FIRST_DYNAMIC_TOKEN + i): pattern for i, pattern in enumerate(patterns)}
+    tokenized = [tokenize(document, tokens) for document in documents]
+    lines = Counter(line for document in tokenized for line in set(document.splitlines()) if len(line) > TOKEN_LENGTH)
+    recurring = sorted((line for line, count in lines.items() if count > 1), key=lambda line: (lines[line], len(line)))
+    zdict = ("\n".join(tokenized) + "\n" + "\n".join(recurring)).encode('utf-8')[-zdict_size:]
+    return SharedDictionary(name, tokens, zdict)
+
+
+class DictionaryStore:
+    """Shared dictionaries on disk, one immutable file per name and digest
+
+    Safe to share between threads and processes: files are never modified
+    once written, and a new one only appears under its name when complete.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._loaded: Dict[Tuple[str, bytes], SharedDictionary] = {}
+
+    def path_for(self, name: str, digest: bytes) -> Path:
+        return self.directory / f"{name}-{digest.hex()}.mqd"
+
+    def save(self, dictionary: SharedDictionary) -> Path:
+        """Write a dictionary; it becomes the latest one under its name"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path_for(dictionary.name, dictionary.digest)
+        tmp = path.with_suffix(f".tmp{os.getpid()}")
+        tmp.write_bytes(dictionary.to_bytes())
+        os.replace(tmp, path)
+        self._loaded[(dictionary.name, dictionary.digest)] = dictionary
+        return path
+
+    def get(self, name: str, digest: bytes) -> SharedDictionary:
+        """The exact dictionary a file was written with"""
+        key = (name, digest)
+        if key not in self._loaded:
+            path = self.path_for(name, digest)
+            if not path.exists():
+                raise ValueError(f"Shared dictionary {path.name} not found in {self.directory}")
+            dictionary = SharedDictionary.from_bytes(name, path.read_bytes())
+            if dictionary.digest != digest:
+                raise ValueError(f"Shared dictionary {path.name} does not match its digest")
+            self._loaded[key] = dictionary
+        return self._loaded[key]
+
+    def latest(self, name: str) -> Optional[SharedDictionary]:
+        """Most recently trained dictionary with this name, if any"""
+        candidates = list(self.directory.glob(f"{name}-*.mqd")) if self.directory.exists() else []
+        if not candidates:
+            return None
+        newest = max(candidates, key=lambda path: path.stat().st_mtime)
+        return self.get(name, bytes.fromhex(newest.stem[len(name) + 1:]))
+
+
+def _read_exact(source: BinaryIO, size: int) -> bytes:
+    data = source.read(size)
+    if len(data) != size:
+        raise ValueError(f"Truncated Markqant stream ({len(data)} of {size} bytes)")
+    return data
+
+
+def _read_text(source: BinaryIO, chunk_size: int, prefix: bytes = b"") -> Iterator[str]:
+    # UTF-8 is decoded incrementally, so a character split between reads is kept whole
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    if prefix:
+        yield decoder.decode(prefix)
+    for data in iter(lambda: source.read(chunk_size), b""):
+        yield decoder.decode(data)
+    yield decoder.decode(b"", final=True)
+
+
+def _stream_sample(source: BinaryIO, size: int = DICTIONARY_SAMPLE) -> Tuple[str, bytes]:
+    """Text to build a dictionary from, and bytes already read that still need encoding
+
+    A seekable source is sampled in evenly spaced whole-line pieces and
+    rewound; anything else contributes its first `size` bytes, which are
+    handed back to be encoded first.
+    """
+    if not source.seekable():
+        prefix = source.read(size)
+        return prefix.decode('utf-8', 'ignore'), prefix
+    start = source.tell()
+    length = source.seek(0, io.SEEK_END) - start
+    if length <= size:
+        source.seek(start)
+        prefix = source.read()
+        return prefix.decode('utf-8', 'ignore'), prefix
+    pieces = []
+    for i in range(SAMPLE_CHUNKS):
+        source.seek(start + i * (length // SAMPLE_CHUNKS))
+        lines = source.read(size // SAMPLE_CHUNKS).decode('utf-8', 'ignore').split("\n")
+        pieces.append("\n".join(lines[1:-1]))  # drop the partial first and last lines
+    source.seek(start)
+    return "\n".join(pieces), b""
+
+
+def _scan_chunks(chunks: Iterable[str], pattern: Pattern, replace: Callable[[Match], str],
+                 margin: int) -> Iterator[str]:
+    """pattern.sub(replace, ...) over text arriving in chunks
+
+    Each step only rewrites matches starting more than `margin` characters
+    before the end of what has arrived (margin covers the longest match and
+    its lookahead, so those matches are final); the rest is carried over
+    and scanned again with the next chunk. Output equals a whole-text sub.
+    """
+    carry = ""
+    for chunk in chunks:
+        text = carry + chunk
+        limit = len(text) - margin
+        out, pos = [], 0
+        for match in pattern.finditer(text):
+            if match.start() >= limit:
+                break
+            out.append(text[pos:match.start()])
+            out.append(replace(match))
+            pos = match.end()
+        cut = max(pos, limit)
+        out.append(text[pos:cut])
+        carry = text[cut:]
+        yield "".join(out)
+    yield pattern.sub(replace, carry)
+
+
+# Dictionary builders by name, for MarkqantProcessor(dictionary=...)
+DICTIONARY_BUILDERS: Dict[str, Callable[[str, int], List[str]]] = {
+    "savings": savings_dictionary,
+    "frequency": frequency_dictionary,
+}
+
+
+@dataclass
+class PersonaContext:
+    """Context and personality from .mq file"""
+    name: str
+    personality: str
+    compressed_content: str
+    original_size: int
+    compressed_size: int
+    timestamp: datetime
+
+@dataclass
+class BatchResult:
+    """One file written by a batch compress or decompress"""
+    source: Path
+    target: Path
+    original_size: int
+    stored_size: int
+
+
+class MarkqantProcessor:
+    """Handles Markqant (.mq) format compression and decompression
+
+    Holds configuration only: every document gets its own token table, so
+    one processor can be shared across calls and threads.
+    """
+
+    def __init__(self, dictionary: str = "savings", dictionaries: Optional[DictionaryStore] = None,
+                 shared: Optional[str] = None, codec: str = AUTO_CODEC, target: str = DEFAULT_TARGET):
+        self.dictionary = dictionary
+        self.build_dictionary = DICTIONARY_BUILDERS[dictionary]
+        self.dictionaries = dictionaries
+        self.shared = shared  # name of the shared dictionary to write with, if trained
+        resolve_codec(codec, 0, target)  # unknown names fail here rather than on first write
+        self.codec = codec
+        self.target = target
+
+    def shared_dictionary(self) -> Optional[SharedDictionary]:
+        """The latest shared dictionary to write with, if one is configured and trained"""
+        if self.dictionaries is None or self.shared is None:
+            return None
+        return self.dictionaries.latest(self.shared)
+
+    def compress(self, content: str, shared: Optional[SharedDictionary] = None) -> Tuple[str, Dict[str, str]]:
+        """Compress markdown content to Markqant format in a single scan
+
+        With a shared dictionary its tokens come first and only what they
+        leave uncovered is considered for this document's own tokens. The
+        returned token table includes the shared tokens.
+        """
+        dynamic_tokens = self._assign_tokens(content, shared)
+        return tokenize(content, dynamic_tokens), dynamic_tokens
+
+    def _assign_tokens(self, content: str, shared: Optional[SharedDictionary]) -> Dict[str, str]:
+        dynamic_tokens = dict(shared.tokens) if shared else {}
+        residual = content
+        if shared and shared.tokens:
+            residual = pattern_matcher(shared.tokens.values()).sub("\0", content)
+
+        # Assign dynamic tokens to the dictionary's patterns, best first, after any shared ones
+        next_token_id = FIRST_DYNAMIC_TOKEN + len(dynamic_tokens)
+        known = set(dynamic_tokens.values())
+        for pattern in self.build_dictionary(residual, 0x100 - next_token_id):
+            if pattern in known or "\0" in pattern:
+                continue
+            dynamic_tokens[_token_name(next_token_id)] = pattern
+            next_token_id += 1
+        return dynamic_tokens
+
+    def decompress(self, compressed: str, dynamic_tokens: Dict[str, str], escaped: bool = True,
+                   shared: Optional[SharedDictionary] = None) -> str:
+        """Decompress Markqant content back to markdown in a single scan
+
+        Expanded text is never scanned again, so the cost is linear in the
+        input however many tokens the dictionary holds. Pass escaped=False
+        for files written before tokens were escaped; those are decoded the
+        way they were written, one token at a time.
+        """
+        all_tokens = {**MARKQANT_TOKENS, **(shared.tokens if shared else {}), **dynamic_tokens}
+        if not escaped:
+            return expand_tokens_sequential(compressed, all_tokens)
+        all_tokens[ESCAPE_TOKEN] = "T"
+        return expand_tokens(compressed, all_tokens)
+
+    def create_mq_file(self, content: str, filename: str) -> str:
+        """Create a complete .mq file with header"""
+        compressed, dynamic_tokens = self.compress(content)
+
+        # Build token dictionary
+        token_dict = "\n".join([f"{k}={v}" for k, v in dynamic_tokens.items()])
+
+        # Calculate sizes
+        original_size = len(content.encode('utf-8'))
+        compressed_size = len(compressed.encode('utf-8'))
+
+        # Create header
+        header = f"MARKQANT_V1 {datetime.now().isoformat()}Z {original_size} {compressed_size} {ESCAPED_FLAG}"
+
+        # Compressed (hex-encoded) if beneficial, flagged with the format's name
+        payload, flags = pack_payload(compressed, codec=self.codec, target=self.target)
+        if flags & COMPRESSED_FLAGS:
+            header += f" -{TEXT_FORMAT_FLAGS[flags & COMPRESSED_FLAGS]}"
+            compressed = payload.hex()
+            compressed_size = len(payload)
+
+        # Build complete file
+        mq_content = f"{header}\n"
+        if token_dict:
+            mq_content += f"{token_dict}\n"
+        mq_content += "---\n"
+        mq_content += compressed
+
+        return mq_content
+
+    def parse_mq_file(self, mq_content: str) -> PersonaContext:
+        """Parse a text .mq file and return decompressed content"""
+        # Only the header and dictionary are split into lines; the payload is
+        # sliced off after the "---" separator as is (including any trailing
+        # whitespace, which is part of the content)
+        header, _, rest = mq_content.partition('\n')
+        if rest.startswith("---\n") or rest == "---":
+            token_block, compressed = "", rest[4:]
+        else:
+            separator = rest.index("\n---\n") if "\n---\n" in rest else rest.index("\n---")
+            token_block, compressed = rest[:separator], rest[separator + 5:]
+
+        # Parse header
+        header_parts = header.split()
+        version = header_parts[0]
+        timestamp = datetime.fromisoformat(header_parts[1].rstrip('Z'))
+        original_size = int(header_parts[2])
+        compressed_size = int(header_parts[3])
+        flags = header_parts[4:] if len(header_parts) > 4 else []
+
+        # Parse dynamic tokens
+        dynamic_tokens = {}
+        for line in token_block.splitlines():
+            if '=' in line:
+                token, pattern = line.split('=', 1)
+                dynamic_tokens[token] = pattern
+
+        # Handle a compressed payload
+        for bits, name in TEXT_FORMAT_FLAGS.items():
+            if f"-{name}" in flags:
+                compressed = unpack_payload(bytes.fromhex(compressed), bits).decode('utf-8')
+
+        # Decompress
+        content = self.decompress(compressed, dynamic_tokens, escaped=ESCAPED_FLAG in flags)
+
+        return PersonaContext(
+            name=_persona_name(content),
+            personality=content,
+            compressed_content=compressed,
+            original_size=original_size,
+            compressed_size=compressed_size,
+            timestamp=timestamp
+        )
+
+    def create_mq_binary(self, content: str) -> bytes:
+        """Create a binary .mq/.m8 container: header, dictionary, raw payload"""
+        shared = self.shared_dictionary()
+        shared_tokens = shared.tokens if shared else {}
+        zdict = shared.zdict if shared else None
+
+        compressed, dynamic_tokens = self.compress(content, shared)
+        own_tokens = {t: p for t, p in dynamic_tokens.items() if t not in shared_tokens}
+        payload, flags = pack_payload(compressed, zdict, self.codec, self.target)
+        if flags & COMPRESSED_FLAGS and own_tokens:
+            # The codec already finds the repeats a dictionary replaces, and usually
+            # does better without tokens in the way; keep whichever is smaller
+            plain, plain_flags = pack_payload(tokenize(content, shared_tokens), zdict, self.codec, self.target)
+            if len(plain) <= len(payload) + len(_pack_tokens(own_tokens)):
+                payload, flags, own_tokens = plain, plain_flags | FLAG_CODEC_ONLY, {}
+
+        if shared:
+            flags |= FLAG_SHARED
+        parts = [BINARY_HEADER.pack(
+            BINARY_MAGIC, BINARY_VERSION, flags, len(own_tokens),
+            datetime.now().timestamp(), len(content.encode('utf-8')), len(payload),
+        )]
+        if shared:
+            parts.append(SHARED_REFERENCE.pack(shared.name.encode(), shared.digest))
+        parts.append(_pack_tokens(own_tokens))
+        parts.append(payload)
+        return b"".join(parts)
+
+    def parse_mq_binary(self, data: Union[bytes, bytearray, memoryview, mmap.mmap]) -> PersonaContext:
+        """Parse a binary container from any buffer without copying the payload first"""
+        with memoryview(data) as view:
+            magic, version, flags, entries, timestamp, original_size, payload_size = \
+                BINARY_HEADER.unpack_from(view)
+            if magic != BINARY_MAGIC or version > BINARY_VERSION or flags & ~KNOWN_FLAGS:
+                raise ValueError(f"Not a binary Markqant v{BINARY_VERSION} container")
+
+            offset = BINARY_HEADER.size
+            shared = None
+            if flags & FLAG_SHARED:
+                name, digest = SHARED_REFERENCE.unpack_from(view, offset)
+                offset += SHARED_REFERENCE.size
+                name = name.rstrip(b"\0").decode()
+                if self.dictionaries is None:
+                    raise ValueError(f"Container needs shared dictionary '{name}' but no store is configured")
+                shared = self.dictionaries.get(name, digest)
+            dynamic_tokens, offset = _unpack_tokens(view, offset, entries)
+
+            if flags & FLAG_STREAMED:
+                payload_size = len(view) - offset
+
+            # Released on exit, so an mmap passed in can be closed right after
+            with view[offset:offset + payload_size] as payload:
+                if len(payload) != payload_size:
+                    raise ValueError(f"Truncated Markqant container ({len(payload)} of {payload_size} payload bytes)")
+                if flags & COMPRESSED_FLAGS:
+                    compressed = unpack_payload(payload, flags, shared.zdict if shared else None).decode('utf-8')
+                else:
+                    compressed = str(payload, 'utf-8')
+
+        content = self.decompress(compressed, dynamic_tokens, escaped=bool(flags & FLAG_ESCAPED), shared=shared)
+        return PersonaContext(
+            name=_persona_name(content),
+            personality=content,
+            compressed_content=compressed,
+            original_size=len(content.encode('utf-8')) if flags & FLAG_STREAMED else original_size,
+            compressed_size=payload_size,
+            timestamp=datetime.fromtimestamp(timestamp)
+        )
+
+    def read_mq_file(self, path: Path) -> PersonaContext:
+        """Read a .mq/.m8 file in either the binary or the text MARKQANT_V1 format"""
+        with open(path, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                f.seek(0)
+                return self.parse_mq_file(f.read().decode('utf-8'))
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return self.parse_mq_binary(mapped)
+
+    def write_mq_file(self, path: Path, content: str):
+        """Write content to path as a binary container"""
+        with open(path, 'wb') as f:
+            f.write(self.create_mq_binary(content))
+
+    def write_mq_files(self, documents: Dict[Path, str], workers: Optional[int] = None) -> List[BatchResult]:
+        """Write many documents (path -> content) as containers across a process pool"""
+        return self._run_batch(_write_document, list(documents.items()), workers)
+
+    def compress_files(self, jobs: Iterable[Tuple[Path, Path]], workers: Optional[int] = None) -> List[BatchResult]:
+        """Compress (text file, container) pairs across a process pool"""
+        return self._run_batch(_compress_file, list(jobs), workers)
+
+    def decompress_files(self, jobs: Iterable[Tuple[Path, Path]], workers: Optional[int] = None) -> List[BatchResult]:
+        """Decompress (.mq/.m8 file, text file) pairs across a process pool"""
+        return self._run_batch(_decompress_file, list(jobs), workers)
+
+    def _run_batch(self, task: Callable, jobs: List[tuple], workers: Optional[int]) -> List[BatchResult]:
+        # workers=1 (or a single job) runs here, without starting any processes
+        workers = min(workers or os.cpu_count() or 1, len(jobs))
+        if workers <= 1:
+            return [task(self, *job) for job in jobs]
+        settings = (self.dictionary, self.dictionaries.directory if self.dictionaries else None,
+                    self.shared, self.codec, self.target)
+        # A few chunks per worker: small files don't pay a round trip each, and
+        # uneven sizes still balance out
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(workers, initializer=_start_batch_worker, initargs=settings) as pool:
+            return list(pool.map(_run_batch_job, [task] * len(jobs), jobs, chunksize=chunksize))
+
+    def compress_stream(self, source: BinaryIO, chunk_size: int = STREAM_CHUNK) -> Iterator[bytes]:
+        """Compress a UTF-8 byte stream into a streamed binary container, chunk by chunk
+
+        The dictionary is built from a sample of the input, so memory stays
+        bounded by the chunk size however long the input is. The length isn't
+        known up front, so an automatic codec is the one for large payloads.
+        """
+        shared = self.shared_dictionary()
+        sample, prefix = _stream_sample(source)
+        dynamic_tokens = self._assign_tokens(sample, shared)
+        shared_tokens = shared.tokens if shared else {}
+        own_tokens = {t: p for t, p in dynamic_tokens.items() if t not in shared_tokens}
+        zdict = shared.zdict if shared else None
+        codec = resolve_codec(self.codec, SMALL_PAYLOAD + 1, self.target, zdict)
+
+        flags = FLAG_ESCAPED | FLAG_STREAMED | codec.flags | (FLAG_SHARED if shared else 0)
+        yield BINARY_HEADER.pack(
+            BINARY_MAGIC, BINARY_VERSION, flags, len(own_tokens), datetime.now().timestamp(), 0, 0
+        )
+        if shared:
+            yield SHARED_REFERENCE.pack(shared.name.encode(), shared.digest)
+        yield _pack_tokens(own_tokens)
+
+        reverse_tokens = {v: k for k, v in {**SAVING_TOKENS, **dynamic_tokens}.items()}
+        matcher = pattern_matcher(reverse_tokens)
+        margin = max(map(len, reverse_tokens)) + 2  # longest pattern plus the escape lookahead
+        packer = codec.compressor(zdict)
+        chunks = _read_text(source, chunk_size, prefix)
+        for text in _scan_chunks(chunks, matcher, lambda m: reverse_tokens.get(m.group(), ESCAPE_TOKEN), margin):
+            packed = packer.compress(text.encode('utf-8'))
+            if packed:
+                yield packed
+        yield packer.flush()
+
+    def decompress_stream(self, source: BinaryIO, chunk_size: int = STREAM_CHUNK) -> Iterator[bytes]:
+        """Decompress a binary container (streamed or not) from a byte stream, chunk by chunk"""
+        header = _read_exact(source, BINARY_HEADER.size)
+        magic, version, flags, entries, _, _, payload_size = BINARY_HEADER.unpack(header)
+        if magic != BINARY_MAGIC or version > BINARY_VERSION or flags & ~KNOWN_FLAGS:
+            raise ValueError(f"Not a binary Markqant v{BINARY_VERSION} container")
+
+        all_tokens = dict(MARKQANT_TOKENS)
+        zdict = None
+        if flags & FLAG_SHARED:
+            name, digest = SHARED_REFERENCE.unpack(_read_exact(source, SHARED_REFERENCE.size))
+            name = name.rstrip(b"\0").decode()
+            if self.dictionaries is None:
+                raise ValueError(f"Container needs shared dictionary '{name}' but no store is configured")
+            shared = self.dictionaries.get(name, digest)
+            all_tokens.update(shared.tokens)
+            zdict = shared.zdict
+        for _ in range(entries):
+            token_id, length = BINARY_ENTRY.unpack(_read_exact(source, BINARY_ENTRY.size))
+            all_tokens[_token_name(token_id)] = _read_exact(source, length).decode('utf-8')
+        if flags & FLAG_ESCAPED:
+            all_tokens[ESCAPE_TOKEN] = "T"
+
+        def payload() -> Iterator[bytes]:
+            remaining = None if flags & FLAG_STREAMED else payload_size
+            inflater = payload_inflater(flags, zdict)
+            while remaining is None or remaining > 0:
+                data = source.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                # Capped per call: a highly compressed chunk could otherwise expand a hundredfold
+                yield from inflater.feed(data, chunk_size)
+            if remaining:
+                raise ValueError(f"Truncated Markqant container ({remaining} payload bytes missing)")
+            yield inflater.flush()
+
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = (decoder.decode(data) for data in payload())
+        expand = lambda m: all_tokens.get(m.group(), m.group())
+        for text in _scan_chunks(chunks, TOKEN_REF, expand, TOKEN_LENGTH - 1):
+            if text:
+                yield text.encode('utf-8')
+
+
+# Each batch worker process builds its processor once, from the parent's settings
+_batch_processor: Optional[MarkqantProcessor] = None
+
+
+def _start_batch_worker(dictionary: str, directory: Optional[Path], shared: Optional[str], codec: str, target: str):
+    global _batch_processor
+    store = DictionaryStore(directory) if directory else None
+    _batch_processor = MarkqantProcessor(dictionary, store, shared, codec, target)
+
+
+def _run_batch_job(task: Callable, job: tuple) -> BatchResult:
+    return task(_batch_processor, *job)
+
+
+def _write_document(processor: MarkqantProcessor, target: Path, content: str) -> BatchResult:
+    processor.write_mq_file(target, content)
+    return BatchResult(target, target, len(content.encode('utf-8')), target.stat().st_size)
+
+
+def _compress_file(processor: MarkqantProcessor, source: Path, target: Path) -> BatchResult:
+    content = source.read_bytes().decode('utf-8')  # not read_text: line endings must survive
+    processor.write_mq_file(target, content)
+    return BatchResult(source, target, len(content.encode('utf-8')), target.stat().st_size)
+
+
+def _decompress_file(processor: MarkqantProcessor, source: Path, target: Path) -> BatchResult:
+    content = processor.read_mq_file(source).personality
+    target.write_bytes(content.encode('utf-8'))
+    return BatchResult(source, target, len(content.encode('utf-8')), source.stat().st_size)
+
+
+def _open_stream(path: str, mode: str) -> BinaryIO:
+    if path == "-":
+        return sys.stdin.buffer if "r" in mode else sys.stdout.buffer
+    return open(path, mode)
+
+
+def main():
+    """Markqant command line: stream-compress or decompress files"""
+    parser = argparse.ArgumentParser(description="Markqant (.mq) compression")
+    parser.add_argument("--dictionaries", type=Path, default=Path.home() / ".sage" / "dictionaries",
+                        help="Directory of shared dictionaries")
+    parser.add_argument("--shared", help="Shared dictionary to compress with (default: none)")
+    parser.add_argument("--codec", default=AUTO_CODEC, choices=[AUTO_CODEC, *CODECS],
+                        help="Payload codec to compress with (default: auto)")
+    parser.add_argument("--target", default=DEFAULT_TARGET, choices=list(AUTO_CODECS),
+                        help="What the auto codec favours (default: balanced)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("compress", "Compress text to a streamed .mq container"),
+                            ("decompress", "Decompress a binary .mq/.m8 container")):
+        command = sub.add_parser(name, help=help_text)
+        command.add_argument("input", help="Input file, or - for stdin")
+        command.add_argument("output", help="Output file, or - for stdout")
+        command.add_argument("--chunk-size", type=int, default=STREAM_CHUNK, help="Bytes read per step")
+
+    args = parser.parse_args()
+    processor = MarkqantProcessor(dictionaries=DictionaryStore(args.dictionaries), shared=args.shared,
+                                  codec=args.codec, target=args.target)
+    stream = processor.compress_stream if args.command == "compress" else processor.decompress_stream
+    with _open_stream(args.input, "rb") as source, _open_stream(args.output, "wb") as target:
+        for data in stream(source, args.chunk_size):
+            target.write(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Local command predictor for Sage - naive Bayes over pane-state features
+
+Learns from .sage_proj/interactions.jsonl (pane state -> command the model
+chose, in order, so the previous command is a feature too) and answers in
+microseconds without any network. It can sit in front of the remote model,
+stand in for it when every endpoint is down, or be a persona of its own
+(api_endpoint: local).
+"""
+
+import json
+import logging
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from sage_ai import extract_command
+from sage_cache import normalize_pane_text
+from sage_prompt import PROMPT_HEADER
+
+logger = logging.getLogger(__name__)
+
+# Persona api_endpoint that means "only ever ask the local predictor"
+LOCAL_ENDPOINT = "local"
+
+SMOOTHING = 0.1
+# Classes scored even without a shared feature, so a strong prior can still win
+PRIOR_CANDIDATES = 5
+
+# "$ git status", "user@host:~/p$ make test", "❯ cargo build"
+SHELL_COMMAND = re.compile(r"[$#%>❯]\s+([a-z][\w.-]*)(?:[ \t]+([a-z][\w.-]*))?")
+WORD = re.compile(r"[a-z][a-z_-]{2,19}")
+
+
+def state_features(prompt: str, previous: Optional[str] = None) -> Set[str]:
+    """Words, commands run and the previous suggestion, as a feature set"""
+    text = normalize_pane_text(prompt)
+    if text.startswith(PROMPT_HEADER.strip()):
+        text = text[len(PROMPT_HEADER.strip()):]
+    text = text.lower()
+    features = {"w:" + word for word in WORD.findall(text)}
+    for command, argument in SHELL_COMMAND.findall(text):
+        features.add("ran:" + command)
+        if argument:
+            features.add(f"ran:{command} {argument}")
+    if previous:
+        features.add("prev:" + previous)
+    return features
+
+
+class CommandPredictor:
+    """Incrementally trained naive Bayes classifier from pane state to command"""
+
+    def __init__(self, log_path: Optional[Path] = None):
+        self.log_path = log_path
+        self.examples = 0
+        self.class_counts: Counter = Counter()
+        self.feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        self.predictions = 0
+        self.agreements = 0
+        self._previous: Optional[str] = None
+        self._read_offset = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.examples
+
+    def learn(self, prompt: str, command: str):
+        """Add one (pane state, chosen command) example"""
+        for feature in state_features(prompt, self._previous):
+            self.feature_counts[feature][command] += 1
+        self.class_counts[command] += 1
+        self.examples += 1
+        self._previous = command
+
+    def refresh(self):
+        """Learn from interactions appended to the log since the last read"""
+        if self.log_path is None or not self.log_path.exists():
+            return
+        with self._lock, open(self.log_path, 'rb') as f:
+            f.seek(self._read_offset)
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    break  # half-written last line; retry next time
+                self._read_offset += len(line)
+                try:
+                    entry = json.loads(line)
+                    self.learn(entry["prompt"], extract_command(entry["response"]))
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def rank(self, prompt: str, previous: Optional[str] = None, k: int = 3) -> List[Tuple[str, float]]:
+        """Top-k commands with posterior probabilities"""
+        features = state_features(prompt, previous)
+        with self._lock:
+            if not self.examples:
+                return []
+            return self._rank(features, k)
+
+    def _rank(self, features: Set[str], k: int) -> List[Tuple[str, float]]:
+        # Score = log prior + sum over features of log P(feature | command). Only
+        # commands sharing a feature get the co-occurrence bonus, so the work is
+        # proportional to the postings touched rather than to every command.
+        bonus: Counter = Counter()
+        for feature in features:
+            for command, count in self.feature_counts.get(feature, {}).items():
+                bonus[command] += math.log((count + SMOOTHING) / SMOOTHING)
+        candidates = set(bonus) | {c for c, _ in self.class_counts.most_common(PRIOR_CANDIDATES)}
+        scores = {}
+        for command in candidates:
+            seen = self.class_counts[command]
+            scores[command] = (
+                math.log(seen / self.examples)
+                + len(features) * math.log(SMOOTHING / (seen + 2 * SMOOTHING))
+                + bonus[command]
+            )
+        best = max(scores.values())
+        weights = {c: math.exp(s - best) for c, s in scores.items()}
+        total = sum(weights.values())
+        ranked = sorted(weights.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(command, weight / total) for command, weight in ranked]
+
+    def predict(self, prompt: str, previous: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        """Most likely command and its probability, or None before any training"""
+        ranked = self.rank(prompt, previous, k=1)
+        return ranked[0] if ranked else None
+
+    def compare(self, predicted: Optional[str], actual: str):
+        """Count how often the local guess matches the remote model's command"""
+        if predicted is None:
+            return
+        self.predictions += 1
+        if predicted == actual:
+            self.agreements += 1
+
+    def hit_rate(self) -> float:
+        return self.agreements / self.predictions if self.predictions else 0.0
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Prompt assembly for Sage - token budgets, cross-pane dedupe and per-session deltas
+"""
+
+import logging
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from sage import PersonaConfig
+
+logger = logging.getLogger(__name__)
+
+PANE_LINES = 5
+RECENT_COMMANDS = 5
+DEFAULT_PROMPT_BUDGET = 1500  # tokens; 0 means unlimited
+
+# Rough token estimate without a tokenizer dependency: ~4 characters per token
+# for English and shell output, plus a few tokens of framing per chat message
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4
+
+PROMPT_HEADER = "Analyze these idle tmux panes and suggest ONE useful command:\n\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count of a piece of text"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def message_tokens(messages: List[Dict[str, str]]) -> int:
+    """Approximate token count of a list of chat messages"""
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+def pane_tail(content: str) -> List[str]:
+    """The last few lines of a pane"""
+    return content.strip().splitlines()[-PANE_LINES:]
+
+
+def summarize_pane(pane_id: str, content: str) -> str:
+    """Format the last few lines of a pane for the AI prompt"""
+    return f"Pane {pane_id}:\n" + "\n".join(pane_tail(content))
+
+
+def suggestion_prompt(summaries: List[str]) -> str:
+    """Prompt asking for one command given pane summaries"""
+    return PROMPT_HEADER + "\n\n".join(summaries)
+
+
+def build_messages(config: "PersonaConfig", prompt: str, context: Optional[Dict[str, Any]] = None,
+                   recent: int = RECENT_COMMANDS) -> List[Dict[str, str]]:
+    """Build the chat messages for a suggestion request
+
+    The system message holds only static persona text, so it is byte-identical
+    across calls and can be served from the provider's prompt cache; anything
+    that changes per call (recent commands, pane contents) goes in the final
+    user message.
+    """
+    if context and context.get("recent_commands") and recent > 0:
+        prompt = f"Recent commands: {', '.join(context['recent_commands'][-recent:])}\n\n{prompt}"
+    if config.candidates > 1:
+        prompt += (
+            f"\n\nReply with {config.candidates} alternative commands, best first, "
+            "one per line, each wrapped in backticks."
+        )
+    return [
+        {"role": "system", "content": config.system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+
+@dataclass
+class BuiltPrompt:
+    """Messages ready to send, with their estimated size"""
+    messages: List[Dict[str, str]]
+    tokens: int
+    naive_tokens: int
+    # Pane lines this prompt carried; they become the baseline once the model has seen them
+    tails: Optional[Dict[str, List[str]]] = None
+    sequence: int = 0
+
+    @property
+    def saved(self) -> int:
+        """Tokens saved compared with sending every pane's tail in full"""
+        return max(0, self.naive_tokens - self.tokens)
+
+
+@dataclass
+class _PaneSection:
+    pane_id: str
+    lines: List[str]
+    unchanged: List[str] = field(default_factory=list)
+    repeated: List[str] = field(default_factory=list)
+    trimmed: int = 0
+
+    def render(self) -> str:
+        notes = []
+        if self.unchanged:
+            notes.append(f"{len(self.unchanged)} unchanged since last query")
+        if self.repeated:
+            notes.append(f"{len(self.repeated)} same as another pane")
+        if self.trimmed:
+            notes.append(f"{self.trimmed} older")
+        text = f"Pane {self.pane_id}:"
+        if notes:
+            text += f" (lines omitted: {', '.join(notes)})"
+        return text + "".join("\n" + line for line in self.lines)
+
+
+class PromptBuilder:
+    """Builds one session's suggestion prompts within its persona's token budget
+
+    Each pane contributes its last few lines, minus blank lines, lines already
+    shown for another pane, and lines the previous query for this session
+    already carried (the prompt line is always kept). A query only counts as
+    carried once commit() says the model answered it. If that is still over
+    budget, older pane lines go first, then recent commands, and finally the
+    system prompt is cut to half the budget (a fixed cut, so the cacheable
+    prefix stays the same from call to call).
+    """
+
+    def __init__(self):
+        self.previous: Dict[str, List[str]] = {}
+        self.total_saved = 0
+        self._built = 0
+        self._committed = 0
+
+    def _sections(self, contents: Dict[str, str]) -> List[_PaneSection]:
+        seen = set()
+        sections = []
+        for pane_id, content in contents.items():
+            tail = pane_tail(content)
+            before = set(self.previous.get(pane_id, []))
+            section = _PaneSection(pane_id, [])
+            for i, line in enumerate(tail):
+                is_prompt = i == len(tail) - 1
+                if not line.strip():
+                    continue
+                if is_prompt:
+                    # Every pane keeps its prompt line, even when several sit at the same prompt
+                    section.lines.append(line)
+                    seen.add(line)
+                elif line in seen:
+                    section.repeated.append(line)
+                elif line in before:
+                    section.unchanged.append(line)
+                else:
+                    section.lines.append(line)
+                    seen.add(line)
+            sections.append(section)
+        return sections
+
+    def build(self, config: "PersonaConfig", contents: Dict[str, str],
+              context: Optional[Dict[str, Any]] = None) -> BuiltPrompt:
+        """Assemble the messages for the given pane contents (pane id -> text)"""
+        naive = build_messages(
+            config, suggestion_prompt([summarize_pane(pid, text) for pid, text in contents.items()]), context
+        )
+        sections = self._sections(contents)
+        self._built += 1
+
+        recent = RECENT_COMMANDS
+        system_prompt = config.system_prompt
+
+        def assemble() -> List[Dict[str, str]]:
+            messages = build_messages(
+                config, PROMPT_HEADER + "\n\n".join(s.render() for s in sections), context, recent
+            )
+            messages[0] = {"role": "system", "content": system_prompt}
+            return messages
+
+        messages = assemble()
+        budget = config.prompt_budget
+        while budget and message_tokens(messages) > budget:
+            longest = max(sections, key=lambda s: len(s.lines), default=None)
+            if longest is not None and len(longest.lines) > 1:
+                longest.lines.pop(0)
+                longest.trimmed += 1
+            elif recent > 0 and context and context.get("recent_commands"):
+                recent -= 1
+            elif len(system_prompt) > budget // 2 * CHARS_PER_TOKEN:
+                system_prompt = system_prompt[:budget // 2 * CHARS_PER_TOKEN]
+            else:
+                break
+            messages = assemble()
+
+        built = BuiltPrompt(messages, message_tokens(messages), message_tokens(naive),
+                            self._carried(sections), self._built)
+        self.total_saved += built.saved
+        logger.info(f"Prompt ~{built.tokens} tokens (saved ~{built.saved} of {built.naive_tokens})")
+        return built
+
+    @staticmethod
+    def _carried(sections: List[_PaneSection]) -> Dict[str, List[str]]:
+        """Per pane, the lines the model gets to see: rendered here or for another pane, or already carried"""
+        rendered = {line for section in sections for line in section.lines}
+        return {
+            s.pane_id: s.lines + [line for line in s.repeated if line in rendered] + s.unchanged
+            for s in sections
+        }
+
+    def commit(self, built: BuiltPrompt):
+        """The model answered this prompt: later prompts may leave out what it carried
+
+        A prompt that was cancelled, failed or never sent is simply not
+        committed. Answers arriving out of order never roll the baseline back.
+        """
+        if built.tails is not None and built.sequence > self._committed:
+            self.previous = built.tails
+            self._committed = built.sequence
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Endpoint routing for Sage - order a persona's model endpoints by observed latency
+
+A persona may list extra `endpoints:` next to its main api_endpoint/model. The
+router keeps per-endpoint latency samples, orders candidates by weighted
+median latency, and tells callers how long to wait before hedging with the
+next one (the p95 of the endpoint being waited on).
+"""
+
+import dataclasses
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from sage import PersonaConfig
+
+logger = logging.getLogger(__name__)
+
+LATENCY_SAMPLES = 50
+MIN_SAMPLES_FOR_P95 = 5
+DEFAULT_HEDGE_DELAY = 2.0  # seconds, until an endpoint has enough samples
+MIN_HEDGE_DELAY = 0.25
+MAX_HEDGE_DELAY = 10.0
+# Each consecutive failure counts as this many seconds of extra latency when ordering
+FAILURE_PENALTY = 5.0
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    """One model endpoint a persona can send suggestions to"""
+    api_endpoint: str
+    model: str
+    api_key: str
+    weight: float = 1.0
+
+    @property
+    def key(self) -> str:
+        return f"{self.model}@{self.api_endpoint}"
+
+    def apply(self, config: "PersonaConfig") -> "PersonaConfig":
+        """The persona config pointed at this endpoint"""
+        return dataclasses.replace(config, api_endpoint=self.api_endpoint, model=self.model, api_key=self.api_key)
+
+
+def persona_endpoints(config: "PersonaConfig") -> List[Endpoint]:
+    """The persona's main endpoint followed by any extra `endpoints:` from its .yml"""
+    endpoints = [Endpoint(config.api_endpoint, config.model, config.api_key)]
+    for extra in config.endpoints:
+        endpoints.append(Endpoint(
+            api_endpoint=extra.get("api_endpoint", config.api_endpoint),
+            model=extra.get("model", config.model),
+            api_key=extra.get("api_key", config.api_key),
+            weight=float(extra.get("weight", 1.0)),
+        ))
+    return endpoints
+
+
+class EndpointStats:
+    """Recent latencies and failures of one endpoint"""
+
+    def __init__(self):
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.wins = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def describe(self) -> str:
+        text = f"{self.requests} requests, {self.wins} wins, {self.failures} failures"
+        if self.latencies:
+            text += f", p50 {self.percentile(0.5) * 1000:.0f}ms, p95 {self.percentile(0.95) * 1000:.0f}ms"
+        return text
+
+
+class EndpointRouter:
+    """Latency bookkeeping and ordering for every endpoint in the process"""
+
+    def __init__(self):
+        self._stats: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def stats(self, endpoint: Endpoint) -> EndpointStats:
+        with self._lock:
+            return self._stats.setdefault(endpoint.key, EndpointStats())
+
+    def route(self, config: "PersonaConfig") -> List[Endpoint]:
+        """Endpoints to try, best first; ties keep their .yml order"""
+        def score(endpoint: Endpoint) -> float:
+            stats = self.stats(endpoint)
+            # Unsampled endpoints are assumed as fast as the default hedge delay
+            latency = stats.percentile(0.5) or DEFAULT_HEDGE_DELAY
+            return (latency + stats.consecutive_failures * FAILURE_PENALTY) / max(endpoint.weight, 1e-6)
+        return sorted(persona_endpoints(config), key=score)
+
+    def hedge_delay(self, endpoint: Endpoint) -> float:
+        """How long to give an endpoint before racing the next one"""
+        stats = self.stats(endpoint)
+        if len(stats.latencies) < MIN_SAMPLES_FOR_P95:
+            return DEFAULT_HEDGE_DELAY
+        return min(MAX_HEDGE_DELAY, max(MIN_HEDGE_DELAY, stats.percentile(0.95)))
+
+    def started(self, endpoint: Endpoint):
+        self.stats(endpoint).requests += 1
+
+    def succeeded(self, endpoint: Endpoint, latency: float):
+        stats = self.stats(endpoint)
+        stats.latencies.append(latency)
+        stats.consecutive_failures = 0
+
+    def won(self, endpoint: Endpoint):
+        self.stats(endpoint).wins += 1
+
+    def failed(self, endpoint: Endpoint):
+        stats = self.stats(endpoint)
+        stats.failures += 1
+        stats.consecutive_failures += 1
+
+    def summary(self) -> Dict[str, str]:
+        """Per-endpoint statistics for logs and status displays"""
+        with self._lock:
+            return {key: stats.describe() for key, stats in self._stats.items()}
+
+    def log_summary(self):
+        for key, description in self.summary().items():
+            logger.info(f"Endpoint {key}: {description}")
+
+
+# Process-wide router shared by every persona and session
+ROUTER = EndpointRouter()
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+"""
+Tmux I/O for Sage - batched pane snapshots, activity timestamps and
+control-mode event streams
+"""
+
+import asyncio
+import re
+import subprocess
+import threading
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Any, Tuple
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# How far back into the scrollback each capture reaches (same as capture-pane -S)
+CAPTURE_START = "-10"
+
+# Upper bound on panes per tmux invocation, keeps argv small on huge sessions
+MAX_PANES_PER_CALL = 64
+
+# Written by display-message before each pane's capture. The record separator
+# never appears in capture-pane output since we don't ask for escape sequences.
+SNAPSHOT_MARKER = "\x1eSAGE-PANE "
+
+# One list-panes call returns activity and foreground command for every pane.
+# pane_activity only exists in newer tmux; window_activity is the fallback and
+# is good enough since Sage waits for *all* panes to be idle anyway.
+ACTIVITY_FORMAT = "#{pane_id}\t#{pane_activity}\t#{window_activity}\t#{pane_current_command}"
+
+# Seconds without output before a pane is a candidate for idle
+ACTIVITY_STALE_SECONDS = 2.0
+
+# Foreground commands that sit at a prompt when idle
+PROMPT_COMMANDS = {
+    "bash", "zsh", "fish", "sh", "dash", "ksh", "tcsh", "csh", "nu", "xonsh",
+    "python", "python3", "ipython", "irb", "node", "psql", "mysql", "sqlite3",
+}
+
+# Shell prompt detection, checked against the last line of a pane
+IDLE_PATTERNS = [re.compile(p) for p in (
+    r".*[\$>#]\s*$",
+    r".*❯\s*$",
+    r".*→\s*$",
+    r".*\)\s*$",  # For custom prompts
+    r"^>>>.*$",    # Python REPL
+    r"^irb.*>.*$", # Ruby IRB
+)]
+
+# CSI / OSC / two-byte escape sequences in raw pane output
+ANSI_ESCAPE = re.compile(r"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])")
+
+# tmux control mode escapes bytes below 32 and backslash as \ooo
+CONTROL_ESCAPE = re.compile(rb"\\([0-7]{3})")
+
+# Bytes of raw output remembered per pane for prompt detection
+OUTPUT_TAIL_BYTES = 2048
+
+# Notifications after which the pane list is re-read
+LAYOUT_NOTIFICATIONS = (
+    "%window-add", "%window-close", "%unlinked-window-close",
+    "%layout-change", "%session-window-changed",
+)
+
+
+def quote_tmux(arg: str) -> str:
+    """Quote an argument for a command sent over a control connection"""
+    return '"' + arg.replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$") + '"'
+
+
+def looks_idle(last_line: str) -> bool:
+    """Check whether a pane's last line looks like a waiting prompt"""
+    return any(pattern.match(last_line) for pattern in IDLE_PATTERNS)
+
+
+def last_output_line(raw: bytes) -> str:
+    """Last non-blank line a terminal would show for raw pane output"""
+    text = ANSI_ESCAPE.sub("", raw.decode(errors="replace"))
+    for line in reversed(text.split("\n")):
+        # A carriage return moves back to column 0; what follows wins
+        line = line.rstrip("\r").split("\r")[-1]
+        if line.strip():
+            return line.strip()
+    return ""
+
+
+@dataclass
+class PaneSnapshot:
+    """Tail of every pane captured at one monitoring tick"""
+    panes: Dict[str, str] = field(default_factory=dict)
+    captured_at: float = 0.0
+    subprocess_calls: int = 0
+
+    def __contains__(self, pane_id: str) -> bool:
+        return pane_id in self.panes
+
+    def content(self, pane_id: str) -> str:
+        """Captured text for a pane ('' if it wasn't captured)"""
+        return self.panes.get(pane_id, "")
+
+    def last_line(self, pane_id: str) -> str:
+        """Last non-blank line of a pane"""
+        text = self.content(pane_id).strip()
+        return text.splitlines()[-1] if text else ""
+
+
+class TmuxSnapshotter:
+    """Captures many panes with one tmux process instead of one per pane"""
+
+    def __init__(self, start_line: str = CAPTURE_START, max_panes_per_call: int = MAX_PANES_PER_CALL):
+        self.start_line = start_line
+        self.max_panes_per_call = max_panes_per_call
+        self.subprocess_calls = 0
+
+    def build_command(self, panes: List[str]) -> List[str]:
+        """Chain display-message/capture-pane pairs into a single tmux command"""
+        cmd = ["tmux"]
+        for i, pane_id in enumerate(panes):
+            if i:
+                cmd.append(";")
+            cmd += [
+                "display-message", "-p", "-t", pane_id, f"{SNAPSHOT_MARKER}#{{pane_id}}", ";",
+                "capture-pane", "-p", "-t", pane_id, "-S", self.start_line,
+            ]
+        return cmd
+
+    @staticmethod
+    def parse(output: str) -> Dict[str, str]:
+        """Split batched output back into per-pane text"""
+        panes: Dict[str, str] = {}
+        current = None
+        lines: List[str] = []
+        for line in output.split("\n"):
+            if line.startswith(SNAPSHOT_MARKER):
+                if current is not None:
+                    panes[current] = "\n".join(lines)
+                current = line[len(SNAPSHOT_MARKER):].strip()
+                lines = []
+            elif current is not None:
+                lines.append(line)
+        if current is not None:
+            panes[current] = "\n".join(lines)
+        return panes
+
+    def _capture_batch(self, panes: List[str]) -> Dict[str, str]:
+        self.subprocess_calls += 1
+        result = subprocess.run(self.build_command(panes), capture_output=True)
+        captured = self.parse(result.stdout.decode(errors="replace"))
+        if result.returncode != 0:
+            # tmux stops at the first pane that vanished; everything queued
+            # after it is missing from the output
+            logger.debug(f"Batched capture failed: {result.stderr.decode(errors='replace').strip()}")
+        return captured
+
+    def capture(self, panes: List[str]) -> PaneSnapshot:
+        """Capture the tail of every pane, returning one shared snapshot"""
+        start_calls = self.subprocess_calls
+        captured: Dict[str, str] = {}
+        for i in range(0, len(panes), self.max_panes_per_call):
+            captured.update(self._capture_batch(panes[i:i + self.max_panes_per_call]))
+
+        # Panes after a vanished one get another go, one at a time
+        for pane_id in panes:
+            if pane_id not in captured:
+                captured.update(self._capture_batch([pane_id]))
+
+        return PaneSnapshot(
+            panes=captured,
+            captured_at=time.time(),
+            subprocess_calls=self.subprocess_calls - start_calls,
+        )
+
+
+@dataclass
+class PaneInfo:
+    """One row of list-panes: when the pane last produced output and what runs in it"""
+    pane_id: str
+    activity: float
+    command: str
+
+
+class ActivityTracker:
+    """Idle detection from tmux activity timestamps
+
+    A pane is idle once its activity timestamp is stale and a prompt-capable
+    command is in the foreground. The prompt regexes only run once per quiet
+    period, as a confirmation, using one batched capture for all panes that
+    went stale together.
+    """
+
+    def __init__(self, session: str, stale_after: float = ACTIVITY_STALE_SECONDS,
+                 snapshotter: Optional[TmuxSnapshotter] = None):
+        self.session = session
+        self.stale_after = stale_after
+        self.snapshotter = snapshotter or TmuxSnapshotter()
+        self.subprocess_calls = 0
+        self.info: Dict[str, PaneInfo] = {}
+        # pane -> (activity timestamp confirmed, looked idle, last line)
+        self._confirmed: Dict[str, Tuple[float, bool, str]] = {}
+
+    @staticmethod
+    def parse(output: str) -> Dict[str, PaneInfo]:
+        """Parse ACTIVITY_FORMAT rows"""
+        info = {}
+        for line in output.splitlines():
+            parts = line.split("\t")
+            if len(parts) < 4:
+                continue
+            pane_id, pane_activity, window_activity, command = parts[:4]
+            try:
+                activity = float(pane_activity or window_activity or 0)
+            except ValueError:
+                activity = 0.0
+            info[pane_id] = PaneInfo(pane_id=pane_id, activity=activity, command=command)
+        return info
+
+    def poll(self) -> Dict[str, PaneInfo]:
+        """Fetch activity for every pane with a single tmux call"""
+        self.subprocess_calls += 1
+        try:
+            out = subprocess.check_output(
+                ["tmux", "list-panes", "-t", self.session, "-F", ACTIVITY_FORMAT],
+                stderr=subprocess.DEVNULL,
+            ).decode(errors="replace")
+        except subprocess.CalledProcessError:
+            logger.error(f"Failed to list pane activity for session '{self.session}'")
+            out = ""
+        self.info = self.parse(out)
+        return self.info
+
+    def last_line(self, pane_id: str) -> str:
+        """Last line seen by the most recent confirmation, or the running command"""
+        if pane_id in self._confirmed:
+            return self._confirmed[pane_id][2]
+        info = self.info.get(pane_id)
+        return f"[{info.command}]" if info else ""
+
+    def _quiet_at_prompt_command(self, pane: Optional[PaneInfo], now: float) -> bool:
+        if pane is None or now - pane.activity < self.stale_after:
+            return False
+        return pane.command.split("/")[-1].lstrip("-") in PROMPT_COMMANDS
+
+    def observe(self, panes: List[str], info: Dict[str, PaneInfo], now: Optional[float] = None) -> List[str]:
+        """Record a list-panes result, returning panes that need a prompt confirmation"""
+        self.info = info
+        now = now or time.time()
+        return [
+            pid for pid in panes
+            if self._quiet_at_prompt_command(info.get(pid), now)
+            and self._confirmed.get(pid, (None,))[0] != info[pid].activity
+        ]
+
+    def confirm(self, pane_id: str, last_line: str):
+        """Store the prompt check for a pane's current quiet period"""
+        pane = self.info.get(pane_id)
+        if pane is not None:
+            self._confirmed[pane_id] = (pane.activity, looks_idle(last_line), last_line)
+
+    def idle_since(self, panes: List[str], now: Optional[float] = None) -> Dict[str, Optional[float]]:
+        """When each pane went idle (None while it's active)"""
+        now = now or time.time()
+        idle: Dict[str, Optional[float]] = {}
+        for pid in panes:
+            pane = self.info.get(pid)
+            confirmed = self._confirmed.get(pid)
+            if (self._quiet_at_prompt_command(pane, now) and confirmed
+                    and confirmed[0] == pane.activity and confirmed[1]):
+                idle[pid] = pane.activity
+            else:
+                idle[pid] = None
+        return idle
+
+    def forget(self, keep: List[str]):
+        """Drop confirmations for panes that no longer exist"""
+        for pid in list(self._confirmed):
+            if pid not in keep:
+                del self._confirmed[pid]
+
+    def check(self, panes: List[str]) -> Dict[str, Optional[float]]:
+        """Return when each pane went idle (None while it's active)"""
+        now = time.time()
+        stale = self.observe(panes, self.poll(), now)
+
+        # Confirm freshly quiet panes against the prompt patterns in one capture
+        if stale:
+            snapshot = self.snapshotter.capture(stale)
+            self.subprocess_calls += snapshot.subprocess_calls
+            for pid in stale:
+                self.confirm(pid, snapshot.last_line(pid))
+
+        return self.idle_since(panes, now)
+
+
+@dataclass
+class PaneActivity:
+    """Output state of one pane as seen through control mode"""
+    pane_id: str
+    tail: bytes = b""
+    last_line: str = ""
+    last_output: float = 0.0
+    idle_since: Optional[float] = None
+
+
+class ControlModeMonitor:
+    """Follows a session through tmux control mode (tmux -C) instead of polling
+
+    A reader thread consumes %output and layout notifications; idle timers
+    start when a pane's output ends at a prompt and reset on the next output.
+    """
+
+    def __init__(self, session: str):
+        self.session = session
+        self.process: Optional[subprocess.Popen] = None
+        self.panes: Dict[str, PaneActivity] = {}
+        self.events_seen = 0
+        self.alive = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending: List[str] = []
+        self._write_lock = threading.Lock()  # replies come back in the order commands are written
+        self._reply: Optional[List[str]] = None
+        self._reader: Optional[threading.Thread] = None
+
+    def start(self, snapshot: Optional[PaneSnapshot] = None):
+        """Attach to the session and seed pane state from a snapshot"""
+        now = time.time()
+        if snapshot is not None:
+            for pane_id in snapshot.panes:
+                line = snapshot.last_line(pane_id)
+                self.panes[pane_id] = PaneActivity(
+                    pane_id=pane_id,
+                    last_line=line,
+                    last_output=now,
+                    idle_since=now if looks_idle(line) else None,
+                )
+
+        self.process = subprocess.Popen(
+            ["tmux", "-C", "attach-session", "-t", self.session],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.alive = True
+        self._reader = threading.Thread(target=self._read_events, name="sage-tmux-control", daemon=True)
+        self._reader.start()
+        self.refresh_panes()
+
+    def stop(self):
+        """Detach the control client"""
+        if self.process and self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+        with self._changed:
+            self.alive = False
+            self._changed.notify_all()
+
+    def send(self, command: str, kind: str = "ignore"):
+        """Send a command over the control connection"""
+        if not self.process or self.process.poll() is not None:
+            return
+        with self._write_lock:
+            with self._lock:
+                self._pending.append(kind)
+            self.process.stdin.write(command.encode() + b"\n")
+            self.process.stdin.flush()
+
+    def refresh_panes(self):
+        """Ask tmux for the current pane list (answered asynchronously)"""
+        self.send(f"list-panes -s -t '{self.session}' -F '#{{pane_id}}'", kind="panes")
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until pane state changes or the timeout passes"""
+        with self._changed:
+            seen = self.events_seen
+            self._changed.wait_for(lambda: self.events_seen != seen or not self.alive, timeout)
+            return self.events_seen != seen
+
+    def pane_ids(self) -> List[str]:
+        """Panes currently being tracked"""
+        with self._lock:
+            return list(self.panes)
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """Idle state per pane, in the same shape the polling loop builds"""
+        now = time.time()
+        with self._lock:
+            return {
+                pane.pane_id: {
+                    'is_idle': pane.idle_since is not None,
+                    'idle_seconds': now - pane.idle_since if pane.idle_since is not None else 0,
+                    'last_line': pane.last_line,
+                }
+                for pane in self.panes.values()
+            }
+
+    def poke(self):
+        """Wake up anyone blocked in wait()"""
+        with self._changed:
+            self.events_seen += 1
+            self._changed.notify_all()
+
+    def reset_idle(self):
+        """Restart the idle timers of every idle pane"""
+        now = time.time()
+        with self._lock:
+            for pane in self.panes.values():
+                if pane.idle_since is not None:
+                    pane.idle_since = now
+
+    def _read_events(self):
+        for raw in self.process.stdout:
+            line = raw.rstrip(b"\n")
+            try:
+                self._handle(line)
+            except Exception as e:
+                logger.debug(f"Ignoring control mode line {line[:80]!r}: {e}")
+        with self._changed:
+            self.alive = False
+            self._changed.notify_all()
+
+    def _handle(self, line: bytes):
+        if self._reply is not None:
+            if line.startswith(b"%end") or line.startswith(b"%error"):
+                self._finish_reply(line)
+            else:
+                self._reply.append(line.decode(errors="replace"))
+            return
+
+        if line.startswith(b"%output ") or line.startswith(b"%extended-output "):
+            self._handle_output(line)
+            return
+
+        name = line.split(b" ", 1)[0].decode(errors="replace")
+        if name == "%begin":
+            # Flag 1 marks replies to our own commands
+            if line.rsplit(b" ", 1)[-1] == b"1":
+                self._reply = []
+            else:
+                self._reply = None
+        elif name in LAYOUT_NOTIFICATIONS:
+            self.refresh_panes()
+        elif name == "%exit":
+            with self._changed:
+                self.alive = False
+                self._changed.notify_all()
+
+    def _finish_reply(self, line: bytes):
+        reply, self._reply = self._reply, None
+        with self._changed:
+            kind = self._pending.pop(0) if self._pending else "ignore"
+            if kind != "panes" or line.startswith(b"%error"):
+                return
+            now = time.time()
+            current = [pid.strip() for pid in reply if pid.strip()]
+            self.panes = {
+                pid: self.panes.get(pid) or PaneActivity(pane_id=pid, last_output=now)
+                for pid in current
+            }
+            self.events_seen += 1
+            self._changed.notify_all()
+
+    def _handle_output(self, line: bytes):
+        if line.startswith(b"%extended-output "):
+            # %extended-output %pane age ... : data
+            header, _, data = line.partition(b" : ")
+            pane_id = header.split(b" ")[1].decode()
+        else:
+            _, pane, data = (line.split(b" ", 2) + [b""])[:3]
+            pane_id = pane.decode()
+
+        data = CONTROL_ESCAPE.sub(lambda m: bytes([int(m.group(1), 8)]), data)
+        now = time.time()
+        with self._changed:
+            pane = self.panes.get(pane_id)
+            if pane is None:
+                pane = self.panes[pane_id] = PaneActivity(pane_id=pane_id)
+            pane.tail = (pane.tail + data)[-OUTPUT_TAIL_BYTES:]
+            pane.last_line = last_output_line(pane.tail)
+            pane.last_output = now
+            pane.idle_since = now if looks_idle(pane.last_line) else None
+            self.events_seen += 1
+            self._changed.notify_all()
+
+
+class TmuxCommandError(Exception):
+    """A command sent over a control connection failed"""
+
+
+class AsyncTmuxControl:
+    """One asyncio tmux control-mode connection for talking to the whole server
+
+    Commands may target any session; each reply arrives between %begin and
+    %end guards carrying the command number, in the order commands were sent.
+    """
+
+    def __init__(self, target: Optional[str] = None):
+        self.target = target
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.commands_sent = 0
+        self.alive = False
+        self._waiting: Deque[asyncio.Future] = deque()
+        self._reader: Optional[asyncio.Task] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+
+    async def start(self):
+        """Attach in control mode and silence %output for the attached session"""
+        args = ["tmux", "-C", "attach-session"]
+        if self.target:
+            args += ["-t", self.target]
+        self.process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=1 << 20,
+        )
+        self._write_lock = asyncio.Lock()
+        self.alive = True
+        self._reader = asyncio.create_task(self._read_replies())
+        try:
+            await self.command("refresh-client -f no-output")
+        except TmuxCommandError:
+            pass  # tmux < 3.2, output notifications are simply ignored
+
+    async def close(self):
+        """Detach the control client"""
+        if self.process and self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=2)
+            except asyncio.TimeoutError:
+                self.process.kill()
+        if self._reader:
+            self._reader.cancel()
+        self.alive = False
+
+    async def command(self, command: str) -> List[str]:
+        """Run a tmux command and return its output lines"""
+        if not self.alive:
+            raise TmuxCommandError("control connection is closed")
+        future = asyncio.get_running_loop().create_future()
+        async with self._write_lock:
+            self._waiting.append(future)
+            self.commands_sent += 1
+            self.process.stdin.write(command.encode() + b"\n")
+            await self.process.stdin.drain()
+        return await future
+
+    async def _read_replies(self):
+        reply: Optional[List[str]] = None
+        number = b""
+        while True:
+            raw = await self.process.stdout.readline()
+            if not raw:
+                break
+            line = raw.rstrip(b"\n")
+            parts = line.split(b" ")
+
+            if reply is not None:
+                if parts[0] in (b"%end", b"%error") and len(parts) > 2 and parts[2] == number:
+                    future = self._waiting.popleft() if self._waiting else None
+                    if future is not None and not future.done():
+                        if parts[0] == b"%error":
+                            future.set_exception(TmuxCommandError("\n".join(reply)))
+                        else:
+                            future.set_result(reply)
+                    reply = None
+                else:
+                    reply.append(line.decode(errors="replace"))
+            elif parts[0] == b"%begin" and parts[-1] == b"1":
+                # Flag 1: the reply to a command this client sent
+                reply, number = [], parts[2]
+            elif parts[0] == b"%exit":
+                break
+
+        self.alive = False
+        while self._waiting:
+            future = self._waiting.popleft()
+            if not future.done():
+                future.set_exception(TmuxCommandError("control connection closed"))
@@ -0,0 +1,124 @@
+"""Completions: request building and command extraction, streamed or ranked"""
+
+import json
+
+import pytest
+
+import sage_ai
+from sage import PersonaConfig
+from sage_ai import (
+    CACHE_CONTROL, CommandExtractor, build_request, extract_command, extract_commands, parse_stream_event,
+    request_completion,
+)
+from sage_http import PoolSettings
+
+MESSAGES = [{"role": "system", "content": "You suggest commands."}, {"role": "user", "content": "Pane %1: $"}]
+ANTHROPIC = "https://api.anthropic.com/v1/messages"
+OPENROUTER = "https://openrouter.ai/api/v1/chat/completions"
+OPENAI = "https://api.openai.com/v1/chat/completions"
+
+RESPONSES = [
+    "`git status`",
+    "Try `git status` to see what changed.",
+    "ls -la /tmp\nThat lists everything.",
+    "  `make\ntest` spans lines",
+    "  indented, then\n`docker ps` below",
+    "Run `pytest -q` or `tox`",
+]
+
+
+def persona(endpoint: str, **kwargs) -> PersonaConfig:
+    return PersonaConfig(name="t", api_key="k", api_endpoint=endpoint, model="m", **kwargs)
+
+
+def cache_marks(value) -> int:
+    """cache_control hints anywhere in a request body"""
+    if isinstance(value, dict):
+        return ("cache_control" in value) + sum(cache_marks(v) for v in value.values())
+    if isinstance(value, list):
+        return sum(cache_marks(v) for v in value)
+    return 0
+
+
+def test_anthropic_marks_the_system_prompt():
+    _, data = build_request(persona(ANTHROPIC), MESSAGES)
+    assert data["system"] == [{"type": "text", "text": "You suggest commands.", "cache_control": CACHE_CONTROL}]
+    assert data["messages"] == MESSAGES[1:]
+    assert cache_marks(data) == 1
+
+
+def test_openrouter_marks_only_the_system_message():
+    _, data = build_request(persona(OPENROUTER), MESSAGES)
+    system, user = data["messages"]
+    assert system["content"][0]["cache_control"] == CACHE_CONTROL
+    assert user == MESSAGES[1]
+    assert cache_marks(data) == 1
+
+
+@pytest.mark.parametrize("endpoint, kwargs, messages", [
+    (OPENAI, {}, MESSAGES),                                             # caches prefixes by itself
+    (ANTHROPIC, {"prompt_cache": False}, MESSAGES),
+    (OPENROUTER, {}, [{"role": "system", "content": ""}] + MESSAGES[1:]),  # nothing to cache
+])
+def test_no_cache_marks(endpoint, kwargs, messages):
+    _, data = build_request(persona(endpoint, **kwargs), messages)
+    assert cache_marks(data) == 0
+
+
+def settled(deltas) -> list:
+    """What the extractor reports after each delta"""
+    extractor = CommandExtractor()
+    return [extractor.feed(delta) for delta in deltas]
+
+
+@pytest.mark.parametrize("response", RESPONSES)
+def test_streamed_command_matches_the_whole_response(response):
+    # However the text is split, a command reported early is the one the full text yields
+    expected = extract_command(response)
+    for cut in range(len(response) + 1):
+        assert set(settled([response[:cut], response[cut:]])) <= {None, expected}
+    assert set(settled(response)) <= {None, expected}
+
+
+def test_commands_wait_until_they_cannot_change():
+    assert settled(["`git st", "atus` now"]) == [None, "git status"]
+    assert settled(["ls -la", " /tmp", "\n"]) == [None, None, "ls -la /tmp"]
+    # An open backtick on an earlier line could still close around this one
+    assert settled(["  `git", "\nls\n", "`"]) == [None, None, "git\nls\n"]
+
+
+def test_stream_events_of_both_apis():
+    openai = {"choices": [{"delta": {"content": "`ls`"}}]}
+    usage = {"choices": [], "usage": {"prompt_tokens": 10}}
+    anthropic_start = {"type": "message_start", "message": {"usage": {"input_tokens": 7}}}
+    anthropic_delta = {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "`pwd`"}}
+    assert parse_stream_event(json.dumps(openai)) == ("`ls`", None)
+    assert parse_stream_event(json.dumps(usage)) == ("", {"prompt_tokens": 10})
+    assert parse_stream_event(json.dumps(anthropic_start)) == ("", {"input_tokens": 7})
+    assert parse_stream_event(json.dumps(anthropic_delta)) == ("`pwd`", None)
+
+
+def test_stream_is_closed_once_the_command_is_complete(monkeypatch):
+    deltas = ["`git ", "log`", " shows", " the history"]
+    consumed = []
+
+    def events():
+        for delta in deltas:
+            consumed.append(delta)
+            yield json.dumps({"choices": [{"delta": {"content": delta}}]})
+
+    stream = events()
+    monkeypatch.setattr(sage_ai.HTTP_POOL, "stream_events", lambda *args, **kwargs: stream)
+    assert request_completion(persona(OPENAI, stream=True), [], PoolSettings()) == "`git log`"
+    assert consumed == deltas[:2]
+    assert stream.gi_frame is None  # closed, not left hanging on the connection
+
+
+@pytest.mark.parametrize("response, expected", [
+    ("1. `git pull`\n2. `git fetch`\n3. `git pull`\n4. `git status`", ["git pull", "git fetch", "git status"]),
+    ("- make\n- make test\n```\n- make clean", ["make", "make test", "make clean"]),
+    ("Best: `ls -la` then `ls`", ["ls -la", "ls"]),
+])
+def test_ranked_candidates(response, expected):
+    assert extract_commands(response, 3) == expected
+    assert extract_commands(response, 1) == [extract_command(response)]
@@ -0,0 +1,144 @@
+"""Suggestion caches: candidate queues, persistence and near-duplicate lookup"""
+
+import json
+import threading
+
+import sage_cache
+from sage_cache import CandidateQueue, SimHashIndex, SuggestionCache, context_key, simhash
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_candidates_come_back_best_first(monkeypatch):
+    monkeypatch.setattr(sage_cache.time, "time", Clock())
+    queue = CandidateQueue()
+    queue.push("ctx", ["git diff", "git log"])
+    queue.push("ctx", ["git stash"])
+    assert [queue.pop("ctx") for _ in range(4)] == ["git diff", "git log", "git stash", None]
+    assert queue.pop("other") is None
+    assert queue.hits == 3 and len(queue) == 0
+
+
+def test_recent_commands_are_skipped(monkeypatch):
+    monkeypatch.setattr(sage_cache.time, "time", Clock())
+    queue = CandidateQueue()
+    queue.push("ctx", ["make", "make test", "make install"])
+    assert queue.pop("ctx", exclude=["make", "make test"]) == "make install"
+    assert queue.pop("ctx") is None  # skipped candidates are dropped, not kept for later
+
+
+def test_stale_candidates_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sage_cache.time, "time", clock)
+    queue = CandidateQueue(ttl=60)
+    queue.push("ctx", ["ls"])
+    clock.now += 30
+    queue.push("ctx", ["pwd"])
+    clock.now += 45
+    assert queue.pop("ctx") == "pwd"
+    assert len(queue) == 0
+
+
+def test_context_key_follows_prompts_not_output():
+    before = ["Pane %1:\n$ make\n3 errors\nuser@host:~/p$", "Pane %2:\nuser@host:~$"]
+    after = ["Pane %1:\n$ make\n0 errors\nuser@host:~/p$", "Pane %2:\nuser@host:~$"]
+    elsewhere = ["Pane %1:\n$ make\n0 errors\nuser@host:~/q$", "Pane %2:\nuser@host:~$"]
+    assert context_key("sage", "m", before) == context_key("sage", "m", after)
+    assert context_key("sage", "m", before) != context_key("sage", "m", elsewhere)
+    assert context_key("sage", "m", before) != context_key("sage", "other-model", before)
+
+
+def test_concurrent_saves_leave_one_valid_file(tmp_path):
+    path = tmp_path / "suggestions.json"
+    cache = SuggestionCache(path)
+    errors = []
+
+    def writer(n: int):
+        try:
+            for i in range(20):
+                cache.put(f"{n}-{i}", f"`echo {n} {i}`")
+                cache.save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert [p.name for p in tmp_path.iterdir()] == ["suggestions.json"]
+    reloaded = SuggestionCache(path)
+    assert len(reloaded) == 40
+    assert reloaded.get("1-19") == "`echo 1 19`"
+
+
+def write_log(path, *entries):
+    with open(path, "a") as f:
+        f.write("\n".join(json.dumps(entry) for entry in entries) + "\n")
+
+
+def interaction(prompt: str, response: str, persona: str = "sage"):
+    return {"persona": persona, "prompt": prompt, "response": response}
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def test_simhash_ignores_escapes_and_timestamps():
+    plain = "Pane %1:\nbuild finished at 12:34:56\nuser@host:~/p$"
+    noisy = "Pane %1:\n\x1b[32mbuild finished at 09:01:02\x1b[0m\nuser@host:~/p$   "
+    assert simhash(plain) == simhash(noisy)
+
+
+def test_simhash_distance_tracks_similarity():
+    base = "Pane %1:\n$ pytest -q tests\n118 passed in 4.2s\nuser@host:~/project$"
+    close = base.replace("118 passed", "119 passed")
+    far = "Pane %2:\n$ docker compose logs web\nweb-1 | listening on :8080\nuser@host:~/other$"
+    assert distance(simhash(base), simhash(close)) < distance(simhash(base), simhash(far))
+
+
+def test_bands_find_every_signature_within_max_distance(tmp_path, monkeypatch):
+    # Four flipped bits spread across bands still leave one band identical
+    signatures = {"query": 0, "near": 1 << 3 | 1 << 17 | 1 << 30 | 1 << 45, "far": (1 << 5) - 1}
+    monkeypatch.setattr(sage_cache, "simhash", signatures.__getitem__)
+    log = tmp_path / "interactions.jsonl"
+    write_log(log, interaction("near", "`ls`"), interaction("far", "`pwd`"))
+    index = SimHashIndex(log, max_distance=4)
+    assert index.lookup("sage", "query") == ("`ls`", 4)
+    assert index.lookup("other-persona", "query") is None
+
+
+def test_ties_go_to_the_newest_interaction(tmp_path, monkeypatch):
+    # "new" shares the first band with the query, "old" only later bands
+    signatures = {"query": 0, "old": 1 << 0 | 1 << 14, "new": 1 << 20 | 1 << 30}
+    monkeypatch.setattr(sage_cache, "simhash", signatures.__getitem__)
+    log = tmp_path / "interactions.jsonl"
+    write_log(log, interaction("old", "`make`"), interaction("new", "`make test`"))
+    assert SimHashIndex(log).lookup("sage", "query") == ("`make test`", 2)
+
+
+def test_refresh_reads_only_new_complete_lines(tmp_path):
+    log = tmp_path / "interactions.jsonl"
+    write_log(log, interaction("first prompt", "`one`"))
+    index = SimHashIndex(log)
+    index.refresh()
+    assert len(index) == 1
+    # A writer caught mid-line: the partial entry is left for the next refresh
+    record = json.dumps(interaction("second prompt", "`two`"))
+    with open(log, "a") as f:
+        f.write(record[:20])
+    index.refresh()
+    assert len(index) == 1
+    with open(log, "a") as f:
+        f.write(record[20:] + "\n")
+    index.refresh()
+    assert len(index) == 2
+    assert index.lookup("sage", "second prompt") == ("`two`", 0)
@@ -0,0 +1,89 @@
+"""Daemon scheduling: sessions come and go, bad personas stay contained"""
+
+import asyncio
+import time
+
+import pytest
+
+import sage_daemon
+from sage import PersonaConfig
+from sage_daemon import SageDaemon
+from sage_predict import LOCAL_ENDPOINT
+
+
+class FakePersonas:
+    """PersonaManager stand-in that only knows 'helpful'"""
+
+    def load_persona(self, name: str):
+        if name != "helpful":
+            raise ValueError(f"Persona '{name}' not found")
+        return PersonaConfig(name=name, api_key="", api_endpoint=LOCAL_ENDPOINT, model="local"), None
+
+
+class FakeTmux:
+    """Answers list-panes from a session -> panes table; captures come back empty"""
+
+    def __init__(self):
+        self.sessions = {}
+
+    async def command(self, command: str):
+        if not command.startswith("list-panes"):
+            return []
+        now = time.time()
+        return [
+            f"{session}\t{pane}\t{now:.0f}\t{now:.0f}\tbash"
+            for session, panes in self.sessions.items() for pane in panes
+        ]
+
+
+@pytest.fixture
+def make_daemon(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sage_daemon, "PersonaManager", FakePersonas)
+
+    def make(requested=None, default="helpful", watch_all=True) -> SageDaemon:
+        daemon = SageDaemon(requested or {}, default, watch_all=watch_all)
+        daemon.tmux = FakeTmux()
+        return daemon
+    return make
+
+
+def test_sessions_are_watched_and_dropped_as_they_come_and_go(make_daemon):
+    daemon = make_daemon()
+    daemon.tmux.sessions = {"dev": ["%1", "%2"], "ops": ["%3"]}
+    asyncio.run(daemon.tick())
+    assert sorted(daemon.sessions) == ["dev", "ops"]
+    assert daemon.sessions["dev"].panes == ["%1", "%2"]
+
+    del daemon.tmux.sessions["ops"]
+    asyncio.run(daemon.tick())
+    assert list(daemon.sessions) == ["dev"]
+
+
+def test_only_requested_sessions_without_all(make_daemon):
+    daemon = make_daemon({"dev": "helpful"}, watch_all=False)
+    daemon.tmux.sessions = {"dev": ["%1"], "scratch": ["%2"]}
+    asyncio.run(daemon.tick())
+    assert list(daemon.sessions) == ["dev"]
+
+
+def test_unknown_persona_skips_only_that_session(make_daemon):
+    daemon = make_daemon({"ops": "no-such-persona"})
+    daemon.tmux.sessions = {"dev": ["%1"], "ops": ["%2"]}
+    asyncio.run(daemon.tick())
+    asyncio.run(daemon.tick())
+    assert list(daemon.sessions) == ["dev"]
+    assert daemon.skipped == {"ops"}
+
+    # Once the session closes it is forgotten, and retried if it comes back
+    del daemon.tmux.sessions["ops"]
+    asyncio.run(daemon.tick())
+    assert daemon.skipped == set()
+
+
+def test_unknown_personas_fail_at_startup(make_daemon):
+    with pytest.raises(ValueError):
+        make_daemon(default="no-such-persona").check_personas()
+    with pytest.raises(ValueError):
+        make_daemon({"ops": "no-such-persona"}).check_personas()
+    make_daemon({"dev": "helpful"}).check_personas()
@@ -0,0 +1,49 @@
+"""Endpoint guards: breakers per endpoint and model, rate limits per origin"""
+
+import pytest
+
+from sage_guard import CircuitOpenError, GuardRegistry, RateLimitedError, TokenBucket
+from sage_http import PoolSettings
+
+URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+def test_models_on_one_origin_have_separate_breakers():
+    registry = GuardRegistry()
+    settings = PoolSettings(rate_limit=100.0, burst=100)
+    failing, hedge = registry.for_url(URL, settings, "model-a"), registry.for_url(URL, settings, "model-b")
+    assert failing.bucket is hedge.bucket
+    for _ in range(settings.failure_threshold):
+        failing.admit()
+        failing.record(503)
+    with pytest.raises(CircuitOpenError):
+        failing.admit()
+    hedge.admit()  # still closed
+
+
+def test_rejected_requests_take_no_token():
+    bucket = TokenBucket(rate=1.0, burst=1)
+    assert bucket.reserve(max_wait=0.5) == 0.0
+    for _ in range(10):
+        assert bucket.reserve(max_wait=0.5) > 0.5
+    # Ten rejections later the next token is still about a second away, not eleven
+    assert bucket.reserve() <= 1.0
+
+
+def test_admit_raises_when_rate_limited():
+    registry = GuardRegistry()
+    guard = registry.for_url(URL, PoolSettings(rate_limit=1.0, burst=1), "model-a")
+    guard.admit()
+    with pytest.raises(RateLimitedError):
+        guard.admit(max_wait=0.1)
+    assert guard.bucket.tokens > -1
+
+
+@pytest.mark.parametrize("http", [{"rate_limit": 0}, {"rate_limit": -1.5}, {"burst": 0}])
+def test_non_positive_rate_limits_fall_back_to_defaults(http):
+    settings = PoolSettings.from_config(http)
+    assert settings.rate_limit == PoolSettings.rate_limit
+    assert settings.burst == PoolSettings.burst
+    bucket = TokenBucket(settings.rate_limit, settings.burst)
+    for _ in range(settings.burst + 2):
+        bucket.reserve()  # no ZeroDivisionError once the burst is spent
@@ -0,0 +1,37 @@
+"""Hedged completions: a caller's cancel stops every attempt"""
+
+import threading
+import time
+
+import pytest
+
+import sage_ai
+from sage import PersonaConfig
+from sage_ai import HedgeCancelled, complete
+from sage_http import PoolSettings
+from sage_routing import Endpoint
+
+CONFIG = PersonaConfig(name="test", api_key="key", api_endpoint="https://a.example/v1", model="m")
+
+
+def test_cancel_abandons_a_running_request(monkeypatch):
+    endpoints = [Endpoint("https://a.example/v1", "m", "key"), Endpoint("https://b.example/v1", "m", "key")]
+    monkeypatch.setattr(sage_ai.ROUTER, "route", lambda config: endpoints)
+    monkeypatch.setattr(sage_ai.ROUTER, "hedge_delay", lambda endpoint: 60.0)
+    attempts = []
+
+    def slow_stream(config, messages, settings, cancelled=None):
+        attempts.append(config.api_endpoint)
+        while not cancelled.is_set():
+            time.sleep(0.01)
+        raise HedgeCancelled(config.api_endpoint)
+
+    monkeypatch.setattr(sage_ai, "request_completion", slow_stream)
+    cancelled = threading.Event()
+    threading.Timer(0.1, cancelled.set).start()
+    started = time.perf_counter()
+    with pytest.raises(HedgeCancelled):
+        complete(CONFIG, [], PoolSettings(), cancelled)
+    assert time.perf_counter() - started < 5
+    # Cancelled before the hedge delay: the fallback endpoint was never started
+    assert attempts == ["https://a.example/v1"]
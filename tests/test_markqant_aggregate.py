@@ -0,0 +1,43 @@
+"""Markqant aggregates extract exactly what went in, and only inside the output directory"""
+
+import pytest
+
+from sage_aggregate import MarkqantAggregate, create_aggregate, member_path
+
+
+def test_extract_is_byte_exact(tmp_path):
+    root = tmp_path / "docs"
+    root.mkdir()
+    (root / "crlf.md").write_bytes("# Title\r\n\r\n- one\r\n- two\r\n".encode("utf-8"))
+    (root / "plain.md").write_bytes("# Plain\n\nno trailing newline".encode("utf-8"))
+    archive = tmp_path / "docs.mq"
+    create_aggregate(archive, root, sorted(root.iterdir()))
+    with MarkqantAggregate(archive) as aggregate:
+        for path in root.iterdir():
+            assert aggregate.read(path.name).encode("utf-8") == path.read_bytes()
+
+
+def test_undecodable_files_are_refused(tmp_path):
+    root = tmp_path / "docs"
+    root.mkdir()
+    (root / "latin1.md").write_bytes("caf\xe9".encode("latin-1"))
+    with pytest.raises(ValueError, match="not UTF-8"):
+        create_aggregate(tmp_path / "docs.mq", root, [root / "latin1.md"])
+
+
+@pytest.mark.parametrize("name", ["../escape.md", "a/../../escape.md", "/etc/escape.md"])
+def test_member_path_rejects_escapes(tmp_path, name):
+    with pytest.raises(ValueError, match="outside"):
+        member_path(tmp_path / "out", name)
+
+
+def test_member_path_rejects_symlinked_escape(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / "link").symlink_to(tmp_path)
+    with pytest.raises(ValueError, match="outside"):
+        member_path(out, "link/escape.md")
+
+
+def test_member_path_allows_subdirectories(tmp_path):
+    assert member_path(tmp_path, "sub/dir/file.md") == tmp_path / "sub" / "dir" / "file.md"
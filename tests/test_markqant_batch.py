@@ -0,0 +1,65 @@
+"""Markqant batch APIs and sharing one processor between threads"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from sage_markqant import (
+    BINARY_HEADER, FLAG_SHARED, DictionaryStore, MarkqantProcessor, train_shared_dictionary,
+)
+
+DOCUMENTS = [
+    f"# Document {i}\r\n\r\n" + "Persona contexts compress with shared tokens. " * (i + 1)
+    + "\nT0A stays literal 🧙\n"
+    for i in range(12)
+]
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    store = DictionaryStore(tmp_path_factory.mktemp("dictionaries"))
+    store.save(train_shared_dictionary("sage", DOCUMENTS))
+    return store
+
+
+def test_one_processor_serves_many_threads():
+    processor = MarkqantProcessor()
+    expected = [processor.compress(document) for document in DOCUMENTS]
+    with ThreadPoolExecutor(8) as pool:
+        for _ in range(5):
+            assert list(pool.map(processor.compress, DOCUMENTS)) == expected
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_compress_and_decompress_files(tmp_path, store, workers):
+    processor = MarkqantProcessor(dictionaries=store, shared="sage", codec="zlib-6")
+    sources = []
+    for i, document in enumerate(DOCUMENTS):
+        source = tmp_path / f"doc{i}.md"
+        source.write_bytes(document.encode("utf-8"))
+        sources.append(source)
+
+    packed = processor.compress_files([(s, s.with_suffix(".mq")) for s in sources], workers=workers)
+    assert [r.source for r in packed] == sources  # results in job order
+    for result in packed:
+        # Workers write with the parent's shared dictionary
+        assert BINARY_HEADER.unpack_from(result.target.read_bytes())[2] & FLAG_SHARED
+        assert result.stored_size == result.target.stat().st_size
+
+    restored = processor.decompress_files([(r.target, r.target.with_suffix(".out")) for r in packed],
+                                          workers=workers)
+    for source, result in zip(sources, restored):
+        assert result.target.read_bytes() == source.read_bytes()  # CRLF and all
+
+
+def test_write_mq_files_matches_single_writes(tmp_path):
+    processor = MarkqantProcessor(codec="raw")
+    documents = {tmp_path / f"ctx{i}.m8": document for i, document in enumerate(DOCUMENTS)}
+    results = processor.write_mq_files(documents, workers=2)
+    assert [r.target for r in results] == list(documents)
+    for path, document in documents.items():
+        assert processor.read_mq_file(path).personality == document
+
+
+def test_empty_batch_starts_nothing():
+    assert MarkqantProcessor().compress_files([]) == []
@@ -0,0 +1,63 @@
+"""Every registered payload codec round-trips through every Markqant write path"""
+
+import io
+from pathlib import Path
+
+import pytest
+
+from sage_aggregate import MarkqantAggregate, create_aggregate
+from sage_markqant import AUTO_CODEC, AUTO_CODECS, CODECS, MarkqantProcessor, pack_payload, unpack_payload
+
+DOCS = Path(__file__).resolve().parent.parent / "docs"
+SAMPLE = (DOCS / "SSE_USAGE.md").read_text(encoding="utf-8")
+# Small, mid-sized and large (>16 KB) payloads, plus text full of token lookalikes
+DOCUMENTS = [SAMPLE[:200], SAMPLE, SAMPLE * 12, "T10 T0F T0 TFF\r\n" * 50]
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+@pytest.mark.parametrize("content", DOCUMENTS, ids=["small", "doc", "large", "lookalikes"])
+def test_payload_roundtrip(codec, content):
+    payload, flags = pack_payload(content, codec=codec)
+    assert unpack_payload(payload, flags).decode("utf-8") == content
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+@pytest.mark.parametrize("content", DOCUMENTS, ids=["small", "doc", "large", "lookalikes"])
+def test_container_roundtrip(codec, content):
+    processor = MarkqantProcessor(codec=codec)
+    assert processor.parse_mq_binary(processor.create_mq_binary(content)).personality == content
+    assert processor.parse_mq_file(processor.create_mq_file(content, "doc.md")).personality == content
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_stream_roundtrip(codec):
+    content = SAMPLE * 12
+    processor = MarkqantProcessor(codec=codec)
+    packed = b"".join(processor.compress_stream(io.BytesIO(content.encode("utf-8")), 4096))
+    restored = b"".join(processor.decompress_stream(io.BytesIO(packed), 4096))
+    assert restored.decode("utf-8") == content
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_aggregate_roundtrip(codec, tmp_path):
+    root = tmp_path / "docs"
+    root.mkdir()
+    for index, content in enumerate(DOCUMENTS):
+        (root / f"{index}.md").write_bytes(content.encode("utf-8"))
+    archive = tmp_path / "docs.mq"
+    create_aggregate(archive, root, sorted(root.iterdir()), codec)
+    with MarkqantAggregate(archive) as aggregate:
+        for index, content in enumerate(DOCUMENTS):
+            assert aggregate.read(f"{index}.md") == content
+
+
+@pytest.mark.parametrize("target", list(AUTO_CODECS))
+def test_auto_roundtrip(target):
+    processor = MarkqantProcessor(codec=AUTO_CODEC, target=target)
+    for content in DOCUMENTS:
+        assert processor.parse_mq_binary(processor.create_mq_binary(content)).personality == content
+
+
+def test_zstd_registered_when_installed():
+    pytest.importorskip("zstandard")
+    assert {"zstd-1", "zstd-3", "zstd-19"} <= set(CODECS)
@@ -0,0 +1,124 @@
+"""decode(encode(x)) == x for Markqant, in every format Sage writes or still reads"""
+
+import io
+import random
+from pathlib import Path
+
+import pytest
+
+from sage_markqant import (
+    BINARY_HEADER, ESCAPE_TOKEN, FLAG_CODEC_ONLY, MARKQANT_TOKENS, DictionaryStore, MarkqantProcessor,
+    train_shared_dictionary,
+)
+
+ROOT = Path(__file__).resolve().parent.parent
+LEGACY = ROOT / "tests" / "fixtures" / "legacy"
+CASES = 300
+
+
+def random_markdown(rng: random.Random, length: int) -> str:
+    """Text built from token patterns, token look-alikes and repeated words"""
+    pieces = list(MARKQANT_TOKENS.values()) + list(MARKQANT_TOKENS) + [
+        ESCAPE_TOKEN, "T", "TT", "0A", "FF", "T1", "=", "---\n", "---", "\n", " ", "\r\n", "é", "🧙",
+        "suggest", "suggesting", "commands", "Terminal", "T0A0B", "T10", "TFF",
+    ]
+    return "".join(rng.choice(pieces) for _ in range(length))
+
+
+def documents():
+    rng = random.Random(0)
+    generated = [random_markdown(rng, rng.randint(0, 400)) for _ in range(CASES)]
+    edge_cases = ["", "\n", "---", "---\n", "T", "T0F", "T0FT0F", "\r\n\r\n", "  trailing  \n\n"]
+    real = [path.read_bytes().decode("utf-8") for path in sorted((ROOT / "docs").glob("*.md"))]
+    return generated + edge_cases + real
+
+
+DOCUMENTS = documents()
+
+
+@pytest.fixture(scope="module")
+def shared_store(tmp_path_factory):
+    store = DictionaryStore(tmp_path_factory.mktemp("dictionaries"))
+    store.save(train_shared_dictionary("test", DOCUMENTS[-10:]))
+    return store
+
+
+def test_escaped_text_format():
+    processor = MarkqantProcessor()
+    for document in DOCUMENTS:
+        assert processor.parse_mq_file(processor.create_mq_file(document, "check.mq")).personality == document
+
+
+def test_binary_container():
+    processor = MarkqantProcessor()
+    for document in DOCUMENTS:
+        assert processor.parse_mq_binary(processor.create_mq_binary(document)).personality == document
+
+
+def test_binary_container_with_shared_dictionary(shared_store):
+    processor = MarkqantProcessor(dictionaries=shared_store, shared="test")
+    for document in DOCUMENTS:
+        assert processor.parse_mq_binary(processor.create_mq_binary(document)).personality == document
+
+
+def header(container: bytes):
+    _, _, flags, entries, *_ = BINARY_HEADER.unpack_from(container)
+    return flags, entries
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_codec_only_containers(shared, shared_store):
+    # Prose like this: zlib finds the repeats itself, and a token table only costs bytes
+    document = (LEGACY / "SSE_USAGE.md").read_bytes().decode("utf-8")
+    processor = MarkqantProcessor(codec="zlib-9", dictionaries=shared_store if shared else None,
+                                  shared="test" if shared else None)
+    container = processor.create_mq_binary(document)
+    flags, entries = header(container)
+    assert flags & FLAG_CODEC_ONLY and entries == 0
+    assert processor.parse_mq_binary(container).personality == document
+
+
+def test_tokens_kept_without_a_codec():
+    document = "- configuration management configuration\n" * 20
+    container = MarkqantProcessor(codec="raw").create_mq_binary(document)
+    flags, entries = header(container)
+    assert not flags & FLAG_CODEC_ONLY and entries > 0
+
+
+def test_files_on_disk(tmp_path):
+    processor = MarkqantProcessor()
+    path = tmp_path / "context.m8"
+    for document in DOCUMENTS[::10]:
+        processor.write_mq_file(path, document)
+        assert processor.read_mq_file(path).personality == document
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_stream(chunk_size):
+    processor = MarkqantProcessor()
+    # Small chunks put token, escape and UTF-8 boundaries between reads
+    for document in DOCUMENTS[:40] + DOCUMENTS[-3:]:
+        packed = b"".join(processor.compress_stream(io.BytesIO(document.encode("utf-8")), chunk_size))
+        restored = b"".join(processor.decompress_stream(io.BytesIO(packed), chunk_size))
+        assert restored.decode("utf-8") == document
+
+
+def test_stream_reads_whole_containers():
+    processor = MarkqantProcessor()
+    for document in DOCUMENTS[::10]:
+        restored = b"".join(processor.decompress_stream(io.BytesIO(processor.create_mq_binary(document)), 64))
+        assert restored.decode("utf-8") == document
+
+
+def test_truncated_stream_input_is_an_error():
+    processor = MarkqantProcessor(codec="raw")
+    container = processor.create_mq_binary(DOCUMENTS[-1])
+    for cut in (10, len(container) - 5):
+        with pytest.raises(ValueError, match="Truncated"):
+            b"".join(processor.decompress_stream(io.BytesIO(container[:cut]), 64))
+
+@pytest.mark.parametrize("path", sorted(LEGACY.glob("*.mq")), ids=lambda path: path.stem)
+def test_legacy_files(path):
+    # Written by the original compressor: unescaped, tokens replaced one pattern at a time
+    processor = MarkqantProcessor()
+    assert processor.read_mq_file(path).personality == path.with_suffix(".md").read_bytes().decode("utf-8")
@@ -0,0 +1,80 @@
+"""Shared Markqant dictionaries: files always decode with the exact dictionary they were written with"""
+
+import io
+
+import pytest
+
+from sage_markqant import DictionaryStore, MarkqantProcessor, train_shared_dictionary
+
+CORPUS = [
+    "# Sage persona\n\nYou suggest terminal commands for developers working in tmux.\n" * 3,
+    "## Context\n\nThe developer is working on a Python project with pytest and tmux.\n" * 3,
+]
+DOCUMENT = "# Helpful persona\n\nSuggest terminal commands for developers in tmux sessions.\n"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = DictionaryStore(tmp_path / "dictionaries")
+    store.save(train_shared_dictionary("sage", CORPUS))
+    return store
+
+
+def alter(path):
+    """Flip a byte of a dictionary file's zlib preset, keeping its name"""
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+
+def test_files_keep_decoding_after_a_retrain(store):
+    writer = MarkqantProcessor(dictionaries=store, shared="sage")
+    old = writer.create_mq_binary(DOCUMENT)
+    retrained = train_shared_dictionary("sage", CORPUS + ["Completely different material about gardening.\n" * 5])
+    store.save(retrained)
+    assert store.latest("sage").digest == retrained.digest
+    new = writer.create_mq_binary(DOCUMENT)
+
+    reader = MarkqantProcessor(dictionaries=DictionaryStore(store.directory))
+    assert reader.parse_mq_binary(old).personality == DOCUMENT
+    assert reader.parse_mq_binary(new).personality == DOCUMENT
+
+
+def test_missing_dictionary_is_an_error(store, tmp_path):
+    container = MarkqantProcessor(dictionaries=store, shared="sage").create_mq_binary(DOCUMENT)
+    with pytest.raises(ValueError, match="not found"):
+        MarkqantProcessor(dictionaries=DictionaryStore(tmp_path / "empty")).parse_mq_binary(container)
+    with pytest.raises(ValueError, match="no store is configured"):
+        MarkqantProcessor().parse_mq_binary(container)
+
+
+def test_altered_dictionary_file_is_rejected(store):
+    container = MarkqantProcessor(dictionaries=store, shared="sage").create_mq_binary(DOCUMENT)
+    alter(next(store.directory.glob("sage-*.mqd")))
+    with pytest.raises(ValueError, match="does not match its digest"):
+        MarkqantProcessor(dictionaries=DictionaryStore(store.directory)).parse_mq_binary(container)
+
+
+def stream_roundtrip(writer: MarkqantProcessor, reader: MarkqantProcessor, document: str,
+                     chunk_size: int) -> str:
+    packed = b"".join(writer.compress_stream(io.BytesIO(document.encode("utf-8")), chunk_size))
+    return b"".join(reader.decompress_stream(io.BytesIO(packed), chunk_size)).decode("utf-8")
+
+
+@pytest.mark.parametrize("chunk_size", [3, 4096])
+def test_streams_with_a_shared_dictionary(store, chunk_size):
+    writer = MarkqantProcessor(dictionaries=store, shared="sage")
+    reader = MarkqantProcessor(dictionaries=DictionaryStore(store.directory))
+    document = DOCUMENT * 50 + "Ends with a multibyte character: 🧙"
+    assert stream_roundtrip(writer, reader, document, chunk_size) == document
+
+
+def test_streamed_reference_to_an_altered_dictionary_is_rejected(store):
+    packed = b"".join(MarkqantProcessor(dictionaries=store, shared="sage").compress_stream(
+        io.BytesIO(DOCUMENT.encode("utf-8"))))
+    alter(next(store.directory.glob("sage-*.mqd")))
+    reader = MarkqantProcessor(dictionaries=DictionaryStore(store.directory))
+    with pytest.raises(ValueError, match="does not match its digest"):
+        b"".join(reader.decompress_stream(io.BytesIO(packed)))
+    with pytest.raises(ValueError, match="no store is configured"):
+        b"".join(MarkqantProcessor().decompress_stream(io.BytesIO(packed)))
@@ -0,0 +1,101 @@
+"""Local command predictor: naive Bayes ranking over pane-state features"""
+
+import json
+import math
+import random
+
+import pytest
+
+from sage_predict import SMOOTHING, CommandPredictor, state_features
+
+
+def pane(*lines: str) -> str:
+    return "Pane %1:\n" + "\n".join(lines)
+
+
+def trained() -> CommandPredictor:
+    predictor = CommandPredictor()
+    for _ in range(5):
+        predictor.learn(pane("$ git status", "modified: sage.py", "user@host:~/p$"), "git add -p")
+        predictor.learn(pane("$ make", "error: missing semicolon", "user@host:~/p$"), "make")
+        predictor.learn(pane("$ pytest -q", "3 failed", "user@host:~/p$"), "pytest -q --lf")
+    return predictor
+
+
+def full_scores(predictor: CommandPredictor, features) -> dict:
+    """Textbook multinomial-style score over every class, for comparison"""
+    scores = {}
+    for command, seen in predictor.class_counts.items():
+        score = math.log(seen / predictor.examples)
+        for feature in features:
+            count = predictor.feature_counts.get(feature, {}).get(command, 0)
+            score += math.log((count + SMOOTHING) / (seen + 2 * SMOOTHING))
+        scores[command] = score
+    return scores
+
+
+def test_untrained_predictor_has_no_answer():
+    assert CommandPredictor().rank(pane("$ ls")) == []
+    assert CommandPredictor().predict(pane("$ ls")) is None
+
+
+def test_pane_state_picks_the_command():
+    predictor = trained()
+    command, probability = predictor.predict(pane("$ pytest -q", "1 failed", "user@host:~/p$"))
+    assert command == "pytest -q --lf" and probability > 0.9
+    assert predictor.predict(pane("$ git status", "modified: README.md", "user@host:~/p$"))[0] == "git add -p"
+
+
+def test_ranking_is_a_distribution_in_order():
+    ranked = trained().rank(pane("$ make", "user@host:~/p$"), k=2)
+    assert len(ranked) == 2 and ranked[0][0] == "make"
+    assert ranked[0][1] >= ranked[1][1]
+    assert sum(p for _, p in ranked) <= 1.0 + 1e-9
+
+
+def test_previous_command_is_a_feature():
+    predictor = CommandPredictor()
+    for _ in range(4):
+        predictor.learn(pane("$ git add -p", "user@host:~/p$"), "git commit")
+        predictor.learn(pane("$ git add -p", "user@host:~/p$"), "git push")
+    state = pane("$ git add -p", "user@host:~/p$")
+    assert "prev:git commit" in state_features(state, "git commit")
+    # learn() saw "git push" follow "git commit" every time
+    assert predictor.predict(state, "git commit")[0] == "git push"
+    assert predictor.predict(state, "git push")[0] == "git commit"
+
+
+def test_sparse_scores_match_the_full_model():
+    rng = random.Random(3)
+    words = ["build", "deploy", "docker", "cargo", "failed", "passed", "branch", "remote", "cache", "lint"]
+    commands = [f"cmd{i}" for i in range(12)]
+    predictor = CommandPredictor()
+    for _ in range(300):
+        command = rng.choice(commands)
+        text = " ".join(rng.sample(words, 3)) + " " + command
+        predictor.learn(pane(f"$ {text}"), command)
+
+    for _ in range(20):
+        prompt = pane("$ " + " ".join(rng.sample(words, 4)))
+        features = state_features(prompt)
+        full = full_scores(predictor, features)
+        ranked = predictor.rank(prompt, k=3)
+        assert ranked[0][0] == max(full, key=full.get)
+        # Same relative odds between the commands it returns
+        (a, pa), (b, pb) = ranked[:2]
+        assert math.log(pa / pb) == pytest.approx(full[a] - full[b])
+
+
+def test_refresh_learns_complete_lines_only(tmp_path):
+    log = tmp_path / "interactions.jsonl"
+    first = json.dumps({"persona": "sage", "prompt": pane("$ make"), "response": "`make test`"})
+    second = json.dumps({"persona": "sage", "prompt": pane("$ ls"), "response": "`ls -la`\nShows dotfiles."})
+    log.write_text(first + "\n" + second[:15])
+    predictor = CommandPredictor(log)
+    predictor.refresh()
+    assert len(predictor) == 1
+    with open(log, "a") as f:
+        f.write(second[15:] + "\n")
+    predictor.refresh()
+    assert len(predictor) == 2
+    assert predictor.class_counts == {"make test": 1, "ls -la": 1}
@@ -0,0 +1,55 @@
+"""Prompt assembly: cross-pane dedupe and per-session deltas"""
+
+from types import SimpleNamespace
+
+from sage_prompt import PromptBuilder
+
+CONFIG = SimpleNamespace(system_prompt="You suggest shell commands.", candidates=1, prompt_budget=0)
+PANES = {
+    "%1": "$ make test\n12 passed\nuser@host:~/p$",
+    "%2": "$ git status\nclean\nuser@host:~/p$",
+}
+
+
+def user_message(built) -> str:
+    return built.messages[-1]["content"]
+
+
+def test_every_pane_keeps_a_shared_prompt_line():
+    built = PromptBuilder().build(CONFIG, PANES)
+    assert user_message(built).count("user@host:~/p$") == 2
+
+
+def test_unsent_prompts_are_not_the_delta_baseline():
+    builder = PromptBuilder()
+    builder.build(CONFIG, PANES)  # cancelled or failed: never committed
+    assert "unchanged since last query" not in user_message(builder.build(CONFIG, PANES))
+
+
+def test_answered_prompts_are_the_delta_baseline():
+    builder = PromptBuilder()
+    builder.commit(builder.build(CONFIG, PANES))
+    again = user_message(builder.build(CONFIG, PANES))
+    assert "unchanged since last query" in again
+    assert "12 passed" not in again
+
+
+def test_late_answers_do_not_roll_the_baseline_back():
+    builder = PromptBuilder()
+    first = builder.build(CONFIG, PANES)
+    second = builder.build(CONFIG, {"%1": "$ ls\nREADME.md\nuser@host:~/p$"})
+    builder.commit(second)
+    builder.commit(first)
+    assert builder.previous == second.tails
+
+
+def test_lines_trimmed_for_budget_are_not_the_baseline():
+    tight = SimpleNamespace(system_prompt="", candidates=1, prompt_budget=40)
+    pane = {"%1": "$ make\ncc -c one.c\ncc -c two.c\nlinking sage\nuser@host:~/p$"}
+    builder = PromptBuilder()
+    first = builder.build(tight, pane)
+    assert "cc -c one.c" not in user_message(first)
+    builder.commit(first)
+    roomy = SimpleNamespace(system_prompt="", candidates=1, prompt_budget=0)
+    # The model never saw the trimmed lines, so they are not "unchanged since last query"
+    assert "cc -c one.c" in user_message(builder.build(roomy, pane))
@@ -0,0 +1,139 @@
+"""Tmux I/O: batched snapshots, activity-based idle detection and control-mode bookkeeping"""
+
+import subprocess
+import threading
+import time
+
+import sage_tmux
+from sage_tmux import SNAPSHOT_MARKER, ActivityTracker, ControlModeMonitor, TmuxSnapshotter
+
+SCREENS = {"%1": "$ make\nok\nuser@host:~$", "%2": "top - 12:00", "%3": ">>> ", "%4": ""}
+
+
+class FakeTmux:
+    """Runs chained display-message/capture-pane commands against SCREENS
+
+    Like tmux, it stops at the first command whose pane doesn't exist.
+    """
+
+    def __init__(self, vanished=()):
+        self.vanished = set(vanished)
+        self.calls = []
+
+    def __call__(self, cmd, capture_output=False):
+        self.calls.append(cmd)
+        commands, current = [], []
+        for arg in cmd[1:] + [";"]:
+            if arg == ";":
+                commands.append(current)
+                current = []
+            else:
+                current.append(arg)
+        out, code = [], 0
+        for command in commands:
+            pane = command[command.index("-t") + 1]
+            if pane in self.vanished:
+                code = 1
+                break
+            out.append(SNAPSHOT_MARKER + pane if command[0] == "display-message" else SCREENS[pane])
+        stdout = "\n".join(out) + "\n" if out else ""
+        return subprocess.CompletedProcess(cmd, code, stdout.encode(), b"can't find pane" if code else b"")
+
+
+def test_parse_splits_chained_output_per_pane():
+    output = f"noise\n{SNAPSHOT_MARKER}%1\n$ ls\nREADME\n{SNAPSHOT_MARKER}%2\n\n{SNAPSHOT_MARKER}%3\n>>> "
+    assert TmuxSnapshotter.parse(output) == {"%1": "$ ls\nREADME", "%2": "", "%3": ">>> "}
+
+
+def test_one_tmux_call_per_batch(monkeypatch):
+    tmux = FakeTmux()
+    monkeypatch.setattr(sage_tmux.subprocess, "run", tmux)
+    snapshot = TmuxSnapshotter(max_panes_per_call=3).capture(list(SCREENS))
+    assert snapshot.subprocess_calls == len(tmux.calls) == 2
+    assert snapshot.last_line("%1") == "user@host:~$"
+    assert snapshot.content("%4").strip() == ""
+    assert set(snapshot.panes) == set(SCREENS)
+
+
+def test_panes_after_a_vanished_one_are_retried(monkeypatch):
+    tmux = FakeTmux(vanished={"%2"})
+    monkeypatch.setattr(sage_tmux.subprocess, "run", tmux)
+    snapshot = TmuxSnapshotter().capture(list(SCREENS))
+    # One batch that stops at %2, then %2, %3 and %4 one at a time
+    assert snapshot.subprocess_calls == 4
+    assert "%2" not in snapshot
+    assert snapshot.last_line("%3") == ">>>" and "%4" in snapshot
+
+
+def test_activity_rows_parse_with_fallbacks():
+    rows = "\n".join([
+        "%1\t1700000000\t1699999999\tzsh",
+        "%2\t\t1699999990\tvim",        # tmux without pane_activity
+        "%3\tsoon\t\t-bash",            # garbage timestamp
+        "%4\t1700000000",                 # short row
+        "",
+    ])
+    info = ActivityTracker.parse(rows)
+    assert list(info) == ["%1", "%2", "%3"]
+    assert info["%1"].activity == 1700000000 and info["%1"].command == "zsh"
+    assert info["%2"].activity == 1699999990
+    assert info["%3"].activity == 0.0 and info["%3"].command == "-bash"
+
+
+def test_idle_needs_quiet_prompt_command_and_one_confirmation():
+    tracker = ActivityTracker("work", stale_after=2.0)
+    now = 1000.0
+    info = ActivityTracker.parse("%1\t990\t\tzsh\n%2\t999.5\t\tzsh\n%3\t900\t\tvim")
+    # Only the quiet shell needs a prompt check; %2 is too recent, %3 runs vim
+    assert tracker.observe(["%1", "%2", "%3"], info, now) == ["%1"]
+    assert tracker.idle_since(["%1"], now) == {"%1": None}
+
+    tracker.confirm("%1", "user@host:~$")
+    assert tracker.idle_since(["%1", "%2", "%3"], now) == {"%1": 990, "%2": None, "%3": None}
+    # Same quiet period: no second capture
+    assert tracker.observe(["%1"], info, now + 5) == []
+
+    # New output starts a new quiet period that needs its own confirmation
+    info = ActivityTracker.parse("%1\t1003\t\tzsh")
+    assert tracker.observe(["%1"], info, now + 10) == ["%1"]
+    tracker.confirm("%1", "Password:")
+    assert tracker.idle_since(["%1"], now + 10) == {"%1": None}
+
+
+class RecordingStdin:
+    """Pipe stand-in that records each command line, slowly enough for threads to interleave"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data: bytes):
+        time.sleep(0.0005)
+        self.lines.append(data.decode().rstrip("\n"))
+
+    def flush(self):
+        pass
+
+
+class FakeProcess:
+    def __init__(self):
+        self.stdin = RecordingStdin()
+
+    def poll(self):
+        return None
+
+
+def test_replies_are_matched_in_write_order():
+    monitor = ControlModeMonitor("work")
+    monitor.process = FakeProcess()
+
+    def sender(kind: str):
+        for i in range(30):
+            monitor.send(f"{kind} {i}", kind=kind)
+
+    threads = [threading.Thread(target=sender, args=(kind,)) for kind in ("panes", "capture")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The n-th %begin/%end pair answers the n-th command written
+    assert [line.split()[0] for line in monitor.process.stdin.lines] == monitor._pending